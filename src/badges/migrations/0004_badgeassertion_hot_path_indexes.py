@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('badges', '0003_auto_20190809_1136'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='badgeassertion',
+            index=models.Index(fields=['user', 'badge', 'ordinal'], name='badgeassertion_user_badge_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='badgeassertion',
+            index=models.Index(fields=['user', 'semester', 'game_lab_transfer'], name='badgeassertion_user_sem_idx'),
+        ),
+    ]
@@ -2,7 +2,7 @@ from collections import defaultdict
 
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Max, Sum
 from django.shortcuts import get_object_or_404
 from django.urls import reverse
@@ -13,7 +13,7 @@ from django.db.models.signals import post_save
 from siteconfig.models import SiteConfig
 from notifications.signals import notify
 
-from prerequisites.models import Prereq, IsAPrereqMixin, HasPrereqsMixin
+from prerequisites.models import Prereq, IsAPrereqMixin, HasPrereqsMixin, users_with_at_least
 
 
 # Create your models here.
@@ -201,6 +201,10 @@ class Badge(models.Model, IsAPrereqMixin, HasPrereqsMixin):
         # print("num_approved: " + str(num_approved) + "/" + str(num_required))
         return num_approved >= num_required
 
+    def users_meeting_condition_as_prerequisite(self, user_ids, num_required=1):
+        assertions = BadgeAssertion.objects.get_queryset(False).get_badge(self)
+        return users_with_at_least(assertions, num_required, user_ids)
+
 
 class BadgeAssertionQuerySet(models.query.QuerySet):
     def get_user(self, user):
@@ -288,18 +292,70 @@ class BadgeAssertionManager(models.Manager):
             semester_id=active_semester
         )
         new_assertion.save()
-        user.profile.xp_invalidate_cache()  # recalculate user's XP
         return new_assertion
 
     def check_for_new_assertions(self, user, transfer=False):
-        badges = Badge.objects.get_conditions_met(user)
-        for badge in badges:
-            # if the badge doesn't already exist
-            if not self.all_for_user_badge(user, badge, False):
-                self.create_assertion(user, badge, None, transfer)
-                # if a new badge has been granted, then check again recursively.
-                # maybe this should be celeried?
-                self.check_for_new_assertions(user, transfer)
+        """
+        Grant the user every active badge they have met the prerequisites of and don't have yet, including badges that
+        the new ones lead to.  The user's facts are loaded once (see prerequisites.graph.UserFacts), and each round of
+        newly earned badges is added to them in memory until no more are earned.  The new assertions are then created
+        with one insert, one XP ledger update and one insert of notifications, instead of a save and its signals each.
+        :return: the new assertions
+        """
+        # import here to prevent circular imports
+        from notifications.models import Notification
+        from prerequisites.graph import UserFacts, get_changed_targets, get_prereq_graph
+        from prerequisites.tasks import schedule_quest_conditions_for_user
+        from profile_manager.models import XPEntry, xp_contribution
+        from quest_manager.models import invalidate_available_quests
+
+        graph = get_prereq_graph()
+        facts = UserFacts(user)
+        candidates = {
+            badge.id: badge for badge in Badge.objects.get_queryset().get_active().select_related('badge_type')
+            if badge.id not in facts.badge_counts
+        }
+
+        new_badges = []
+        while candidates:
+            earned = graph.get_conditions_met(Badge, list(candidates), facts, False)
+            if not earned:
+                break
+            for badge_id in earned:
+                badge = candidates.pop(badge_id)
+                new_badges.append(badge)
+                facts.badge_counts[badge_id] = 1
+                if not transfer:
+                    facts.xp += badge.xp
+            # the memoized prerequisites may depend on the new badges or XP
+            facts.prereqs_met = {}
+
+        if not new_badges:
+            return []
+
+        config = SiteConfig.get()
+        issued_by = config.deck_ai
+        with transaction.atomic():
+            # bypasses save() and its signals, so everything they would do is done below
+            new_assertions = self.bulk_create([
+                BadgeAssertion(badge=badge, user=user, ordinal=1, issued_by=issued_by, game_lab_transfer=transfer,
+                               semester_id=config.active_semester_id)
+                for badge in new_badges
+            ])
+            XPEntry.objects.record_changes([
+                (assertion, None, xp_contribution(assertion)) for assertion in new_assertions
+            ])
+
+            notifications_by_icon = defaultdict(list)
+            for assertion in new_assertions:
+                notifications_by_icon[badge_notification_icon(assertion.badge)].append((user, assertion.badge, None))
+            for icon, notifications in notifications_by_icon.items():
+                Notification.objects.bulk_notify(issued_by, "granted you a", icon, notifications)
+
+            invalidate_available_quests(user.id)
+            targets = {target for assertion in new_assertions for target in get_changed_targets(assertion)}
+            schedule_quest_conditions_for_user(user.id, list(targets))
+        return new_assertions
 
     def get_by_type_for_user(self, user):
         self.check_for_new_assertions(user)
@@ -349,6 +405,14 @@ class BadgeAssertion(models.Model):
 
     objects = BadgeAssertionManager()
 
+    class Meta:
+        indexes = [
+            # a user's assertions of a badge, e.g. all_for_user_badge() and num_assertions()
+            models.Index(fields=['user', 'badge', 'ordinal'], name='badgeassertion_user_badge_idx'),
+            # a user's assertions and XP in the active semester
+            models.Index(fields=['user', 'semester', 'game_lab_transfer'], name='badgeassertion_user_sem_idx'),
+        ]
+
     def __str__(self):
         # ordinal_str = ""
         # if self.ordinal > 1:
@@ -377,6 +441,18 @@ class BadgeAssertion(models.Model):
         return BadgeAssertion.objects.all_for_user_badge(self.user, self.badge, False)
 
 
+def badge_notification_icon(badge):
+    fa_icon = badge.badge_type.fa_icon
+
+    if not fa_icon:
+        fa_icon = "fa-certificate"
+
+    icon = "<i class='text-warning fa fa-lg fa-fw "
+    icon += fa_icon
+    icon += "'></i>"
+    return icon
+
+
 # only receive signals from BadgeAssertion model
 @receiver(post_save, sender=BadgeAssertion)
 def post_save_receiver(sender, **kwargs):
@@ -387,20 +463,11 @@ def post_save_receiver(sender, **kwargs):
         if sender is None:
             sender = User.objects.filter(is_staff=True).first()
 
-        fa_icon = assertion.badge.badge_type.fa_icon
-
-        if not fa_icon:
-            fa_icon = "fa-certificate"
-
-        icon = "<i class='text-warning fa fa-lg fa-fw "
-        icon += fa_icon
-        icon += "'></i>"
-
         notify.send(
             sender,
             # action= action,
             target=assertion.badge,
             recipient=assertion.user,
             affected_users=[assertion.user, ],
-            icon=icon,
+            icon=badge_notification_icon(assertion.badge),
             verb="granted you a")
@@ -8,6 +8,10 @@ from tenant_schemas.test.client import TenantClient
 
 from siteconfig.models import SiteConfig
 from badges.models import Badge, BadgeAssertion, BadgeType, BadgeSeries, BadgeRarity
+from notifications.models import Notification
+from prerequisites.models import Prereq
+from profile_manager.models import Profile
+from quest_manager.models import Quest, QuestSubmission
 
 User = get_user_model()
 
@@ -166,8 +170,28 @@ class BadgeAssertionTestModel(TenantTestCase):
         # TODO need to test this properly
 
     def test_badge_assertion_manager_check_for_new_assertions(self):
-        BadgeAssertion.objects.check_for_new_assertions(self.student)
-        # TODO need to test this properly
+        self.assertEqual(BadgeAssertion.objects.check_for_new_assertions(self.student), [])
+
+        # a chain of badges: the quest leads to the first, each badge leads to the next
+        quest = mommy.make(Quest, xp=1)
+        badges = mommy.make(Badge, xp=10, _quantity=3)
+        Prereq.add_simple_prereq(badges[0], quest)
+        Prereq.add_simple_prereq(badges[1], badges[0])
+        Prereq.add_simple_prereq(badges[2], badges[1])
+        num_notifications = Notification.objects.filter(recipient=self.student).count()
+
+        # approving the quest grants them all at once
+        sub = mommy.make(QuestSubmission, user=self.student, quest=quest, semester=self.sem)
+        sub.mark_approved()
+
+        assertions = BadgeAssertion.objects.filter(user=self.student, badge__in=badges)
+        self.assertEqual(sorted(assertions.values_list('badge_id', flat=True)), sorted(badge.id for badge in badges))
+        self.assertEqual(Notification.objects.filter(recipient=self.student).count(), num_notifications + 3)
+        self.assertEqual(Profile.objects.get(user=self.student).xp_cached, 31)
+
+        # nothing new the next time
+        self.assertEqual(BadgeAssertion.objects.check_for_new_assertions(self.student), [])
+        self.assertEqual(assertions.count(), 3)
 
     def test_fraction_of_active_users_granted_this(self):
         num_students_with_badge = 3
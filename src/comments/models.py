@@ -74,6 +74,30 @@ class CommentManager(models.Manager):
 
         return comment
 
+    def create_comments(self, user, text, targets_paths, convert_newlines=True):
+        """ create_comment() with the same text on many targets, in two queries
+        :param targets_paths: a list of (target, path)
+        """
+        text = clean_html(text, convert_newlines)
+
+        comments = []
+        for target, path in targets_paths:
+            comments.append(self.model(
+                user=user,
+                path=path,
+                text=text,
+                target_content_type=ContentType.objects.get_for_model(target),
+                target_object_id=target.id,
+            ))
+        comments = self.bulk_create(comments)
+
+        # add anchor target to Comment path now that ids are assigned
+        for comment in comments:
+            comment.path += "#comment-" + str(comment.id)
+        self.bulk_update(comments, ['path'])
+
+        return comments
+
 
 def clean_html(text, convert_newlines=True):
     """ Several steps to clean HTML input by user:
@@ -5,9 +5,8 @@ import numpy
 from django.conf import settings
 from django.core.validators import validate_comma_separated_integer_list
 from django.contrib.auth.models import User
-from django.db import models
-from django.db.models.signals import post_save
-from django.dispatch import receiver
+from django.db import models, transaction
+from django.db.models import Count, Sum
 from django.urls import reverse
 from django.utils import timezone
 
@@ -19,7 +18,12 @@ from colorful.fields import RGBColorField
 from siteconfig.models import SiteConfig
 
 from prerequisites.models import IsAPrereqMixin
-from quest_manager.models import QuestSubmission
+from quest_manager.models import QuestSubmission, invalidate_quest_availability
+
+# Steps of closing a semester, see SemesterManager.close_semester()
+SEMESTER_CLOSE_GRADES = 'grades'
+SEMESTER_CLOSE_IN_PROGRESS = 'in_progress'
+SEMESTER_CLOSE_DONE = 'done'
 
 
 class MarkRangeManager(models.Manager):
@@ -127,6 +131,9 @@ class Rank(models.Model, IsAPrereqMixin):
         # profile = Profile.objects.get(user=user)
         return user.profile.xp_cached >= self.xp
 
+    def users_meeting_condition_as_prerequisite(self, user_ids, num_required=1):
+        return set(User.objects.filter(id__in=user_ids, profile__xp_cached__gte=self.xp).values_list('id', flat=True))
+
     def get_map(self):
         from djcytoscape.models import CytoScape
         return CytoScape.objects.get_map_for_init(self)
@@ -150,6 +157,10 @@ class Grade(models.Model, IsAPrereqMixin):
         else:
             return False
 
+    def users_meeting_condition_as_prerequisite(self, user_ids, num_required=1):
+        coursestudents = CourseStudent.objects.all_for_active_semester(user_ids)
+        return set(coursestudents.filter(grade_fk__value=self.value).values_list('user_id', flat=True))
+
 
 class SemesterManager(models.Manager):
     def get_queryset(self):
@@ -171,27 +182,99 @@ class SemesterManager(models.Manager):
             sem.save()
 
     def complete_active_semester(self):
+        """
+        Start closing the active semester in the background, see close_semester().  If it's already being closed,
+        carry on from where it got to.
+        :return: the semester, or -1 if it's already closed, or -2 if there are still quests awaiting approval
+        """
+        # import here to prevent circular imports
+        from .tasks import close_semester
 
-        active_sem = self.get_current()
+        config = SiteConfig.get()
+        active_sem = config.active_semester
 
         # This semester has already been closed
         if active_sem.closed:
             return -1
 
-        # There are still quests awaiting approval, can't close!
-        if QuestSubmission.objects.all_awaiting_approval():
-            return -2
-
-        # need to calculate all user XP and store in their Course
-        CourseStudent.objects.calc_semester_grades(active_sem)
-
-        QuestSubmission.objects.remove_in_progress()
-
-        active_sem.closed = True
-        active_sem.save()
-
+        progress = config.semester_close_progress
+        if not progress or progress['semester'] != active_sem.id or progress['step'] == SEMESTER_CLOSE_DONE:
+            # There are still quests awaiting approval, can't close!
+            if QuestSubmission.objects.all_awaiting_approval():
+                return -2
+
+            progress = {
+                'semester': active_sem.id,
+                'step': SEMESTER_CLOSE_GRADES,
+                'last_id': 0,
+                'done': 0,
+                'total': CourseStudent.objects.all_for_semester(active_sem).count(),
+            }
+            # update() so it doesn't go through SiteConfig's signals
+            SiteConfig.objects.filter(pk=config.pk).update(semester_close_progress=progress)
+
+        transaction.on_commit(lambda: close_semester.apply_async(args=[active_sem.id], queue='default'))
         return active_sem
 
+    def close_semester(self, semester_id):
+        """
+        Close the semester started by complete_active_semester(), one batch at a time:
+        1. record the final XP of all the student courses in the semester and deactivate them
+        2. remove the quests still in progress
+        3. mark the semester closed
+
+        Rows are written in bulk without their signals, then the quest availability and prerequisite conditions they
+        would have updated are refreshed once at the end.  The step and how far it got are saved in
+        SiteConfig.semester_close_progress with each batch, so running this again carries on from there.
+        """
+        while self._close_semester_batch(semester_id):
+            pass
+
+    def _close_semester_batch(self, semester_id):
+        """ :return: True if there's more to do """
+        # import here to prevent circular imports
+        from prerequisites.tasks import update_quest_conditions_all
+
+        batch_size = settings.SEMESTER_CLOSE_BATCH_SIZE
+        with transaction.atomic():
+            # only one batch at a time, even if it was started twice
+            config = SiteConfig.objects.select_for_update().get(pk=SiteConfig.get().pk)
+            progress = config.semester_close_progress
+            if not progress or progress['semester'] != semester_id or progress['step'] == SEMESTER_CLOSE_DONE:
+                return False
+
+            if progress['step'] == SEMESTER_CLOSE_GRADES:
+                coursestudents = list(
+                    CourseStudent.objects.all_for_semester(semester_id).filter(id__gt=progress['last_id'])
+                    .order_by('id')[:batch_size]
+                )
+                if coursestudents:
+                    CourseStudent.objects.calc_semester_grades(semester_id, coursestudents)
+                    progress['last_id'] = coursestudents[-1].id
+                    progress['done'] += len(coursestudents)
+                else:
+                    progress.update(
+                        step=SEMESTER_CLOSE_IN_PROGRESS, last_id=0, done=0,
+                        total=QuestSubmission.objects.all_not_completed(active_semester_only=False).count(),
+                    )
+
+            elif progress['step'] == SEMESTER_CLOSE_IN_PROGRESS:
+                num_removed = QuestSubmission.objects.remove_in_progress(batch_size)
+                if num_removed:
+                    progress['done'] += num_removed
+                else:
+                    semester = self.get(pk=semester_id)
+                    semester.closed = True
+                    semester.save()
+                    progress['step'] = SEMESTER_CLOSE_DONE
+                    invalidate_quest_availability()
+                    transaction.on_commit(lambda: update_quest_conditions_all.apply_async(
+                        args=[1], queue='default', countdown=settings.CONDITIONS_UPDATE_COUNTDOWN
+                    ))
+
+            SiteConfig.objects.filter(pk=config.pk).update(semester_close_progress=progress)
+        return progress['step'] != SEMESTER_CLOSE_DONE
+
 
 def default_end_date():
     return date.today() + timedelta(days=135)
@@ -288,6 +371,30 @@ class Semester(models.Model):
         # make timezone aware
         return timezone.make_aware(dt, timezone.get_default_timezone())
 
+    def get_datetimes_by_days_since_start(self, num_class_days, add_holidays=False):
+        """
+        get_datetime_by_days_since_start() for each class day from 1 to num_class_days, stepping from one class day
+        to the next instead of looking up the excluded days and counting from the first day each time
+        """
+        excluded_days = list(self.excluded_days())
+
+        dates = []
+        date = self.first_day
+        for class_day in range(num_class_days + 1):
+            date = workday(date, 1, excluded_days)
+            dates.append(date)
+
+        if add_holidays:
+            # run each class day up to the day before the next one
+            dates = [next_date - timedelta(days=1) for next_date in dates[1:]]
+        else:
+            dates = dates[:-1]
+
+        return [
+            timezone.make_aware(datetime.combine(date, datetime.max.time()), timezone.get_default_timezone())
+            for date in dates
+        ]
+
     def get_student_mark_list(self, students_only=False):
         students = CourseStudent.objects.all_users_for_active_semester(students_only=students_only)
         mark_list = []
@@ -328,7 +435,7 @@ class ExcludedDate(models.Model):
         return self.date.strftime("%d-%b-%Y")
 
 
-class Course(models.Model, ):
+class Course(models.Model, IsAPrereqMixin):
     title = models.CharField(max_length=50, unique=True)
     icon = models.ImageField(upload_to='icons/', null=True, blank=True)
     xp_for_100_percent = models.PositiveIntegerField(default=1000)
@@ -353,6 +460,10 @@ class Course(models.Model, ):
         else:
             return False
 
+    def users_meeting_condition_as_prerequisite(self, user_ids, num_required=1):
+        coursestudents = CourseStudent.objects.all_for_active_semester(user_ids)
+        return set(coursestudents.filter(course=self).values_list('user_id', flat=True))
+
     @staticmethod
     def autocomplete_search_fields():  # for grapelli prereq selection
         return ("title__icontains",)
@@ -409,12 +520,31 @@ class CourseStudentManager(models.Manager):
                 xp += studentcourse.xp_adjustment
         return xp
 
-    def calc_semester_grades(self, semester):
-        coursestudents = self.get_queryset().get_semester(semester)
+    def calc_semester_grades(self, semester, coursestudents=None):
+        """
+        Record the final XP of the student courses in the semester, each student's XP for the semester split evenly
+        over their courses in it as in Profile.xp_per_course(), and deactivate them.  Written in bulk, without signals.
+        :param coursestudents: only these CourseStudents of the semester (e.g. one batch), otherwise all of them
+        """
+        # import here to prevent circular imports
+        from profile_manager.models import XPEntry
+
+        if coursestudents is None:
+            coursestudents = list(self.get_queryset().get_semester(semester))
+        user_ids = {coursestudent.user_id for coursestudent in coursestudents}
+
+        xp = dict(
+            XPEntry.objects.filter(semester=semester, user_id__in=user_ids).order_by()
+            .values('user_id').annotate(xp=Sum('delta')).values_list('user_id', 'xp')
+        )
+        num_courses = dict(
+            self.get_queryset().get_semester(semester).filter(user_id__in=user_ids).order_by()
+            .values('user_id').annotate(num=Count('id')).values_list('user_id', 'num')
+        )
         for coursestudent in coursestudents:
-            coursestudent.final_xp = coursestudent.user.profile.xp_per_course()
+            coursestudent.final_xp = max(int(xp.get(coursestudent.user_id, 0) / num_courses[coursestudent.user_id]), 0)
             coursestudent.active = False
-            coursestudent.save()
+        self.bulk_update(coursestudents, ['final_xp', 'active'])
 
     def all_for_semester(self, semester, students_only=False):
         qs = self.get_queryset().get_semester(semester)
@@ -429,6 +559,10 @@ class CourseStudentManager(models.Manager):
     def current_courses(self, user):
         return self.all_for_user(user).get_semester(SiteConfig.get().active_semester)
 
+    def all_for_active_semester(self, user_ids):
+        """ :return: the courses of all these users (by id) in the active semester """
+        return self.get_queryset().filter(user_id__in=user_ids).get_semester(SiteConfig.get().active_semester)
+
     def all_users_for_active_semester(self, students_only=False):
         """
         :return: queryset of all Users who are enrolled in a course during the active semester (doubles removed)
@@ -495,15 +629,6 @@ class CourseStudent(models.Model):
             return 0
 
 
-@receiver(post_save, sender=CourseStudent)
-def coursestudent_post_save_callback(instance, **kwargs):
-    """
-    This model's objects are edited by teachers using the admin menu.
-    If they make a manual XP adjustment we need to invalidate the user's xp_cache to recalculate xp
-    """
-    instance.user.profile.xp_invalidate_cache()
-
-
 class MarkDistributionHistogram(Chart):
     chart_type = 'bar'
     scales = {
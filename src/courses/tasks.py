@@ -0,0 +1,9 @@
+from celery import shared_task
+
+from .models import Semester
+
+
+@shared_task(name='courses.tasks.close_semester')
+def close_semester(semester_id):
+    """ Close the semester, or carry on closing it, see SemesterManager.close_semester() """
+    Semester.objects.close_semester(semester_id)
@@ -1,11 +1,15 @@
 from datetime import timedelta, date
 from django.contrib.auth import get_user_model
 
+from mock import patch
 from model_mommy import mommy
+from model_mommy.recipe import Recipe
 from freezegun import freeze_time
 from tenant_schemas.test.cases import TenantTestCase
 
-from courses.models import MarkRange, Course, Semester
+from courses.models import MarkRange, Course, CourseStudent, Semester, ExcludedDate, SEMESTER_CLOSE_DONE
+from quest_manager.models import Quest, QuestSubmission
+from siteconfig.models import SiteConfig
 
 User = get_user_model()
 
@@ -93,6 +97,62 @@ class SemesterTestModel(TenantTestCase):
 
         # Timezone problems?    
 
+    def test_get_datetimes_by_days_since_start(self):
+        mommy.make(ExcludedDate, semester=self.semester, date=date(2020, 9, 14))
+        for add_holidays in [False, True]:
+            self.assertEqual(
+                self.semester.get_datetimes_by_days_since_start(10, add_holidays=add_holidays),
+                [self.semester.get_datetime_by_days_since_start(day, add_holidays=add_holidays) for day in range(1, 11)]
+            )
+
+
+class SemesterCloseTestManager(TenantTestCase):
+
+    def setUp(self):
+        Recipe(User, is_staff=True).make()  # need a teacher or student creation will fail.
+        self.semester = SiteConfig.get().active_semester
+        self.students = mommy.make(User, _quantity=3)
+        # the first student has two courses this semester
+        self.coursestudents = [
+            mommy.make(CourseStudent, user=student, semester=self.semester) for student in self.students
+        ] + [mommy.make(CourseStudent, user=self.students[0], semester=self.semester)]
+
+        quest = mommy.make(Quest, xp=10)
+        for student in self.students[:2]:
+            mommy.make(QuestSubmission, user=student, quest=quest, semester=self.semester).mark_approved()
+        self.in_progress = mommy.make(QuestSubmission, user=self.students[2], quest=quest, semester=self.semester)
+
+    @patch('prerequisites.tasks.update_quest_conditions_all.apply_async')
+    def test_complete_active_semester(self, update_conditions):
+        self.assertEqual(Semester.objects.complete_active_semester(), self.semester)
+        self.assertEqual(SiteConfig.get().semester_close_progress['total'], 4)
+
+        with self.settings(SEMESTER_CLOSE_BATCH_SIZE=1):
+            Semester.objects.close_semester(self.semester.id)
+
+        self.assertEqual(SiteConfig.get().semester_close_progress['step'], SEMESTER_CLOSE_DONE)
+        self.assertTrue(Semester.objects.get(id=self.semester.id).closed)
+        self.assertFalse(QuestSubmission.objects.filter(id=self.in_progress.id).exists())
+        self.assertEqual(
+            {cs.id: (cs.final_xp, cs.active) for cs in CourseStudent.objects.filter(semester=self.semester)},
+            {
+                self.coursestudents[0].id: (5, False),
+                self.coursestudents[1].id: (10, False),
+                self.coursestudents[2].id: (0, False),
+                self.coursestudents[3].id: (5, False),
+            }
+        )
+
+        # closing it again does nothing
+        self.assertEqual(Semester.objects.complete_active_semester(), -1)
+        Semester.objects.close_semester(self.semester.id)
+        self.assertTrue(Semester.objects.get(id=self.semester.id).closed)
+
+    def test_complete_active_semester_awaiting_approval(self):
+        self.in_progress.mark_completed()
+        self.assertEqual(Semester.objects.complete_active_semester(), -2)
+        self.assertIsNone(SiteConfig.get().semester_close_progress)
+
 
 class CourseTestModel(TenantTestCase):
 
@@ -5,11 +5,14 @@ from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.contrib.messages.views import SuccessMessageMixin
+from django.core.cache import cache
 from django.urls import reverse_lazy
 from django.shortcuts import get_object_or_404, redirect, render, Http404, HttpResponse
+from django.utils import timezone
 from django.views.generic import ListView
 from django.views.generic.edit import CreateView
 
+from profile_manager.models import XPDailyTotal, xp_progress_chart_cache_key
 from siteconfig.models import SiteConfig
 
 # from .forms import ProfileForm
@@ -110,17 +113,17 @@ def end_active_semester(request):
         return HttpResponse(status=401)
 
     sem = Semester.objects.complete_active_semester()
-    if sem is -1:
+    if sem == -1:
         messages.warning(request,
                          "Semester is already closed, no action taken.")
-    if sem is -2:
+    elif sem == -2:
         messages.warning(request,
                          "There are still quests awaiting approval. Can't close the Semester \
                          until they are approved or returned")
     else:
-        messages.success(request, "Semester " + str(sem) + " has been closed.")
+        messages.success(request, "Semester " + str(sem) + " is being closed. Its progress is shown below.")
 
-    return redirect('config')
+    return redirect(SiteConfig.get().get_absolute_url())
 
 
 @allow_non_public_view
@@ -134,26 +137,26 @@ def ajax_progress_chart(request, user_id=0):
     if request.is_ajax() and request.method == "POST":
         sem = SiteConfig.get().active_semester
 
-        # generate a list of dates, from first date of semester to today
-        datelist = []
-        for i in range(1, sem.days_so_far() + 1):
-            # need to ignore weekends and non-class days
-            next_day_of_class = sem.get_datetime_by_days_since_start(i, add_holidays=True)
-            datelist.append(next_day_of_class)
+        # XP at the end of each class day so far, this only changes when the user's XP does (or tomorrow)
+        cache_key = xp_progress_chart_cache_key(user.id, sem.id)
+        xp_series = cache.get(cache_key)
+        if xp_series is None:
+            # generate a list of dates, from first date of semester to today, ignoring weekends and non-class days
+            datelist = sem.get_datetimes_by_days_since_start(sem.days_so_far(), add_holidays=True)
+            dates = [timezone.localtime(day_of_class).date() for day_of_class in datelist]
+            xp_series = XPDailyTotal.objects.get_xp_series(user, sem, dates)
+            cache.set(cache_key, xp_series, 60 * 60 * 24)
 
         xp_data = []
         # generate an list of dictionary data for chart.js:
         #   x: day into course
         #   y: XP earned so far
 
-        xp = 0
         num_courses = user.profile.num_courses()
-        # days_so_far == len(datelist)
-        for day in range(0, sem.days_so_far()):
-            xp = user.profile.xp_to_date(datelist[day]) / num_courses
+        for day, xp in enumerate(xp_series):
             xp_data.append(
                 # day 0-indexed
-                {'x': day + 1, 'y': xp}
+                {'x': day + 1, 'y': xp / num_courses}
             )
 
         progress_chart = {
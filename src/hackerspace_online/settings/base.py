@@ -505,6 +505,23 @@ CELERY_TASKS_BUNCH_SIZE = 10
 
 # allowed delay between conditions met updates for all users:
 CONDITIONS_UPDATE_COUNTDOWN = 60 * 1  # In sec., wait before start next 'big' update for all conditions, if it's going to start - all other updates could be skipped
+# In sec., wait before updating a user's conditions, changes made in the meantime are handled by the same update
+CONDITIONS_UPDATE_USER_COUNTDOWN = 5
+# In sec., autosaved submission drafts are kept in the cache and written to the database this long after they change
+SUBMISSION_DRAFT_FLUSH_COUNTDOWN = 60
+# In sec., drafts are dropped from the cache this long after their last autosave, long after they've been written
+SUBMISSION_DRAFT_TIMEOUT = 60 * 60 * 24
+# Limits on the draft store: longer drafts are written straight to the database, and once more than this many drafts
+# are waiting, they're all written right away
+SUBMISSION_DRAFT_MAX_LENGTH = 100000
+SUBMISSION_DRAFT_MAX_PENDING = 1000
+# Closing a semester records final XP and removes quests in progress this many rows at a time
+SEMESTER_CLOSE_BATCH_SIZE = 500
+# In sec., the rendered cards of the Available quests tab are cached this long, editing a quest replaces its card anyway
+QUEST_CARD_CACHE_TIMEOUT = 60 * 60 * 24
+# Updates of all users' conditions are done this many users at a time, by up to this many tasks in parallel
+CONDITIONS_UPDATE_CHUNK_SIZE = 100
+CONDITIONS_UPDATE_CONCURRENCY = 4
 
 # Django Postman
 POSTMAN_DISALLOW_ANONYMOUS = True
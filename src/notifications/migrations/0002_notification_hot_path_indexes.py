@@ -0,0 +1,20 @@
+from django.db import migrations, models
+import django.db.models.query_utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['recipient', '-timestamp'], name='notification_recipient_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(condition=django.db.models.query_utils.Q(('unread', True)), fields=['recipient', '-timestamp'], name='notification_unread_idx'),
+        ),
+    ]
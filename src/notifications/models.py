@@ -82,6 +82,32 @@ class NotificationManager(models.Manager):
         # should only have one element?
         return self.get_queryset().get_user(user).get_object_target(target).first()
 
+    def bulk_notify(self, sender, verb, icon, notifications):
+        """
+        Like notify.send() for many recipients and targets at once, with a single insert.  See new_notification()
+        :param notifications: a list of (recipient, target, action), target and action can be None
+        """
+        sender_content_type = ContentType.objects.get_for_model(sender)
+        new_notes = []
+        for recipient, target, action in notifications:
+            # don't send a notification to yourself/themself
+            if recipient == sender:
+                continue
+            new_note = self.model(
+                recipient=recipient,
+                verb=verb,
+                sender_content_type=sender_content_type,
+                sender_object_id=sender.id,
+                font_icon=icon,
+            )
+            # Action not currently used...
+            for option, obj in (("target", target), ("action", action)):
+                if obj is not None:
+                    setattr(new_note, "%s_content_type" % option, ContentType.objects.get_for_model(obj))
+                    setattr(new_note, "%s_object_id" % option, obj.id)
+            new_notes.append(new_note)
+        return self.bulk_create(new_notes)
+
     def get_user_target_unread(self, user, target):
         # should be only one, first will convert from queryset to notification
         notification = self.get_queryset().get_user(user).get_object_target(target).first()
@@ -119,6 +145,13 @@ class Notification(models.Model):
 
     objects = NotificationManager()
 
+    class Meta:
+        indexes = [
+            # a user's notifications, newest first, see NotificationManager
+            models.Index(fields=['recipient', '-timestamp'], name='notification_recipient_idx'),
+            models.Index(fields=['recipient', '-timestamp'], name='notification_unread_idx', condition=Q(unread=True)),
+        ]
+
     def __str__(self):
         try:
             target_url = self.target_object.get_absolute_url()
@@ -1,11 +1,23 @@
 from django import forms
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.contrib.admin.views.main import ChangeList
 from django.contrib.contenttypes.admin import GenericTabularInline
+from django.contrib.contenttypes.forms import BaseGenericInlineFormSet
 
-from .models import Prereq, PrereqAllConditionsMet
+from .models import PREREQ_MAX_DEPTH, Prereq, PrereqAllConditionsMet, PrereqCycleError, prefetch_prereq_objects
 from tenant.admin import NonPublicSchemaOnlyAdminAccessMixin
 
 
+def depth(prereq):
+    """ How many Prereqs deep the conditions of a saved Prereq are nested, see Prereq.get_depth() """
+    if prereq is None or prereq.pk is None:
+        return '-'
+    try:
+        return '{} (max {})'.format(prereq.get_depth(), PREREQ_MAX_DEPTH)
+    except PrereqCycleError as e:
+        return str(e)
+
+
 class PrereqInlineForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
         super(PrereqInlineForm, self).__init__(*args, **kwargs)
@@ -15,16 +27,26 @@ class PrereqInlineForm(forms.ModelForm):
         self.fields['or_prereq_content_type'].queryset = Prereq.all_registered_content_types()
 
 
+class PrereqInlineFormSet(BaseGenericInlineFormSet):
+    def get_queryset(self):
+        # resolve the generic objects of all the forms at once, the formset only uses the result as a list
+        if not hasattr(self, '_queryset'):
+            self._queryset = prefetch_prereq_objects(super().get_queryset())
+        return self._queryset
+
+
 class PrereqInline(GenericTabularInline):
     model = Prereq
     ct_field = "parent_content_type"
     ct_fk_field = "parent_object_id"
     fk_name = "parent_object"
     form = PrereqInlineForm
+    formset = PrereqInlineFormSet
 
     extra = 1
 
     exclude = ['name', ]
+    readonly_fields = [depth]
 
     autocomplete_lookup_fields = {
         'generic': [
@@ -35,15 +57,31 @@ class PrereqInline(GenericTabularInline):
 
 
 def auto_name_selected_prereqs(modeladmin, request, queryset):
-    for prereq in queryset:
+    for prereq in queryset.with_objects():
         prereq.name = str(prereq)
         prereq.save()
 
 
+class PrereqChangeList(ChangeList):
+    def get_results(self, request):
+        super().get_results(request)
+        self.result_list = prefetch_prereq_objects(self.result_list)
+
+
 class PrereqAdmin(NonPublicSchemaOnlyAdminAccessMixin, admin.ModelAdmin):
     list_display = ('id', 'parent', '__str__', 'name')
+    readonly_fields = [depth]
     actions = [auto_name_selected_prereqs]
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        # clean() only mentions the depth when it's over the limit
+        messages.info(request, 'The conditions of this prerequisite are nested {} Prereqs deep, the maximum is {}.'.format(
+            obj.get_depth(), PREREQ_MAX_DEPTH))
+
+    def get_changelist(self, request, **kwargs):
+        return PrereqChangeList
+
 
 class PrereqAllConditionsMetAdmin(NonPublicSchemaOnlyAdminAccessMixin, admin.ModelAdmin):
     list_display = ('id', 'user_id', 'model_name')
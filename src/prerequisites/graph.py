@@ -0,0 +1,371 @@
+"""
+A compiled, in-memory copy of every Prereq in a tenant.
+
+Evaluating prerequisites through the ORM (PrereqManager.all_conditions_met) costs a few queries per Prereq: one for
+each generic target, then more inside each target's condition_met_as_prerequisite().  The PrereqGraph loads all the
+Prereq rows once, resolves their targets in bulk (one query per content type), and evaluates the AND/OR/NOT/count
+logic against a UserFacts object: everything about a single user that any condition could ask for, fetched up front.
+It can also evaluate the same logic for many users at once, with one aggregate query per condition.
+
+The compiled graph is kept per process and per tenant, and is thrown away whenever a Prereq or a model that can act as
+a prerequisite is saved or deleted (see prerequisites.signals).
+"""
+import uuid
+from collections import defaultdict, namedtuple
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Count
+
+from badges.models import Badge, BadgeAssertion
+from courses.models import Course, CourseStudent, Grade, Rank
+from quest_manager.models import Quest, QuestSubmission
+
+from .models import Prereq, PrereqCycleError
+
+GRAPH_VERSION_CACHE_KEY = 'prereq_graph_version'
+
+# schema_name -> (version, PrereqGraph)
+_compiled_graphs = {}
+
+# A single (optionally inverted) requirement of a Prereq: its prereq_object or its or_prereq_object
+Condition = namedtuple('Condition', ['content_type_id', 'object_id', 'count', 'invert'])
+
+# A compiled Prereq. `alternate` is None if the Prereq has no OR condition
+PrereqNode = namedtuple('PrereqNode', ['id', 'main', 'alternate'])
+
+
+class UserFacts:
+    """
+    Everything the prerequisite conditions of the built-in models depend on, for a single user.
+    Mirrors the condition_met_as_prerequisite() implementations of Quest, Badge, Rank, Grade and Course.
+    """
+
+    def __init__(self, user):
+        self.user = user
+
+        # Quest: approved submissions (any semester) of non-archived quests that are visible to students
+        self.approved_quest_counts = dict(
+            QuestSubmission.objects.get_queryset().get_user(user).approved()
+            .order_by().values_list('quest_id').annotate(Count('id'))
+        )
+
+        # Badge: assertions from any semester
+        self.badge_counts = dict(
+            BadgeAssertion.objects.get_queryset().get_user(user)
+            .order_by().values_list('badge_id').annotate(Count('id'))
+        )
+
+        # Course and Grade: courses in the active semester
+        current_courses = CourseStudent.objects.current_courses(user).values_list('course_id', 'grade_fk__value')
+        self.course_ids = set()
+        self.grade_values = set()
+        for course_id, grade_value in current_courses:
+            self.course_ids.add(course_id)
+            self.grade_values.add(grade_value)
+
+        # Rank
+        self.xp = user.profile.xp_cached
+
+        # Memo of PrereqGraph.prereq_met(): prereq id -> True/False, or None while being evaluated
+        self.prereqs_met = {}
+
+    def quest_condition_met(self, quest_id, value, num_required):
+        return self.approved_quest_counts.get(quest_id, 0) >= num_required
+
+    def badge_condition_met(self, badge_id, value, num_required):
+        return self.badge_counts.get(badge_id, 0) >= num_required
+
+    def rank_condition_met(self, rank_id, xp, num_required):
+        return self.xp >= xp
+
+    def grade_condition_met(self, grade_id, grade_value, num_required):
+        return grade_value in self.grade_values
+
+    def course_condition_met(self, course_id, value, num_required):
+        return course_id in self.course_ids
+
+
+# field: the field the condition depends on
+# met: evaluates the condition for a single user, against their UserFacts
+FactCondition = namedtuple('FactCondition', ['field', 'met'])
+
+# Registered models that aren't listed here are kept as objects and fall back to their condition_met_as_prerequisite()
+FACT_CONDITIONS = {
+    Quest: FactCondition('pk', UserFacts.quest_condition_met),
+    Badge: FactCondition('pk', UserFacts.badge_condition_met),
+    Rank: FactCondition('xp', UserFacts.rank_condition_met),
+    Grade: FactCondition('value', UserFacts.grade_condition_met),
+    Course: FactCondition('pk', UserFacts.course_condition_met),
+}
+
+# The models UserFacts are built from -> the prerequisite models whose conditions a change to one of their rows can
+# affect, with the field holding the affected object's id (None when any object of that model could be affected).
+# Every one of them can also change the user's XP, and so any Rank condition.
+FACT_SOURCES = {
+    QuestSubmission: ((Quest, 'quest_id'), (Rank, None)),
+    BadgeAssertion: ((Badge, 'badge_id'), (Rank, None)),
+    CourseStudent: ((Course, None), (Grade, None), (Rank, None)),
+}
+
+
+def get_changed_targets(instance):
+    """
+    :param instance: a saved or deleted object of one of the FACT_SOURCES models
+    :return: a list of (content_type_id, object_id) of the prerequisites it can affect, see PrereqGraph.get_dependents()
+    """
+    return [
+        (ContentType.objects.get_for_model(model).id, getattr(instance, field) if field else None)
+        for model, field in FACT_SOURCES[type(instance)]
+    ]
+
+
+class PrereqGraph:
+
+    def __init__(self, nodes, targets):
+        """
+        :param nodes: a list of (parent_content_type_id, parent_object_id, PrereqNode)
+        :param targets: a dict of (content_type_id, object_id) -> (model, value) for every target that exists.
+            value is the FACT_CONDITIONS field for those models, None for a Prereq, and the object itself otherwise
+        """
+        self.nodes = {}
+        self.parents = defaultdict(list)
+        self.node_parents = {}
+        # Reverse index: (content_type_id, object_id) of a target -> ids of the nodes with a condition on it
+        self.dependents = defaultdict(set)
+        for parent_ct_id, parent_id, node in nodes:
+            self.nodes[node.id] = node
+            self.parents[(parent_ct_id, parent_id)].append(node)
+            self.node_parents[node.id] = (parent_ct_id, parent_id)
+            for condition in filter(None, (node.main, node.alternate)):
+                self.dependents[(condition.content_type_id, condition.object_id)].add(node.id)
+        self.targets = targets
+
+        # There's no telling what the condition_met_as_prerequisite() of other models depends on
+        self.opaque_targets = [
+            key for key, (model, value) in targets.items() if model is not Prereq and model not in FACT_CONDITIONS
+        ]
+
+    @classmethod
+    def compile(cls):
+        """ Load every Prereq and all of their targets: 1 query, plus one per content type used as a prerequisite """
+        nodes = []
+        ids_by_content_type = defaultdict(set)
+        for row in Prereq.objects.values_list(
+                'id', 'parent_content_type_id', 'parent_object_id',
+                'prereq_content_type_id', 'prereq_object_id', 'prereq_count', 'prereq_invert',
+                'or_prereq_content_type_id', 'or_prereq_object_id', 'or_prereq_count', 'or_prereq_invert'):
+            main = Condition(*row[3:7])
+            alternate = Condition(*row[7:11]) if row[7] and row[8] else None
+            nodes.append((row[1], row[2], PrereqNode(row[0], main, alternate)))
+            for condition in filter(None, (main, alternate)):
+                ids_by_content_type[condition.content_type_id].add(condition.object_id)
+
+        targets = {}
+        prereq_ids = {node.id for _, _, node in nodes}
+        for ct_id, ids in ids_by_content_type.items():
+            model = ContentType.objects.get_for_id(ct_id).model_class()
+            if model is None:  # deleted models
+                continue
+            if model is Prereq:
+                targets.update(((ct_id, pk), (Prereq, None)) for pk in ids & prereq_ids)
+            elif model in FACT_CONDITIONS:
+                rows = model._base_manager.filter(pk__in=ids).values_list('pk', FACT_CONDITIONS[model].field)
+                targets.update(((ct_id, pk), (model, value)) for pk, value in rows)
+            else:
+                objects = model._base_manager.in_bulk(ids)
+                targets.update(((ct_id, pk), (model, obj)) for pk, obj in objects.items())
+
+        return cls(nodes, targets)
+
+    def _condition_met(self, condition, facts):
+        """
+        :return: True or False if the condition's target is met (before inverting), None if the target doesn't exist
+        """
+        target = self.targets.get((condition.content_type_id, condition.object_id))
+        if target is None:
+            return None
+        model, value = target
+        if model is Prereq:
+            return self.prereq_met(condition.object_id, facts)
+        if model not in FACT_CONDITIONS:
+            return value.condition_met_as_prerequisite(facts.user, condition.count)
+        return FACT_CONDITIONS[model].met(facts, condition.object_id, value, condition.count)
+
+    def prereq_met(self, prereq_id, facts):
+        """
+        The in-memory equivalent of Prereq.condition_met(), memoized in the facts
+        :raises PrereqCycleError: if the conditions lead back to this Prereq
+        """
+        if prereq_id in facts.prereqs_met:
+            if facts.prereqs_met[prereq_id] is None:
+                raise PrereqCycleError('Prereq {} depends on itself'.format(prereq_id))
+            return facts.prereqs_met[prereq_id]
+        facts.prereqs_met[prereq_id] = None
+        facts.prereqs_met[prereq_id] = self._prereq_met(prereq_id, facts)
+        return facts.prereqs_met[prereq_id]
+
+    def _prereq_met(self, prereq_id, facts):
+        node = self.nodes[prereq_id]
+
+        main_condition_met = self._condition_met(node.main, facts)
+        if main_condition_met is None:
+            return False
+        if node.main.invert:
+            main_condition_met = not main_condition_met
+
+        if node.alternate is None:
+            return main_condition_met
+
+        or_condition_met = self._condition_met(node.alternate, facts)
+        if or_condition_met is None:
+            return False
+        if node.alternate.invert:
+            or_condition_met = not or_condition_met
+
+        return main_condition_met or or_condition_met
+
+    def all_conditions_met(self, content_type_id, object_id, facts, no_prereq_means=True):
+        """ The in-memory equivalent of PrereqManager.all_conditions_met() """
+        nodes = self.parents.get((content_type_id, object_id))
+        if not nodes:
+            return no_prereq_means
+        return all(self.prereq_met(node.id, facts) for node in nodes)
+
+    def get_conditions_met(self, model, object_ids, facts, no_prereq_means=True):
+        """
+        :return: a list of the ids (from object_ids) of objects of this model whose prerequisites have all been met
+        """
+        ct_id = ContentType.objects.get_for_model(model).id
+        return [pk for pk in object_ids if self.all_conditions_met(ct_id, pk, facts, no_prereq_means)]
+
+    def get_dependents(self, model, targets):
+        """
+        :param model: the model of the parent objects to look for
+        :param targets: (content_type_id, object_id) of the objects that changed.  An object_id of None stands for
+            every object of that content type.
+        :return: the set of ids of the objects of this model with a prerequisite that depends on any of the targets,
+            directly or through a chain of Prereqs.  Prerequisites on models outside of FACT_CONDITIONS always count.
+        """
+        keys = set(self.opaque_targets)
+        for content_type_id, object_id in targets:
+            if object_id is None:
+                keys.update(key for key in self.dependents if key[0] == content_type_id)
+            else:
+                keys.add((content_type_id, object_id))
+
+        model_ct_id = ContentType.objects.get_for_model(model).id
+        prereq_ct_id = ContentType.objects.get_for_model(Prereq).id
+        pending = [node_id for key in keys for node_id in self.dependents.get(key, ())]
+        visited = set()
+        dependent_ids = set()
+        while pending:
+            node_id = pending.pop()
+            if node_id in visited:
+                continue
+            visited.add(node_id)
+            parent_ct_id, parent_id = self.node_parents[node_id]
+            if parent_ct_id == model_ct_id:
+                dependent_ids.add(parent_id)
+            # Prereqs used as the prereq of other Prereqs
+            pending.extend(self.dependents.get((prereq_ct_id, node_id), ()))
+        return dependent_ids
+
+    # Set-based evaluation: the same logic as above, but for many users at once.
+    # Each condition costs a single aggregate query no matter how many users are being evaluated.
+
+    def _users_meeting_condition(self, condition, user_ids, memo):
+        """
+        :return: the set of ids from user_ids meeting the condition (before inverting), None if the target doesn't exist
+        """
+        target = self.targets.get((condition.content_type_id, condition.object_id))
+        if target is None:
+            return None
+        model, value = target
+        if model is Prereq:
+            return self.users_meeting_prereq(condition.object_id, user_ids, memo)
+        if model in FACT_CONDITIONS:
+            # only the field the condition depends on was loaded, which is all an unsaved stand-in of the target needs
+            value = model(**{'pk': condition.object_id, FACT_CONDITIONS[model].field: value})
+        return value.users_meeting_condition_as_prerequisite(user_ids, condition.count)
+
+    def users_meeting_prereq(self, prereq_id, user_ids, memo=None):
+        """
+        The set-based equivalent of prereq_met()
+        :param memo: (prereq id, frozenset of user ids) -> set of user ids, or None while being evaluated
+        :raises PrereqCycleError: if the conditions lead back to this Prereq
+        """
+        user_ids = frozenset(user_ids)
+        if memo is None:
+            memo = {}
+        key = (prereq_id, user_ids)
+        if key in memo:
+            if memo[key] is None:
+                raise PrereqCycleError('Prereq {} depends on itself'.format(prereq_id))
+            return set(memo[key])
+        memo[key] = None
+        memo[key] = self._users_meeting_prereq(prereq_id, user_ids, memo)
+        return set(memo[key])
+
+    def _users_meeting_prereq(self, prereq_id, user_ids, memo):
+        node = self.nodes[prereq_id]
+
+        main_users = self._users_meeting_condition(node.main, user_ids, memo)
+        if main_users is None:
+            return set()
+        if node.main.invert:
+            main_users = user_ids - main_users
+
+        if node.alternate is None:
+            return main_users
+
+        or_users = self._users_meeting_condition(node.alternate, user_ids, memo)
+        if or_users is None:
+            return set()
+        if node.alternate.invert:
+            or_users = user_ids - or_users
+
+        return main_users | or_users
+
+    def users_meeting_all_conditions(self, content_type_id, object_id, user_ids, no_prereq_means=True):
+        """
+        The set-based equivalent of all_conditions_met()
+        :param user_ids: the ids of the users to evaluate
+        :return: the set of ids from user_ids that have met all the prerequisites of the object
+        """
+        user_ids = set(user_ids)
+        nodes = self.parents.get((content_type_id, object_id))
+        if not nodes:
+            return user_ids if no_prereq_means else set()
+
+        qualifying_user_ids = user_ids
+        memo = {}
+        for node in nodes:
+            if not qualifying_user_ids:
+                break
+            qualifying_user_ids = qualifying_user_ids & self.users_meeting_prereq(node.id, qualifying_user_ids, memo)
+        return qualifying_user_ids
+
+
+def get_prereq_graph():
+    """
+    :return: the compiled PrereqGraph for the current tenant, recompiling it if it has been invalidated
+    """
+    # Read the version before compiling, so an invalidation during the compile forces another one next time
+    version = cache.get(GRAPH_VERSION_CACHE_KEY)
+    if version is None:
+        version = invalidate_prereq_graph()
+
+    compiled = _compiled_graphs.get(connection.schema_name)
+    if compiled is None or compiled[0] != version:
+        compiled = (version, PrereqGraph.compile())
+        _compiled_graphs[connection.schema_name] = compiled
+    return compiled[1]
+
+
+def invalidate_prereq_graph():
+    """ Force every process to recompile the current tenant's PrereqGraph the next time it is used. """
+    version = uuid.uuid4().hex
+    cache.set(GRAPH_VERSION_CACHE_KEY, version, None)
+    return version
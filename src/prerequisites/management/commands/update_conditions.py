@@ -1,11 +1,49 @@
 from django.core.management.base import BaseCommand
 
-from prerequisites.tasks import update_quest_conditions_all
+from prerequisites.tasks import (
+    get_quest_conditions_queue_depth, get_update_conditions_all_progress, run_update_conditions_all,
+    update_quest_conditions_all
+)
 
 
 class Command(BaseCommand):
     help = 'Update all conditons met'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--sync', action='store_true',
+                            help='Update in this process with a progress bar, instead of queueing celery tasks')
+        parser.add_argument('--resume', action='store_true',
+                            help='Resume the last update (e.g. after a worker restart) instead of starting a new one')
+        parser.add_argument('--status', action='store_true',
+                            help='Show the progress of the last update and the per user update queue depth, and exit')
+
     def handle(self, *args, **options):
-        self.stdout.write('Creating conditions met for all users...')
-        update_quest_conditions_all.apply_async(args=[1], queue='default')
+        if options['status']:
+            self.write_status()
+        elif options['sync']:
+            self.stdout.write('Updating conditions met for all users...')
+            progress = run_update_conditions_all(progress_callback=self.write_progress)
+            self.stdout.write('')
+            self.stdout.write(self.style.SUCCESS(
+                'Updated {num_users} users in {elapsed:.1f}s ({users_per_second:.1f} users/s)'.format(**progress)))
+        elif options['resume']:
+            self.stdout.write('Resuming conditions met update for all users...')
+            update_quest_conditions_all.apply_async(kwargs={'resume': True}, queue='default')
+        else:
+            self.stdout.write('Creating conditions met for all users...')
+            update_quest_conditions_all.apply_async(args=[1], queue='default')
+
+    def write_status(self):
+        progress = get_update_conditions_all_progress()
+        if progress is None:
+            self.stdout.write('No update of all users in the last day.')
+        else:
+            self.stdout.write('Last update of all users: {chunks_done}/{num_chunks} chunks, {users_done}/{num_users} users, '
+                              '{elapsed:.1f}s, {users_per_second:.1f} users/s'.format(**progress))
+        self.stdout.write('Users queued for an update: {}'.format(get_quest_conditions_queue_depth()))
+
+    def write_progress(self, progress, width=40):
+        done = int(width * progress['chunks_done'] / progress['num_chunks'])
+        self.stdout.write('\r[{}{}] {users_done}/{num_users} users, {elapsed:.1f}s, {users_per_second:.1f} users/s'.format(
+            '#' * done, '-' * (width - done), **progress), ending='')
+        self.stdout.flush()
@@ -0,0 +1,48 @@
+import json
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+def text_to_array(apps, schema_editor):
+    PrereqAllConditionsMet = apps.get_model("prerequisites", "PrereqAllConditionsMet")
+    for met_list in PrereqAllConditionsMet.objects.all():
+        met_list.ids_array = json.loads(met_list.ids) if met_list.ids else []
+        met_list.save(update_fields=['ids_array'])
+
+
+def array_to_text(apps, schema_editor):
+    PrereqAllConditionsMet = apps.get_model("prerequisites", "PrereqAllConditionsMet")
+    for met_list in PrereqAllConditionsMet.objects.all():
+        met_list.ids = str(met_list.ids_array)
+        met_list.save(update_fields=['ids'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('prerequisites', '0004_auto_20190702_0311'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='prereqallconditionsmet',
+            name='ids_array',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), blank=True, default=list, size=None),
+        ),
+        migrations.AlterField(
+            model_name='prereqallconditionsmet',
+            name='ids',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.RunPython(text_to_array, array_to_text),
+        migrations.RemoveField(
+            model_name='prereqallconditionsmet',
+            name='ids',
+        ),
+        migrations.RenameField(
+            model_name='prereqallconditionsmet',
+            old_name='ids_array',
+            new_name='ids',
+        ),
+    ]
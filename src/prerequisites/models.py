@@ -1,11 +1,39 @@
-import json
+from collections import defaultdict
+
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
+from django.contrib.postgres.fields import ArrayField
 from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.contrib.auth import get_user_model
 from django.db import models
+from django.db.models import Count, F, Func, Value
 from django.db.models.base import ObjectDoesNotExist
 
 
+# How many Prereqs deep a chain of Prereqs used as prerequisites of each other can go
+PREREQ_MAX_DEPTH = 10
+
+
+class PrereqCycleError(Exception):
+    """ The conditions of a Prereq lead back to itself, through Prereqs used as prerequisites """
+
+
+def users_with_at_least(queryset, num_required, user_ids):
+    """
+    A helper for users_meeting_condition_as_prerequisite() implementations
+    :param queryset: rows with a user_id, e.g. a user's approved submissions or badge assertions
+    :return: the set of ids from user_ids with at least num_required rows in the queryset
+    """
+    if num_required <= 0:
+        return set(user_ids)
+    return set(
+        queryset.filter(user_id__in=user_ids).order_by()
+        .values('user_id').annotate(num=Count('id')).filter(num__gte=num_required)
+        .values_list('user_id', flat=True)
+    )
+
+
 class HasPrereqsMixin:
     """ 
     For models that have prerequisites that determine their objects' availablity.
@@ -34,6 +62,18 @@ class IsAPrereqMixin:
         """
         raise NotImplementedError
 
+    def users_meeting_condition_as_prerequisite(self, user_ids, num_required=1):
+        """
+        The bulk version of condition_met_as_prerequisite(), for many users at once.  This default implementation loops
+        over condition_met_as_prerequisite(), implementing models should override it with a single aggregate query.
+        :param user_ids: ids of django users
+        :param num_required: as in condition_met_as_prerequisite()
+        :return: the set of ids (from user_ids) of the users that meet the requirements for this object as a
+            prerequisite
+        """
+        users = get_user_model().objects.filter(id__in=user_ids)
+        return {user.id for user in users if self.condition_met_as_prerequisite(user, num_required)}
+
     def is_used_prereq(self):
         """
         :return: True if this object has been assigned as a prerequisite to at least one another object.
@@ -52,7 +92,7 @@ class IsAPrereqMixin:
         """
         reliant_qs = self.get_reliant_qs()
         reliant_objects = []
-        for prereq in reliant_qs:
+        for prereq in reliant_qs.with_objects():
             parent_obj = prereq.parent()
             # Why would this be None?  It's happening in testing, perhaps deleted objects?
             if parent_obj is not None:
@@ -116,7 +156,41 @@ class IsAPrereqMixin:
 #         return self.filter(pk__in=pk_met_list)
 
 
+def prefetch_prereq_objects(prereqs):
+    """
+    Resolve the parent, prereq and or_prereq objects (and content types) of a batch of Prereqs, with one query per
+    content type, and cache them on the instances for parent(), get_prereq(), get_or_prereq() and __str__()
+    :param prereqs: an iterable of Prereqs
+    :return: a list of the Prereqs
+    """
+    prereqs = list(prereqs)
+    content_type_fields = [Prereq._meta.get_field(name) for name in PREREQ_CONTENT_TYPE_FIELDS]
+    ids_by_content_type = defaultdict(set)
+    for prereq in prereqs:
+        for content_type_id, object_id in prereq._generic_object_keys():
+            ids_by_content_type[content_type_id].add(object_id)
+        for field in content_type_fields:
+            content_type_id = getattr(prereq, field.attname)
+            if content_type_id is not None and not field.is_cached(prereq):
+                field.set_cached_value(prereq, ContentType.objects.get_for_id(content_type_id))
+
+    # (content_type_id, object_id) -> object, or None if it doesn't exist
+    objects = {}
+    for content_type_id, ids in ids_by_content_type.items():
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        found = model._base_manager.in_bulk(ids) if model is not None else {}
+        objects.update(((content_type_id, pk), found.get(pk)) for pk in ids)
+
+    for prereq in prereqs:
+        prereq._generic_objects_cache = objects
+    return prereqs
+
+
 class PrereqQuerySet(models.query.QuerySet):
+    def with_objects(self):
+        """ :return: a list of the Prereqs, with their generic objects resolved in bulk (see prefetch_prereq_objects) """
+        return prefetch_prereq_objects(self)
+
     def get_all_for_parent_object(self, parent_object):
         ct = ContentType.objects.get_for_model(parent_object)
         return self.filter(parent_content_type__pk=ct.id,
@@ -170,11 +244,28 @@ class PrereqManager(models.Manager):
         prereqs = self.all_parent(parent_object)
         if not prereqs:
             return no_prereq_means
+        memo = {}
         for prereq in prereqs:
-            if not prereq.condition_met(user):
+            if not prereq.condition_met(user, memo):
                 return False
         return True
 
+    def users_meeting_all_conditions(self, parent_object, user_ids, no_prereq_means=True):
+        """
+        The bulk version of all_conditions_met()
+        :return: the set of ids (from user_ids) of the users that have met all the prerequisites of the parent_object
+        """
+        user_ids = set(user_ids)
+        prereqs = self.all_parent(parent_object)
+        if not prereqs:
+            return user_ids if no_prereq_means else set()
+        memo = {}
+        for prereq in prereqs:
+            if not user_ids:
+                break
+            user_ids &= prereq.users_meeting_conditions(user_ids, memo)
+        return user_ids
+
     def is_prerequisite(self, prereq_obj):
         """
         :return: True if obj is a prerequisite to any other object
@@ -186,6 +277,9 @@ class PrereqManager(models.Manager):
         return False
 
 
+PREREQ_CONTENT_TYPE_FIELDS = ('parent_content_type', 'prereq_content_type', 'or_prereq_content_type')
+
+
 class Prereq(models.Model, IsAPrereqMixin):
     """
     A Prereq object indicates some conditions (prerequisites) that must be met before gaining access to something else.
@@ -279,35 +373,50 @@ class Prereq(models.Model, IsAPrereqMixin):
     # def autocomplete_search_fields():
     #     return ("name__icontains",)
 
-    def parent(self):
-        """:return the parent as its object"""
+    def _generic_object_keys(self):
+        """ :return: (content_type_id, object_id) of the parent, prereq and (if any) or_prereq objects """
+        keys = [(self.parent_content_type_id, self.parent_object_id), (self.prereq_content_type_id, self.prereq_object_id)]
+        if self.or_prereq_content_type_id and self.or_prereq_object_id:
+            keys.append((self.or_prereq_content_type_id, self.or_prereq_object_id))
+        return keys
+
+    def _get_generic_object(self, content_type, object_id):
+        # resolved in bulk by prefetch_prereq_objects()?
+        prefetched = getattr(self, '_generic_objects_cache', {})
+        key = (content_type.id, object_id)
+        if key in prefetched:
+            return prefetched[key]
         try:
-            return self.parent_content_type.get_object_for_this_type(pk=self.parent_object_id)
+            return content_type.get_object_for_this_type(pk=object_id)
         except ObjectDoesNotExist:
             return None
 
+    def parent(self):
+        """:return the parent as its object"""
+        return self._get_generic_object(self.parent_content_type, self.parent_object_id)
+
     def get_prereq(self):
         """:return the main prereq as its object"""
-        try:
-            return self.prereq_content_type.get_object_for_this_type(pk=self.prereq_object_id)
-        except ObjectDoesNotExist:
-            return None
+        return self._get_generic_object(self.prereq_content_type, self.prereq_object_id)
 
     def get_or_prereq(self):
         """:return the alternate prereq as its object"""
-        try:
-            return self.or_prereq_content_type.get_object_for_this_type(pk=self.or_prereq_object_id)
-        except ObjectDoesNotExist:
-            return None
+        return self._get_generic_object(self.or_prereq_content_type, self.or_prereq_object_id)
 
     # A Prereq can itself be a prereq_object
     def condition_met_as_prerequisite(self, user, num_required=1):
         return self.condition_met(user)
 
-    def condition_met(self, user):
+    def users_meeting_condition_as_prerequisite(self, user_ids, num_required=1):
+        return self.users_meeting_conditions(user_ids)
+
+    def condition_met(self, user, memo=None):
         """
         :param user:
+        :param memo: a dict shared by the evaluation of related Prereqs, so Prereqs used as prerequisites of several
+            others are only evaluated once.  (prereq id, user id) -> True/False, or None while being evaluated
         :return: True if the conditions for this complex Prereq have been met by the user
+        :raises PrereqCycleError: if the conditions lead back to this Prereq
 
         CONTINUE this simple example from Prereq:
         Imagine a quest that a student only gains access to if they are in a grade 10 course:
@@ -337,11 +446,23 @@ class Prereq(models.Model, IsAPrereqMixin):
         but the specific implementation can be found in courses.models.Grade.condition_met_as_prerequisite().
         """
 
+        if memo is None:
+            memo = {}
+        key = (self.id, user.id)
+        if key in memo:
+            if memo[key] is None:
+                raise PrereqCycleError('Prereq {} depends on itself'.format(self.id))
+            return memo[key]
+        memo[key] = None
+        memo[key] = self._condition_met(user, memo)
+        return memo[key]
+
+    def _condition_met(self, user, memo):
         # the first of two possible alternate prereq conditions
         prereq_object = self.get_prereq()
         if prereq_object is None:
             return False
-        main_condition_met = prereq_object.condition_met_as_prerequisite(user, self.prereq_count)
+        main_condition_met = self._object_condition_met(prereq_object, user, self.prereq_count, memo)
 
         # invert the requirement if needed (NOT)
         if self.prereq_invert:
@@ -354,7 +475,7 @@ class Prereq(models.Model, IsAPrereqMixin):
         or_prereq_object = self.get_or_prereq()
         if or_prereq_object is None:
             return False
-        or_condition_met = or_prereq_object.condition_met_as_prerequisite(user, self.or_prereq_count)
+        or_condition_met = self._object_condition_met(or_prereq_object, user, self.or_prereq_count, memo)
 
         # invert alternate if required (NOT OR)
         if self.or_prereq_invert:
@@ -362,6 +483,93 @@ class Prereq(models.Model, IsAPrereqMixin):
 
         return main_condition_met or or_condition_met
 
+    @staticmethod
+    def _object_condition_met(obj, user, num_required, memo):
+        if isinstance(obj, Prereq):
+            return obj.condition_met(user, memo)
+        return obj.condition_met_as_prerequisite(user, num_required)
+
+    def users_meeting_conditions(self, user_ids, memo=None):
+        """
+        The bulk version of condition_met(): one query per condition (more for Prereqs used as conditions), no matter
+        how many users.
+        :param memo: as in condition_met(), keyed by (prereq id, frozenset of user ids)
+        :return: the set of ids (from user_ids) of the users that have met the conditions of this Prereq
+        """
+        user_ids = frozenset(user_ids)
+        if memo is None:
+            memo = {}
+        key = (self.id, user_ids)
+        if key in memo:
+            if memo[key] is None:
+                raise PrereqCycleError('Prereq {} depends on itself'.format(self.id))
+            return memo[key]
+        memo[key] = None
+        memo[key] = self._users_meeting_conditions(user_ids, memo)
+        return set(memo[key])
+
+    def _users_meeting_conditions(self, user_ids, memo):
+        prereq_object = self.get_prereq()
+        if prereq_object is None:
+            return set()
+        main_users = self._object_users_meeting_condition(prereq_object, user_ids, self.prereq_count, memo)
+        if self.prereq_invert:
+            main_users = user_ids - main_users
+
+        if not self.or_prereq_object_id or not self.or_prereq_content_type:
+            return main_users
+
+        or_prereq_object = self.get_or_prereq()
+        if or_prereq_object is None:
+            return set()
+        or_users = self._object_users_meeting_condition(or_prereq_object, user_ids, self.or_prereq_count, memo)
+        if self.or_prereq_invert:
+            or_users = user_ids - or_users
+
+        return main_users | or_users
+
+    @staticmethod
+    def _object_users_meeting_condition(obj, user_ids, num_required, memo):
+        if isinstance(obj, Prereq):
+            return obj.users_meeting_conditions(user_ids, memo)
+        return obj.users_meeting_condition_as_prerequisite(user_ids, num_required)
+
+    def get_depth(self, chain=()):
+        """
+        :param chain: the Prereqs this one is (directly or not) a prerequisite of, when following a chain
+        :return: how many Prereqs deep the conditions of this Prereq go: 1 if none of them is a Prereq
+        :raises PrereqCycleError: if the conditions lead back to this Prereq, or to one in the chain
+        """
+        chain = chain + (self,)
+        prereq_ct = ContentType.objects.get_for_model(Prereq)
+        conditions = [(self.prereq_content_type_id, self.prereq_object_id)]
+        if self.or_prereq_content_type_id and self.or_prereq_object_id:
+            conditions.append((self.or_prereq_content_type_id, self.or_prereq_object_id))
+
+        depth = 1
+        for content_type_id, object_id in conditions:
+            if content_type_id != prereq_ct.id:
+                continue
+            if object_id in [prereq.id for prereq in chain]:
+                path = [prereq.id for prereq in chain] + [object_id]
+                raise PrereqCycleError('Prereq cycle: {}'.format(' -> '.join(map(str, path))))
+            prereq = Prereq.objects.filter(pk=object_id).first()
+            if prereq is not None:
+                depth = max(depth, 1 + prereq.get_depth(chain))
+        return depth
+
+    def clean(self):
+        """ Reject Prereqs whose conditions would lead back to themselves, or go more than PREREQ_MAX_DEPTH deep """
+        super().clean()
+        try:
+            depth = self.get_depth()
+        except PrereqCycleError as e:
+            raise ValidationError('The conditions of this prerequisite lead back to itself. {}'.format(e))
+        if depth > PREREQ_MAX_DEPTH:
+            raise ValidationError(
+                'The conditions of this prerequisite are nested {} Prereqs deep, the maximum is {}.'.format(
+                    depth, PREREQ_MAX_DEPTH))
+
     @classmethod
     def add_simple_prereq(cls, parent_object, prereq_object):
         """
@@ -393,9 +601,12 @@ class Prereq(models.Model, IsAPrereqMixin):
 
     @staticmethod
     def model_is_registered(content_type):
+        return Prereq.model_class_is_registered(content_type.model_class())
+
+    @staticmethod
+    def model_class_is_registered(mc):
         # Check if class has the method `condition_met_as_prerequisite`
         # http://stackoverflow.com/questions/25295327/how-to-check-if-a-python-class-has-particular-method-or-not
-        mc = content_type.model_class()
 
         # deleted models?
         if mc is None:
@@ -407,21 +618,40 @@ class Prereq(models.Model, IsAPrereqMixin):
         return False
 
 
+class PrereqAllConditionsMetQuerySet(models.query.QuerySet):
+    """ add_id() and remove_id() are done in a single UPDATE, so concurrent updates of the same rows can't be lost """
+
+    def add_id(self, new_id):
+        return self.exclude(ids__contains=[new_id]).update(ids=Func(F('ids'), Value(new_id), function='array_append'))
+
+    def remove_id(self, old_id):
+        return self.filter(ids__contains=[old_id]).update(ids=Func(F('ids'), Value(old_id), function='array_remove'))
+
+    def met_ids(self):
+        """
+        :return: a queryset of the met ids, one per row, to use as a subquery: e.g. `pk__in=met_lists.met_ids()`
+        """
+        return self.annotate(met_id=Func(F('ids'), function='unnest', output_field=models.IntegerField())).values('met_id')
+
+
 class PrereqAllConditionsMet(models.Model):
-    """ I think these are a list of prereq objects used for caching?
+    """ A cache of the ids of the objects (of model_name) whose prerequisite conditions have all been met by the user.
     """
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
-    ids = models.TextField()  # ids of what?!?  Prerequisites?
+    ids = ArrayField(models.IntegerField(), default=list, blank=True)
     model_name = models.CharField(max_length=256)
 
+    objects = PrereqAllConditionsMetQuerySet.as_manager()
+
     def add_id(self, new_id):
-        ids = self.get_ids([])
-        if new_id not in ids:
-            ids.append(new_id)
-            self.ids = str(ids)
-            self.save()
+        PrereqAllConditionsMet.objects.filter(pk=self.pk).add_id(new_id)
+        self.refresh_from_db(fields=['ids'])
+
+    def remove_id(self, old_id):
+        PrereqAllConditionsMet.objects.filter(pk=self.pk).remove_id(old_id)
+        self.refresh_from_db(fields=['ids'])
 
     def get_ids(self, default=None):
-        if self.ids:
-            return json.loads(self.ids)
-        return default
+        if self.ids is None:
+            return default
+        return list(self.ids)
@@ -1,15 +1,19 @@
 import logging
+import time
 import traceback
+import uuid
 
 from django.core.cache import cache
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
 from django.db import transaction
 from django.db.utils import OperationalError
 from celery import shared_task, Task
 
-from quest_manager.models import Quest
-from prerequisites.models import Prereq, PrereqAllConditionsMet
+from quest_manager.models import Quest, invalidate_available_quests
+from prerequisites.graph import UserFacts, get_prereq_graph
+from prerequisites.models import PrereqAllConditionsMet
 
 
 logger = logging.getLogger(__name__)
@@ -33,55 +37,268 @@ class TransactionAwareTask(Task):
             logger.error(traceback.format_exc())
 
 
+# Coalescing of update_quest_conditions_for_user: while a task is scheduled for a user, more requests for the same user
+# don't queue another one.  Cache keys are already per tenant (tenant_schemas.cache.make_key)
+USER_CONDITIONS_SCHEDULED_CACHE_KEY = 'update_quest_conditions_for_user_scheduled_{}'
+USER_CONDITIONS_FULL_CACHE_KEY = 'update_quest_conditions_for_user_full_{}'
+USER_CONDITIONS_QUEUE_DEPTH_CACHE_KEY = 'update_quest_conditions_for_user_queue_depth'
+
+
+def get_quest_conditions_queue_depth():
+    """ :return: the number of coalesced update_quest_conditions_for_user tasks scheduled but not started yet """
+    return cache.get(USER_CONDITIONS_QUEUE_DEPTH_CACHE_KEY, 0)
+
+
+def schedule_quest_conditions_for_user(user_id, targets=None):
+    """
+    Once the current transaction is committed, schedule update_quest_conditions_for_user after a short debounce
+    (CONDITIONS_UPDATE_USER_COUNTDOWN), unless one is already scheduled for this user.  In that case the scheduled one
+    is told to re-evaluate every quest, since it can't be given the extra targets.
+    """
+    # Not before the commit: a rolled back transaction would leave the user marked as scheduled without a task
+    transaction.on_commit(lambda: _schedule_quest_conditions_for_user(user_id, targets))
+
+
+def _schedule_quest_conditions_for_user(user_id, targets):
+    countdown = settings.CONDITIONS_UPDATE_USER_COUNTDOWN
+    # Expires on its own in case the task is lost
+    timeout = countdown * 10
+    scheduled_key = USER_CONDITIONS_SCHEDULED_CACHE_KEY.format(user_id)
+
+    if not cache.add(scheduled_key, True, timeout):
+        cache.set(USER_CONDITIONS_FULL_CACHE_KEY.format(user_id), True, timeout)
+        # The scheduled task may have started before it could see the flag
+        if not cache.add(scheduled_key, True, timeout):
+            return
+        targets = None
+
+    cache.add(USER_CONDITIONS_QUEUE_DEPTH_CACHE_KEY, 0, None)
+    queue_depth = cache.incr(USER_CONDITIONS_QUEUE_DEPTH_CACHE_KEY)
+    logger.debug('update_quest_conditions_for_user queue depth: {}'.format(queue_depth))
+    update_quest_conditions_for_user.apply_async(
+        args=[user_id], kwargs={'targets': targets, 'coalesced': True}, queue='default', countdown=countdown)
+
+
 @shared_task(base=TransactionAwareTask, bind=True, name='update_quest_conditions_for_user', max_retries=settings.CELERY_TASK_MAX_RETRIES) # noqa
-def update_quest_conditions_for_user(self, user_id):
+def update_quest_conditions_for_user(self, user_id, targets=None, coalesced=False):
+    """
+    :param targets: (content_type_id, object_id) of the objects that changed for this user, see
+        prerequisites.graph.get_changed_targets().  If given, and the user's PrereqAllConditionsMet already exists, only
+        the quests that depend on them are re-evaluated.  Otherwise every quest is.
+    :param coalesced: True if scheduled by schedule_quest_conditions_for_user()
+    """
+    if coalesced:
+        # From now on, new requests need a task of their own
+        cache.delete(USER_CONDITIONS_SCHEDULED_CACHE_KEY.format(user_id))
+        if cache.get(USER_CONDITIONS_FULL_CACHE_KEY.format(user_id)):
+            cache.delete(USER_CONDITIONS_FULL_CACHE_KEY.format(user_id))
+            targets = None
+        try:
+            cache.decr(USER_CONDITIONS_QUEUE_DEPTH_CACHE_KEY)
+        except ValueError:  # expired or evicted
+            pass
+
     user = User.objects.filter(id=user_id).first()
     if not user:
         return
-    pk_met_list = [obj.pk for obj in Quest.objects.all() if Prereq.objects.all_conditions_met(obj, user)]
+    graph = get_prereq_graph()
+    facts = UserFacts(user)
+
+    if targets is not None:
+        with transaction.atomic():
+            met_list = PrereqAllConditionsMet.objects.select_for_update().filter(
+                user=user, model_name=Quest.get_model_name()).first()
+            if met_list:
+                quest_ids = graph.get_dependents(Quest, targets)
+                quest_ids_met = graph.get_conditions_met(
+                    Quest, Quest.objects.filter(pk__in=quest_ids).values_list('pk', flat=True), facts)
+                ids = met_list.get_ids([])
+                new_ids = [pk for pk in ids if pk not in quest_ids] + quest_ids_met
+                if new_ids != ids:
+                    met_list.ids = new_ids
+                    met_list.save(update_fields=['ids'])
+                return met_list.id
+
+    pk_met_list = graph.get_conditions_met(Quest, Quest.objects.values_list('pk', flat=True), facts)
     met_list, created = PrereqAllConditionsMet.objects.update_or_create(
-        user=user, model_name=Quest.get_model_name(), defaults={'ids': str(pk_met_list)})
+        user=user, model_name=Quest.get_model_name(), defaults={'ids': pk_met_list})
     return met_list.id
 
 
 @shared_task(base=TransactionAwareTask, bind=True, name='update_conditions_for_quest', max_retries=settings.CELERY_TASK_MAX_RETRIES) # noqa
-def update_conditions_for_quest(self, quest_id, start_from_user_id):
+def update_conditions_for_quest(self, quest_id, start_from_user_id=None):
+    """
+    Add or remove the quest from every user's PrereqAllConditionsMet, depending on whether they now meet its conditions.
+    Users without a PrereqAllConditionsMet are skipped, it is built in full the first time it's needed.
+    :param start_from_user_id: unused, all users are updated at once.  Kept for tasks queued before that was the case.
+    """
     quest = Quest.objects.filter(id=quest_id).first()
     if not quest:
         return
 
-    users = User.objects.filter(id__gte=start_from_user_id)[:settings.CELERY_TASKS_BUNCH_SIZE]
-    for user in users:
-        if not Prereq.objects.all_conditions_met(quest, user):
-            return
+    met_lists = PrereqAllConditionsMet.objects.filter(model_name=Quest.get_model_name())
+    quest_ct_id = ContentType.objects.get_for_model(Quest).id
+    qualifying_user_ids = get_prereq_graph().users_meeting_all_conditions(
+        quest_ct_id, quest.id, met_lists.values_list('user_id', flat=True)
+    )
 
-        filter_kwargs = {'user': user, 'model_name': Quest.get_model_name()}
-        met_list = PrereqAllConditionsMet.objects.filter(**filter_kwargs).first()
-        if met_list:
-            met_list.add_id(quest.id)
-        else:
-            met_list = PrereqAllConditionsMet.objects.create(ids=[quest.id], **filter_kwargs)
-    else:
-        user_id = user.id + 1
-        user = User.objects.filter(id__gte=user_id).values('id').first()
-        if user:
-            self.apply_async(
-                kwargs={'quest_id': quest.id, 'start_from_user_id': user_id},
-                queue='default', countdown=20
-            )
+    with transaction.atomic():
+        to_add = met_lists.filter(user_id__in=qualifying_user_ids).exclude(ids__contains=[quest.id])
+        to_remove = met_lists.exclude(user_id__in=qualifying_user_ids).filter(ids__contains=[quest.id])
+        # locked until the updates are done, so these are the users whose met lists change
+        changed_user_ids = list(to_add.select_for_update().values_list('user_id', flat=True)) + \
+            list(to_remove.select_for_update().values_list('user_id', flat=True))
+        to_add.add_id(quest.id)
+        to_remove.remove_id(quest.id)
+    # bulk updates don't send PrereqAllConditionsMet's post_save, which invalidates each user's available quests
+    for user_id in changed_user_ids:
+        invalidate_available_quests(user_id)
 
 
-@shared_task(base=TransactionAwareTask, bind=True, name='update_quest_conditions_all', max_retries=settings.CELERY_TASK_MAX_RETRIES) # noqa
-def update_quest_conditions_all(self, start_from_user_id):
-    if start_from_user_id == 1 and cache.get('update_conditions_all_task_waiting'):
+# update_quest_conditions_all jobs.  The job (its id, start time and chunks of users) and its progress are kept in the
+# (per tenant) cache, so a job can be resumed after a worker restart.
+UPDATE_ALL_JOB_CACHE_KEY = 'update_conditions_all_job'
+UPDATE_ALL_NEXT_CHUNK_CACHE_KEY = 'update_conditions_all_next_chunk_{}'
+UPDATE_ALL_CHUNKS_DONE_CACHE_KEY = 'update_conditions_all_chunks_done_{}'
+UPDATE_ALL_CHUNK_DONE_CACHE_KEY = 'update_conditions_all_chunk_done_{}_{}'
+UPDATE_ALL_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def start_update_conditions_all_job():
+    """ Split all the users into chunks of CONDITIONS_UPDATE_CHUNK_SIZE, replacing any previous job """
+    user_ids = list(User.objects.order_by('id').values_list('id', flat=True))
+    size = settings.CONDITIONS_UPDATE_CHUNK_SIZE
+    job = {
+        'id': uuid.uuid4().hex,
+        'started': time.time(),
+        'finished': None,
+        'num_users': len(user_ids),
+        # (first user id, last user id) of each chunk
+        'chunks': [(user_ids[i], user_ids[min(i + size, len(user_ids)) - 1]) for i in range(0, len(user_ids), size)],
+    }
+    cache.set(UPDATE_ALL_NEXT_CHUNK_CACHE_KEY.format(job['id']), 0, UPDATE_ALL_CACHE_TIMEOUT)
+    cache.set(UPDATE_ALL_CHUNKS_DONE_CACHE_KEY.format(job['id']), 0, UPDATE_ALL_CACHE_TIMEOUT)
+    cache.set(UPDATE_ALL_JOB_CACHE_KEY, job, UPDATE_ALL_CACHE_TIMEOUT)
+    return job
+
+
+def claim_update_conditions_chunk(job):
+    """ :return: the index of the next chunk of the job that nobody has started yet, None if there are none left """
+    try:
+        index = cache.incr(UPDATE_ALL_NEXT_CHUNK_CACHE_KEY.format(job['id'])) - 1
+    except ValueError:  # expired or evicted
+        return None
+    return index if index < len(job['chunks']) else None
+
+
+def get_unfinished_update_conditions_chunks(job):
+    """ :return: the indexes of the chunks of the job that were started but aren't done """
+    num_started = min(cache.get(UPDATE_ALL_NEXT_CHUNK_CACHE_KEY.format(job['id']), 0), len(job['chunks']))
+    keys = [UPDATE_ALL_CHUNK_DONE_CACHE_KEY.format(job['id'], index) for index in range(num_started)]
+    done = cache.get_many(keys)
+    return [index for index, key in enumerate(keys) if key not in done]
+
+
+def update_conditions_for_chunk(job, index):
+    """ Update the conditions met of every user in the chunk, then record it as done """
+    first_id, last_id = job['chunks'][index]
+    for user_id in User.objects.filter(id__gte=first_id, id__lte=last_id).values_list('id', flat=True):
+        update_quest_conditions_for_user(user_id)
+
+    # A resumed chunk can also be run by its original task, if that one was still alive: only count it once
+    if not cache.add(UPDATE_ALL_CHUNK_DONE_CACHE_KEY.format(job['id'], index), True, UPDATE_ALL_CACHE_TIMEOUT):
         return
+    if cache.incr(UPDATE_ALL_CHUNKS_DONE_CACHE_KEY.format(job['id'])) == len(job['chunks']):
+        job['finished'] = time.time()
+        if cache.get(UPDATE_ALL_JOB_CACHE_KEY, {}).get('id') == job['id']:
+            cache.set(UPDATE_ALL_JOB_CACHE_KEY, job, UPDATE_ALL_CACHE_TIMEOUT)
+        progress = get_update_conditions_all_progress(job)
+        logger.info('update_quest_conditions_all: {num_users} users in {elapsed:.1f}s ({users_per_second:.1f} users/s)'
+                    .format(**progress))
+
+
+def get_update_conditions_all_progress(job=None):
+    """
+    :param job: defaults to the current (or last) job
+    :return: a dict with the job's num_users, num_chunks, chunks_done, users_done (an estimate), elapsed time in
+        seconds and users_per_second.  None if there is no job.
+    """
+    job = job or cache.get(UPDATE_ALL_JOB_CACHE_KEY)
+    if job is None:
+        return None
+    num_chunks = len(job['chunks'])
+    chunks_done = cache.get(UPDATE_ALL_CHUNKS_DONE_CACHE_KEY.format(job['id']), 0)
+    users_done = job['num_users'] if chunks_done >= num_chunks else chunks_done * settings.CONDITIONS_UPDATE_CHUNK_SIZE
+    elapsed = (job['finished'] or time.time()) - job['started']
+    return {
+        'num_users': job['num_users'],
+        'num_chunks': num_chunks,
+        'chunks_done': chunks_done,
+        'users_done': users_done,
+        'elapsed': elapsed,
+        'users_per_second': users_done / elapsed if elapsed else 0,
+    }
+
 
-        cache.set('update_conditions_all_task_waiting', True, settings.CONDITIONS_UPDATE_COUNTDOWN)
+def run_update_conditions_all(progress_callback=None):
+    """
+    Run a whole update_quest_conditions_all job in this process, one chunk after the other.
+    :param progress_callback: called with get_update_conditions_all_progress() after each chunk
+    :return: the job's final progress
+    """
+    job = start_update_conditions_all_job()
+    index = claim_update_conditions_chunk(job)
+    while index is not None:
+        update_conditions_for_chunk(job, index)
+        if progress_callback:
+            progress_callback(get_update_conditions_all_progress(job))
+        index = claim_update_conditions_chunk(job)
+    return get_update_conditions_all_progress(job)
 
-    users = list(User.objects.filter(id__gte=start_from_user_id).values_list('id', flat=True)[:settings.CELERY_TASKS_BUNCH_SIZE]) # noqa
-    for uid in users:
-        update_quest_conditions_for_user.apply_async(args=[uid], queue='default')
 
-    if users:
-        user = User.objects.filter(id__gte=users[-1] + 1).values('id').first()
-        user and self.apply_async(args=[user['id']], queue='default', countdown=100)
+@shared_task(base=TransactionAwareTask, bind=True, name='update_quest_conditions_all', max_retries=settings.CELERY_TASK_MAX_RETRIES) # noqa
+def update_quest_conditions_all(self, start_from_user_id=1, resume=False):
+    """
+    Update the conditions met of every user, CONDITIONS_UPDATE_CHUNK_SIZE users at a time, by up to
+    CONDITIONS_UPDATE_CONCURRENCY update_quest_conditions_chunk tasks in parallel.
+    :param start_from_user_id: anything but 1 comes from a task queued by an earlier version, and resumes
+    :param resume: continue the current job, starting over the chunks that were started but never finished (e.g. after
+        a worker restart), instead of starting a new one
+    """
+    resume = resume or start_from_user_id != 1
+    job = cache.get(UPDATE_ALL_JOB_CACHE_KEY) if resume else None
+    if job is not None:
+        chunk_indexes = get_unfinished_update_conditions_chunks(job)
+    else:
+        # Any other job queued less than CONDITIONS_UPDATE_COUNTDOWN ago (see signals) was for changes made before now
+        if not resume and not cache.add('update_conditions_all_task_waiting', True, settings.CONDITIONS_UPDATE_COUNTDOWN):
+            return
+        job = start_update_conditions_all_job()
+        chunk_indexes = []
+
+    # None: the task claims the next chunk nobody has started yet.  The tasks resuming a chunk claim more once they're
+    # done, so they count towards the concurrency too
+    chunk_indexes += [None] * max(settings.CONDITIONS_UPDATE_CONCURRENCY - len(chunk_indexes), 0)
+    for index in chunk_indexes:
+        update_quest_conditions_chunk.apply_async(args=[job['id'], index], queue='default')
+
+
+@shared_task(base=TransactionAwareTask, bind=True, name='update_quest_conditions_chunk', max_retries=settings.CELERY_TASK_MAX_RETRIES) # noqa
+def update_quest_conditions_chunk(self, job_id, chunk_index=None):
+    """
+    Update a chunk of an update_quest_conditions_all job, then queue itself again for the next one that is unclaimed.
+    :param chunk_index: the chunk to update, by default the next unclaimed one
+    """
+    job = cache.get(UPDATE_ALL_JOB_CACHE_KEY)
+    if job is None or job['id'] != job_id:  # expired, or replaced by a newer job
+        return
+    if chunk_index is not None and cache.get(UPDATE_ALL_CHUNK_DONE_CACHE_KEY.format(job_id, chunk_index)):
+        # resumed, but its original task finished it in the meantime
+        chunk_index = None
+    if chunk_index is None:
+        chunk_index = claim_update_conditions_chunk(job)
+        if chunk_index is None:
+            return
+
+    update_conditions_for_chunk(job, chunk_index)
+    self.apply_async(args=[job_id], queue='default')
@@ -0,0 +1,194 @@
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from freezegun import freeze_time
+from model_mommy import mommy
+from tenant_schemas.test.cases import TenantTestCase
+
+from badges.models import Badge, BadgeAssertion
+from courses.models import Course, CourseStudent, Grade, Rank, Semester
+from prerequisites.graph import UserFacts, get_prereq_graph
+from prerequisites.models import Prereq, PrereqAllConditionsMet
+from prerequisites.tasks import update_quest_conditions_for_user
+from quest_manager.models import Quest, QuestSubmission
+from siteconfig.models import SiteConfig
+
+User = get_user_model()
+
+
+def make_prereq(parent, prereq, or_prereq=None, **kwargs):
+    if or_prereq is not None:
+        kwargs['or_prereq_content_type'] = ContentType.objects.get_for_model(or_prereq)
+        kwargs['or_prereq_object_id'] = or_prereq.id
+    return Prereq.objects.create(
+        parent_content_type=ContentType.objects.get_for_model(parent),
+        parent_object_id=parent.id,
+        prereq_content_type=ContentType.objects.get_for_model(prereq),
+        prereq_object_id=prereq.id,
+        **kwargs
+    )
+
+
+@freeze_time('2018-10-12 00:54:00', tz_offset=0)
+class PrereqGraphTest(TenantTestCase):
+
+    def setUp(self):
+        self.student = mommy.make(User, username='student', is_staff=False)
+        self.semester = mommy.make(Semester)
+        SiteConfig.get().set_active_semester(self.semester)
+
+        self.quest = mommy.make(Quest, name='Quest')
+        self.badge = mommy.make(Badge, name='Badge')
+        self.rank = mommy.make(Rank, name='Rank', xp=100)
+        self.grade = mommy.make(Grade, name='Grade 10', value=10)
+        self.course = mommy.make(Course, title='Course')
+
+        self.quest_requires_quest = mommy.make(Quest, name='Requires Quest')
+        make_prereq(self.quest_requires_quest, self.quest)
+        self.quest_requires_quest_x2 = mommy.make(Quest, name='Requires Quest x2')
+        make_prereq(self.quest_requires_quest_x2, self.quest, prereq_count=2)
+        self.quest_requires_not_badge = mommy.make(Quest, name='Requires NOT Badge')
+        make_prereq(self.quest_requires_not_badge, self.badge, prereq_invert=True)
+        self.quest_requires_rank_or_course = mommy.make(Quest, name='Requires Rank OR Course')
+        make_prereq(self.quest_requires_rank_or_course, self.rank, self.course)
+        self.quest_requires_grade_and_badge = mommy.make(Quest, name='Requires Grade AND Badge')
+        make_prereq(self.quest_requires_grade_and_badge, self.grade)
+        make_prereq(self.quest_requires_grade_and_badge, self.badge)
+
+        # A named Prereq used as a prereq itself
+        named_prereq = make_prereq(self.quest, self.badge, self.rank, name='Badge OR Rank')
+        self.quest_requires_named_prereq = mommy.make(Quest, name='Requires named Prereq')
+        make_prereq(self.quest_requires_named_prereq, named_prereq)
+
+        self.quest_requires_deleted_quest = mommy.make(Quest, name='Requires deleted Quest')
+        deleted_quest = mommy.make(Quest)
+        make_prereq(self.quest_requires_deleted_quest, deleted_quest, or_prereq_invert=True)
+        deleted_quest.delete()
+
+    def assert_matches_orm(self):
+        """ The graph should give the same answer as PrereqManager.all_conditions_met for every quest """
+        graph = get_prereq_graph()
+        facts = UserFacts(self.student)
+        quest_ct_id = ContentType.objects.get_for_model(Quest).id
+        for quest in Quest.objects.all():
+            self.assertEqual(
+                graph.all_conditions_met(quest_ct_id, quest.id, facts),
+                Prereq.objects.all_conditions_met(quest, self.student),
+                quest.name
+            )
+
+    def test_graph_matches_orm_without_any_conditions_met(self):
+        self.assert_matches_orm()
+
+    def test_graph_matches_orm_with_conditions_met(self):
+        mommy.make(QuestSubmission, user=self.student, quest=self.quest, semester=self.semester, is_approved=True)
+        mommy.make(BadgeAssertion, user=self.student, badge=self.badge, semester=self.semester)
+        mommy.make(CourseStudent, user=self.student, course=self.course, grade_fk=self.grade, semester=self.semester)
+        self.assert_matches_orm()
+
+        self.student.profile.refresh_from_db()
+        self.student.profile.xp_cached = 100
+        self.student.profile.save()
+        mommy.make(QuestSubmission, user=self.student, quest=self.quest, semester=self.semester, is_approved=True)
+        self.assert_matches_orm()
+
+    def test_users_meeting_all_conditions_matches_orm(self):
+        """ The set-based evaluation should agree with the ORM for every user and every quest """
+        students = [self.student] + mommy.make(User, is_staff=False, _quantity=3)
+        mommy.make(QuestSubmission, user=students[0], quest=self.quest, semester=self.semester, is_approved=True)
+        mommy.make(QuestSubmission, user=students[1], quest=self.quest, semester=self.semester, is_approved=True,
+                   _quantity=2)
+        mommy.make(BadgeAssertion, user=students[1], badge=self.badge, semester=self.semester)
+        mommy.make(CourseStudent, user=students[2], course=self.course, grade_fk=self.grade, semester=self.semester)
+        mommy.make(BadgeAssertion, user=students[2], badge=self.badge, semester=self.semester)
+        students[3].profile.xp_cached = 200
+        students[3].profile.save()
+
+        graph = get_prereq_graph()
+        quest_ct_id = ContentType.objects.get_for_model(Quest).id
+        user_ids = [student.id for student in students]
+        for quest in Quest.objects.all():
+            expected = {
+                student.id for student in User.objects.filter(id__in=user_ids)
+                if Prereq.objects.all_conditions_met(quest, student)
+            }
+            self.assertSetEqual(graph.users_meeting_all_conditions(quest_ct_id, quest.id, user_ids), expected,
+                                quest.name)
+
+    def test_bulk_condition_protocol_matches_single_user(self):
+        """ users_meeting_condition_as_prerequisite() should agree with condition_met_as_prerequisite() """
+        students = [self.student] + mommy.make(User, is_staff=False, _quantity=2)
+        mommy.make(QuestSubmission, user=students[0], quest=self.quest, semester=self.semester, is_approved=True,
+                   _quantity=2)
+        mommy.make(QuestSubmission, user=students[1], quest=self.quest, semester=self.semester, is_approved=True)
+        mommy.make(BadgeAssertion, user=students[1], badge=self.badge, semester=self.semester)
+        mommy.make(CourseStudent, user=students[2], course=self.course, grade_fk=self.grade, semester=self.semester)
+        students[2].profile.xp_cached = 100
+        students[2].profile.save()
+        students = User.objects.filter(id__in=[student.id for student in students])
+        user_ids = [student.id for student in students]
+
+        for obj in [self.quest, self.badge, self.rank, self.grade, self.course] + list(Prereq.objects.all()):
+            for num_required in (1, 2):
+                self.assertSetEqual(
+                    obj.users_meeting_condition_as_prerequisite(user_ids, num_required),
+                    {student.id for student in students if obj.condition_met_as_prerequisite(student, num_required)},
+                    '{} x{}'.format(obj, num_required)
+                )
+
+        for quest in Quest.objects.all():
+            self.assertSetEqual(
+                Prereq.objects.users_meeting_all_conditions(quest, user_ids),
+                {student.id for student in students if Prereq.objects.all_conditions_met(quest, student)},
+                quest.name
+            )
+
+    def test_get_dependents(self):
+        graph = get_prereq_graph()
+        quest_ct_id = ContentType.objects.get_for_model(Quest).id
+        badge_ct_id = ContentType.objects.get_for_model(Badge).id
+        grade_ct_id = ContentType.objects.get_for_model(Grade).id
+
+        self.assertSetEqual(
+            graph.get_dependents(Quest, [(quest_ct_id, self.quest.id)]),
+            {self.quest_requires_quest.id, self.quest_requires_quest_x2.id}
+        )
+        # through the named Prereq, which is itself a prereq of another quest
+        self.assertSetEqual(
+            graph.get_dependents(Quest, [(badge_ct_id, self.badge.id)]),
+            {self.quest_requires_not_badge.id, self.quest_requires_grade_and_badge.id, self.quest.id,
+             self.quest_requires_named_prereq.id}
+        )
+        self.assertSetEqual(
+            graph.get_dependents(Quest, [(grade_ct_id, None)]), {self.quest_requires_grade_and_badge.id}
+        )
+        self.assertSetEqual(graph.get_dependents(Quest, [(quest_ct_id, self.quest_requires_quest.id)]), set())
+
+    def test_graph_is_recompiled_when_a_prereq_changes(self):
+        graph = get_prereq_graph()
+        self.assertIs(get_prereq_graph(), graph)
+
+        make_prereq(self.quest_requires_quest, self.badge)
+        self.assertIsNot(get_prereq_graph(), graph)
+        self.assert_matches_orm()
+
+    def test_update_quest_conditions_for_user_uses_a_constant_number_of_queries(self):
+        def count_queries():
+            with CaptureQueriesContext(connection) as context:
+                update_quest_conditions_for_user(self.student.id)
+            return len(context.captured_queries)
+
+        # compile the graph and create the user's PrereqAllConditionsMet first
+        update_quest_conditions_for_user(self.student.id)
+        num_queries = count_queries()
+
+        for _ in range(5):
+            make_prereq(mommy.make(Quest), self.quest)
+        get_prereq_graph()
+        self.assertEqual(count_queries(), num_queries)
+
+        met_ids = PrereqAllConditionsMet.objects.get(user=self.student).get_ids()
+        self.assertIn(self.quest_requires_not_badge.id, met_ids)
+        self.assertNotIn(self.quest_requires_quest.id, met_ids)
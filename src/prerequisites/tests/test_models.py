@@ -0,0 +1,154 @@
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+
+from mock import patch
+from model_mommy import mommy
+from tenant_schemas.test.cases import TenantTestCase
+
+from badges.models import Badge
+from prerequisites.admin import depth
+from prerequisites.graph import UserFacts, get_prereq_graph
+from prerequisites.models import Prereq, PrereqAllConditionsMet, PrereqCycleError
+from quest_manager.models import Quest
+
+User = get_user_model()
+
+
+class PrereqAllConditionsMetTestModel(TenantTestCase):
+
+    def setUp(self):
+        self.student = mommy.make(User, is_staff=False)
+        self.met_list = PrereqAllConditionsMet.objects.create(
+            user=self.student, model_name=Quest.get_model_name(), ids=[1, 2])
+
+    def test_add_id(self):
+        self.met_list.add_id(3)
+        self.assertEqual(self.met_list.get_ids(), [1, 2, 3])
+        # no duplicates
+        self.met_list.add_id(3)
+        self.assertEqual(self.met_list.get_ids(), [1, 2, 3])
+
+    def test_remove_id(self):
+        self.met_list.remove_id(1)
+        self.assertEqual(self.met_list.get_ids(), [2])
+        self.met_list.remove_id(1)
+        self.assertEqual(self.met_list.get_ids(), [2])
+
+    def test_queryset_add_and_remove_id(self):
+        other_met_list = PrereqAllConditionsMet.objects.create(
+            user=mommy.make(User), model_name=Quest.get_model_name(), ids=[2])
+
+        self.assertEqual(PrereqAllConditionsMet.objects.add_id(1), 1)
+        self.assertEqual(PrereqAllConditionsMet.objects.remove_id(2), 2)
+
+        self.met_list.refresh_from_db()
+        other_met_list.refresh_from_db()
+        self.assertEqual(self.met_list.get_ids(), [1])
+        self.assertEqual(other_met_list.get_ids(), [1])
+
+    def test_met_ids_as_subquery(self):
+        quests = mommy.make(Quest, _quantity=3)
+        self.met_list.ids = [quests[0].id, quests[2].id]
+        self.met_list.save()
+
+        met_lists = PrereqAllConditionsMet.objects.filter(user=self.student)
+        self.assertSetEqual(
+            set(Quest.objects.filter(pk__in=met_lists.met_ids())),
+            {quests[0], quests[2]}
+        )
+
+
+class PrereqChainTestModel(TenantTestCase):
+
+    def setUp(self):
+        self.student = mommy.make(User, is_staff=False)
+        self.quest = mommy.make(Quest)
+        # quest <- chained_prereq <- named_prereq <- badge
+        self.named_prereq = Prereq.objects.create(
+            name='Named', parent_content_type=ContentType.objects.get_for_model(Quest), parent_object_id=self.quest.id,
+            prereq_content_type=ContentType.objects.get_for_model(Badge), prereq_object_id=mommy.make(Badge).id,
+            prereq_invert=True,
+        )
+        self.chained_prereq = Prereq.objects.create(
+            parent_content_type=ContentType.objects.get_for_model(Quest), parent_object_id=self.quest.id,
+            prereq_content_type=ContentType.objects.get_for_model(Prereq), prereq_object_id=self.named_prereq.id,
+        )
+
+    def make_cycle(self):
+        self.named_prereq.prereq_content_type = ContentType.objects.get_for_model(Prereq)
+        self.named_prereq.prereq_object_id = self.chained_prereq.id
+        self.named_prereq.save()
+
+    def test_get_depth(self):
+        self.assertEqual(self.named_prereq.get_depth(), 1)
+        self.assertEqual(self.chained_prereq.get_depth(), 2)
+        self.chained_prereq.clean()
+
+    def test_clean_rejects_too_deep(self):
+        with patch('prerequisites.models.PREREQ_MAX_DEPTH', 1):
+            with self.assertRaisesRegex(ValidationError, '2 Prereqs deep'):
+                self.chained_prereq.clean()
+
+    def test_clean_rejects_cycles(self):
+        self.named_prereq.prereq_content_type = ContentType.objects.get_for_model(Prereq)
+        self.named_prereq.prereq_object_id = self.chained_prereq.id
+        with self.assertRaisesRegex(ValidationError, 'lead back to itself'):
+            self.named_prereq.clean()
+
+    def test_admin_shows_depth(self):
+        self.assertEqual(depth(self.chained_prereq), '2 (max 10)')
+        self.assertEqual(depth(Prereq()), '-')
+        self.make_cycle()
+        self.assertIn('Prereq cycle', depth(self.chained_prereq))
+
+    def test_named_prereq_is_evaluated_once(self):
+        memo = {}
+        self.assertTrue(self.chained_prereq.condition_met(self.student, memo))
+        self.assertTrue(memo[(self.named_prereq.id, self.student.id)])
+        with self.assertNumQueries(0):
+            self.assertTrue(self.named_prereq.condition_met(self.student, memo))
+
+    def test_evaluating_a_cycle_raises(self):
+        self.make_cycle()
+        with self.assertRaises(PrereqCycleError):
+            Prereq.objects.all_conditions_met(self.quest, self.student)
+        with self.assertRaises(PrereqCycleError):
+            Prereq.objects.users_meeting_all_conditions(self.quest, [self.student.id])
+
+        graph = get_prereq_graph()
+        with self.assertRaises(PrereqCycleError):
+            graph.prereq_met(self.chained_prereq.id, UserFacts(self.student))
+        with self.assertRaises(PrereqCycleError):
+            graph.users_meeting_prereq(self.chained_prereq.id, [self.student.id])
+
+
+class PrereqPrefetchTestModel(TenantTestCase):
+
+    def setUp(self):
+        quest_ct = ContentType.objects.get_for_model(Quest)
+        badge_ct = ContentType.objects.get_for_model(Badge)
+        for _ in range(5):
+            Prereq.objects.create(
+                parent_content_type=quest_ct, parent_object_id=mommy.make(Quest).id,
+                prereq_content_type=quest_ct, prereq_object_id=mommy.make(Quest).id,
+                or_prereq_content_type=badge_ct, or_prereq_object_id=mommy.make(Badge).id,
+            )
+        deleted_quest = mommy.make(Quest)
+        Prereq.objects.create(
+            parent_content_type=quest_ct, parent_object_id=mommy.make(Quest).id,
+            prereq_content_type=quest_ct, prereq_object_id=deleted_quest.id,
+        )
+        deleted_quest.delete()
+
+    def test_with_objects(self):
+        expected = [(p.parent(), p.get_prereq(), p.get_or_prereq() if p.or_prereq_object_id else None, str(p))
+                    for p in Prereq.objects.order_by('id')]
+
+        # the prereqs, then one query per content type: quests and badges
+        with self.assertNumQueries(3):
+            prereqs = Prereq.objects.order_by('id').with_objects()
+            resolved = [(p.parent(), p.get_prereq(), p.get_or_prereq() if p.or_prereq_object_id else None, str(p))
+                        for p in prereqs]
+        self.assertEqual(resolved, expected)
+        self.assertIsNone(resolved[-1][1])
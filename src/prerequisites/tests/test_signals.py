@@ -22,7 +22,7 @@ class PrerequisitesSignalsTest(TenantTestCase):
         self.teacher = mommy.make(User, username='teacher', is_staff=True)
         self.student = mommy.make(User, username='student', is_staff=False)
 
-    @patch('prerequisites.signals.update_quest_conditions_for_user.apply_async')
+    @patch('prerequisites.signals.schedule_quest_conditions_for_user')
     def test_update_conditions_met_for_user_triggered_by_badge_assertion(self, task):
         sem = mommy.make(Semester)  # not sure why model mommy doesn't create this automatically
         badge_assertion = mommy.make(BadgeAssertion, user=self.student, game_lab_transfer=True, semester=sem)
@@ -30,21 +30,19 @@ class PrerequisitesSignalsTest(TenantTestCase):
         badge_assertion.save()
         self.assertEqual(task.call_count, 2)
 
-    @patch('prerequisites.signals.update_quest_conditions_for_user.apply_async')
+    @patch('prerequisites.signals.schedule_quest_conditions_for_user')
     def test_update_conditions_met_for_user_triggered_by_quest_summission(self, task):
         quest_summission = mommy.make(QuestSubmission, user=self.student, is_completed=False)
         quest_summission.is_completed = True
         quest_summission.save()
         self.assertEqual(task.call_count, 2)
 
-    @patch('prerequisites.signals.update_quest_conditions_for_user.apply_async')
+    @patch('prerequisites.signals.schedule_quest_conditions_for_user')
     def test_update_conditions_met_for_user_triggered_by_course_student(self, task):
-        with patch('profile_manager.models.Profile.xp_invalidate_cache') as callback:
-            course_student = mommy.make(CourseStudent, user=self.student, active=False)
-            course_student.active = True
-            course_student.save()
-            self.assertEqual(task.call_count, 2)
-            self.assertEqual(callback.call_count, 2)
+        course_student = mommy.make(CourseStudent, user=self.student, active=False)
+        course_student.active = True
+        course_student.save()
+        self.assertEqual(task.call_count, 2)
 
     @patch('prerequisites.signals.update_quest_conditions_all.apply_async')
     def test_update_quest_conditions_triggered_by_badge(self, task):
@@ -0,0 +1,213 @@
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.test import override_settings
+
+from freezegun import freeze_time
+from mock import patch
+from model_mommy import mommy
+from tenant_schemas.test.cases import TenantTestCase
+
+from courses.models import Semester
+from prerequisites.graph import get_changed_targets
+from prerequisites.models import Prereq, PrereqAllConditionsMet
+from prerequisites.tasks import (
+    UPDATE_ALL_JOB_CACHE_KEY,
+    _schedule_quest_conditions_for_user,
+    claim_update_conditions_chunk,
+    get_quest_conditions_queue_depth,
+    get_update_conditions_all_progress,
+    run_update_conditions_all,
+    start_update_conditions_all_job,
+    update_quest_conditions_all,
+    update_quest_conditions_chunk,
+    update_conditions_for_chunk,
+    update_conditions_for_quest,
+    update_quest_conditions_for_user
+)
+from quest_manager.models import Quest, QuestSubmission
+from siteconfig.models import SiteConfig
+
+User = get_user_model()
+
+
+@freeze_time('2018-10-12 00:54:00', tz_offset=0)
+class UpdateConditionsForQuestTest(TenantTestCase):
+
+    def setUp(self):
+        self.semester = mommy.make(Semester)
+        SiteConfig.get().set_active_semester(self.semester)
+        self.quest = mommy.make(Quest)
+        self.prereq_quest = mommy.make(Quest)
+        Prereq.add_simple_prereq(self.quest, self.prereq_quest)
+
+        self.students = mommy.make(User, is_staff=False, _quantity=4)
+        model_name = Quest.get_model_name()
+        for student in self.students[:3]:
+            # the quest is wrongly cached as available for the first student
+            ids = [self.quest.id] if student == self.students[0] else []
+            PrereqAllConditionsMet.objects.create(user=student, model_name=model_name, ids=ids)
+
+    def get_met_ids(self, student):
+        return PrereqAllConditionsMet.objects.get(user=student).get_ids()
+
+    def test_update_conditions_for_quest(self):
+        for student in self.students[1:]:
+            mommy.make(QuestSubmission, user=student, quest=self.prereq_quest, semester=self.semester,
+                       is_approved=True)
+
+        with patch('prerequisites.tasks.invalidate_available_quests') as invalidate:
+            update_conditions_for_quest(self.quest.id)
+        self.assertSetEqual({call[0][0] for call in invalidate.call_args_list},
+                            {student.id for student in self.students[:3]})
+
+        self.assertNotIn(self.quest.id, self.get_met_ids(self.students[0]))
+        self.assertIn(self.quest.id, self.get_met_ids(self.students[1]))
+        self.assertIn(self.quest.id, self.get_met_ids(self.students[2]))
+        # only users that already have their conditions cached are updated
+        self.assertFalse(PrereqAllConditionsMet.objects.filter(user=self.students[3]).exists())
+
+        # nothing changed, so nobody's available quests are thrown away
+        with patch('prerequisites.tasks.invalidate_available_quests') as invalidate:
+            update_conditions_for_quest(self.quest.id)
+        invalidate.assert_not_called()
+
+    def test_update_conditions_for_quest_without_prereqs(self):
+        Prereq.objects.filter(parent_content_type=ContentType.objects.get_for_model(Quest)).delete()
+
+        update_conditions_for_quest(self.quest.id)
+
+        for student in self.students[:3]:
+            self.assertEqual(self.get_met_ids(student), [self.quest.id])
+
+
+@freeze_time('2018-10-12 00:54:00', tz_offset=0)
+class UpdateQuestConditionsForUserTest(TenantTestCase):
+
+    def setUp(self):
+        self.semester = mommy.make(Semester)
+        SiteConfig.get().set_active_semester(self.semester)
+        self.student = mommy.make(User, is_staff=False)
+        self.prereq_quest = mommy.make(Quest)
+        self.quest = mommy.make(Quest)
+        Prereq.add_simple_prereq(self.quest, self.prereq_quest)
+        self.other_quest = mommy.make(Quest)
+        Prereq.add_simple_prereq(self.other_quest, mommy.make(Quest))
+
+    def get_met_ids(self):
+        return PrereqAllConditionsMet.objects.get(user=self.student).get_ids()
+
+    def test_only_dependent_quests_are_updated(self):
+        update_quest_conditions_for_user(self.student.id)
+        self.assertNotIn(self.quest.id, self.get_met_ids())
+
+        # A stale entry for a quest that doesn't depend on the change is left alone
+        met_list = PrereqAllConditionsMet.objects.get(user=self.student)
+        met_list.add_id(self.other_quest.id)
+
+        submission = mommy.make(QuestSubmission, user=self.student, quest=self.prereq_quest, semester=self.semester,
+                                is_approved=True)
+        update_quest_conditions_for_user(self.student.id, targets=get_changed_targets(submission))
+
+        self.assertIn(self.quest.id, self.get_met_ids())
+        self.assertIn(self.other_quest.id, self.get_met_ids())
+
+        submission.delete()
+        update_quest_conditions_for_user(self.student.id, targets=get_changed_targets(submission))
+        self.assertNotIn(self.quest.id, self.get_met_ids())
+
+    def test_targets_without_a_met_list_updates_every_quest(self):
+        submission = mommy.make(QuestSubmission, user=self.student, quest=self.prereq_quest, semester=self.semester,
+                                is_approved=True)
+        update_quest_conditions_for_user(self.student.id, targets=get_changed_targets(submission))
+
+        self.assertIn(self.quest.id, self.get_met_ids())
+        self.assertIn(self.prereq_quest.id, self.get_met_ids())
+
+
+class ScheduleQuestConditionsForUserTest(TenantTestCase):
+
+    def setUp(self):
+        self.student = mommy.make(User, is_staff=False)
+
+    @patch('prerequisites.tasks.update_quest_conditions_for_user.apply_async')
+    def test_requests_are_coalesced_until_the_task_starts(self, task):
+        queue_depth = get_quest_conditions_queue_depth()
+
+        _schedule_quest_conditions_for_user(self.student.id, [[1, 2]])
+        _schedule_quest_conditions_for_user(self.student.id, [[1, 3]])
+        _schedule_quest_conditions_for_user(self.student.id, None)
+        self.assertEqual(task.call_count, 1)
+        self.assertEqual(task.call_args[1]['kwargs'], {'targets': [[1, 2]], 'coalesced': True})
+        self.assertEqual(get_quest_conditions_queue_depth(), queue_depth + 1)
+
+        # the coalesced requests had other targets, so the task re-evaluates every quest
+        PrereqAllConditionsMet.objects.create(user=self.student, model_name=Quest.get_model_name(), ids=[])
+        with patch('prerequisites.tasks.get_prereq_graph') as get_prereq_graph:
+            get_prereq_graph.return_value.get_conditions_met.return_value = []
+            update_quest_conditions_for_user(self.student.id, targets=[[1, 2]], coalesced=True)
+            get_prereq_graph.return_value.get_dependents.assert_not_called()
+        self.assertEqual(get_quest_conditions_queue_depth(), queue_depth)
+
+        _schedule_quest_conditions_for_user(self.student.id, [[1, 2]])
+        self.assertEqual(task.call_count, 2)
+
+
+@override_settings(CONDITIONS_UPDATE_CHUNK_SIZE=2, CONDITIONS_UPDATE_CONCURRENCY=3)
+class UpdateQuestConditionsAllTest(TenantTestCase):
+
+    def setUp(self):
+        cache.delete('update_conditions_all_task_waiting')
+        self.students = mommy.make(User, is_staff=False, _quantity=4)
+        self.num_users = User.objects.count()
+        self.num_chunks = (self.num_users + 1) // 2
+
+    def test_run_update_conditions_all(self):
+        progress_reports = []
+        progress = run_update_conditions_all(progress_callback=progress_reports.append)
+
+        self.assertEqual(len(progress_reports), self.num_chunks)
+        self.assertEqual(progress['num_users'], self.num_users)
+        self.assertEqual(progress['users_done'], self.num_users)
+        self.assertEqual(progress['chunks_done'], self.num_chunks)
+        self.assertEqual(PrereqAllConditionsMet.objects.count(), self.num_users)
+        # finished, so it doesn't keep growing
+        self.assertEqual(get_update_conditions_all_progress()['elapsed'], progress['elapsed'])
+
+    @patch('prerequisites.tasks.update_quest_conditions_chunk.apply_async')
+    def test_update_quest_conditions_all_fans_out(self, task):
+        update_quest_conditions_all(1)
+        self.assertEqual(task.call_count, 3)
+        self.assertEqual(task.call_args[1]['args'][1], None)
+
+        # The job was just started, so it covers this one
+        update_quest_conditions_all(1)
+        self.assertEqual(task.call_count, 3)
+
+    @patch('prerequisites.tasks.update_quest_conditions_chunk.apply_async')
+    def test_resume_restarts_unfinished_chunks(self, task):
+        job = start_update_conditions_all_job()
+        # a chunk is started, but its worker dies
+        self.assertEqual(claim_update_conditions_chunk(job), 0)
+
+        update_quest_conditions_all(resume=True)
+        self.assertEqual([call[1]['args'] for call in task.call_args_list],
+                         [[job['id'], 0], [job['id'], None], [job['id'], None]])
+
+    @patch('prerequisites.tasks.update_quest_conditions_chunk.apply_async')
+    def test_resume_with_a_chunk_in_progress(self, task):
+        job = start_update_conditions_all_job()
+        # chunk 0 is still being worked on by its original task when the job is resumed
+        self.assertEqual(claim_update_conditions_chunk(job), 0)
+        update_quest_conditions_all(resume=True)
+        self.assertEqual(task.call_args_list[0][1]['args'], [job['id'], 0])
+
+        # both the original and the resumed task finish it, it's only counted once
+        update_conditions_for_chunk(job, 0)
+        update_conditions_for_chunk(job, 0)
+        self.assertEqual(get_update_conditions_all_progress(job)['chunks_done'], 1)
+        self.assertIsNone(cache.get(UPDATE_ALL_JOB_CACHE_KEY)['finished'])
+
+        # a resumed task whose chunk is done moves on to the next unclaimed chunk instead
+        update_quest_conditions_chunk(job['id'], 0)
+        self.assertEqual(get_update_conditions_all_progress(job)['chunks_done'], 2)
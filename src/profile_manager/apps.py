@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ProfileConfig(AppConfig):
     name = 'profile_manager'
     verbose_name = 'Profiles'
+
+    def ready(self):
+        import profile_manager.signals  # noqa
@@ -0,0 +1,109 @@
+from datetime import datetime, time
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils import timezone
+
+
+def forwards(apps, schema_editor):
+    """ Start the ledger with one entry for everything that already counts towards XP """
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    QuestSubmission = apps.get_model('quest_manager', 'QuestSubmission')
+    BadgeAssertion = apps.get_model('badges', 'BadgeAssertion')
+    CourseStudent = apps.get_model('courses', 'CourseStudent')
+    XPEntry = apps.get_model('profile_manager', 'XPEntry')
+    XPDailyTotal = apps.get_model('profile_manager', 'XPDailyTotal')
+
+    now = timezone.now()
+
+    def semester_start(first_day):
+        return timezone.make_aware(datetime.combine(first_day, time.min)) if first_day else now
+
+    sources = [
+        (QuestSubmission, QuestSubmission.objects.filter(
+            is_approved=True, game_lab_transfer=False, quest__isnull=False, semester__isnull=False
+        ).values_list('id', 'user_id', 'semester_id', 'quest__xp', 'time_approved')),
+        (BadgeAssertion, BadgeAssertion.objects.filter(
+            game_lab_transfer=False
+        ).values_list('id', 'user_id', 'semester_id', 'badge__xp', 'timestamp')),
+        (CourseStudent, [
+            (source_id, user_id, semester_id, xp, semester_start(first_day))
+            for source_id, user_id, semester_id, xp, first_day in CourseStudent.objects.filter(
+                semester__isnull=False
+            ).exclude(xp_adjustment=0).values_list('id', 'user_id', 'semester_id', 'xp_adjustment', 'semester__first_day')
+        ]),
+    ]
+
+    entries = []
+    for model, rows in sources:
+        content_type, created = ContentType.objects.get_or_create(
+            app_label=model._meta.app_label, model=model._meta.model_name
+        )
+        for source_id, user_id, semester_id, xp, timestamp in rows:
+            if xp:
+                entries.append(XPEntry(user_id=user_id, semester_id=semester_id, delta=xp, timestamp=timestamp or now,
+                                       source_content_type=content_type, source_object_id=source_id))
+    XPEntry.objects.bulk_create(entries, batch_size=1000)
+
+    deltas = {}
+    for entry in entries:
+        key = (entry.user_id, entry.semester_id, timezone.localtime(entry.timestamp).date())
+        deltas[key] = deltas.get(key, 0) + entry.delta
+
+    totals = []
+    running = {}
+    for (user_id, semester_id, day), delta in sorted(deltas.items()):
+        running[(user_id, semester_id)] = running.get((user_id, semester_id), 0) + delta
+        totals.append(XPDailyTotal(user_id=user_id, semester_id=semester_id, date=day,
+                                   xp=running[(user_id, semester_id)]))
+    XPDailyTotal.objects.bulk_create(totals, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('courses', '0012_auto_20200411_0038'),
+        ('badges', '0004_badgeassertion_hot_path_indexes'),
+        ('quest_manager', '0017_questsubmission_hot_path_indexes'),
+        ('profile_manager', '0008_auto_20200411_0038'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='XPEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('delta', models.IntegerField()),
+                ('timestamp', models.DateTimeField(help_text='When the XP counts from, e.g. the time the quest was approved')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('source_object_id', models.PositiveIntegerField(blank=True, null=True)),
+                ('semester', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='courses.Semester')),
+                ('source_content_type', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='contenttypes.ContentType')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='xp_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'XP entries',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='xpentry',
+            index=models.Index(fields=['user', 'semester', 'timestamp'], name='xpentry_user_sem_time_idx'),
+        ),
+        migrations.CreateModel(
+            name='XPDailyTotal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('xp', models.IntegerField(default=0)),
+                ('semester', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='courses.Semester')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='xp_daily_totals', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'semester', 'date')},
+            },
+        ),
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
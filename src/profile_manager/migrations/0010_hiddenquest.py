@@ -0,0 +1,58 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def forwards(apps, schema_editor):
+    """ Move the comma separated hidden quest ids of each profile into HiddenQuest rows """
+    Profile = apps.get_model('profile_manager', 'Profile')
+    Quest = apps.get_model('quest_manager', 'Quest')
+    HiddenQuest = apps.get_model('profile_manager', 'HiddenQuest')
+
+    quest_ids = set(Quest.objects.values_list('id', flat=True))
+    hidden = []
+    for user_id, hidden_quests in Profile.objects.exclude(hidden_quests__isnull=True).exclude(hidden_quests='')\
+            .values_list('user_id', 'hidden_quests'):
+        # the list was never cleaned up when quests were deleted
+        ids = {int(quest_id) for quest_id in hidden_quests.split(',') if quest_id.strip().isdigit()}
+        hidden.extend(HiddenQuest(user_id=user_id, quest_id=quest_id) for quest_id in ids & quest_ids)
+    HiddenQuest.objects.bulk_create(hidden, batch_size=1000)
+
+
+def backwards(apps, schema_editor):
+    Profile = apps.get_model('profile_manager', 'Profile')
+    HiddenQuest = apps.get_model('profile_manager', 'HiddenQuest')
+
+    hidden = {}
+    for user_id, quest_id in HiddenQuest.objects.order_by('id').values_list('user_id', 'quest_id'):
+        hidden.setdefault(user_id, []).append(str(quest_id))
+    for user_id, quest_ids in hidden.items():
+        Profile.objects.filter(user_id=user_id).update(hidden_quests=','.join(quest_ids)[:1023])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('quest_manager', '0017_questsubmission_hot_path_indexes'),
+        ('profile_manager', '0009_xpentry_xpdailytotal'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HiddenQuest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quest', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='quest_manager.Quest')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='hidden_quests', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'quest')},
+            },
+        ),
+        migrations.RunPython(forwards, backwards),
+        migrations.RemoveField(
+            model_name='profile',
+            name='hidden_quests',
+        ),
+    ]
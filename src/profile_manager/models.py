@@ -1,9 +1,16 @@
 import re
+from datetime import datetime, time, timedelta
+
+import numpy
 
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.core.validators import RegexValidator, validate_comma_separated_integer_list
-from django.db import models
+from django.core.cache import cache
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
+from django.core.validators import RegexValidator
+from django.db import models, transaction
+from django.db.models import F, Sum
 from django.db.models.signals import post_save
 from django.templatetags.static import static
 from django.urls import reverse
@@ -16,7 +23,7 @@ from tenant_schemas.utils import get_public_schema_name
 from badges.models import BadgeAssertion
 from courses.models import Rank, CourseStudent
 from notifications.signals import notify
-from quest_manager.models import QuestSubmission
+from quest_manager.models import Quest, QuestSubmission, invalidate_available_quests
 from utilities.models import RestrictedFileField
 
 
@@ -119,8 +126,6 @@ class Profile(models.Model):
         default=False, help_text="Check this if you want your preferred name used ONLY in the classroom, but NOT in other places such as on your report card.")  # noqa
     dark_theme = models.BooleanField(default=False)
     silent_mode = models.BooleanField(default=False, help_text="Don't play the gong sounds.")
-    hidden_quests = models.CharField(validators=[validate_comma_separated_integer_list], max_length=1023,
-                                     null=True, blank=True)  # list of quest IDs
     is_TA = models.BooleanField(default=False, help_text="TAs can create new quests for teacher approval.")
 
     custom_stylesheet = RestrictedFileField(null=True, blank=True, upload_to=user_directory_path,
@@ -207,38 +212,32 @@ class Profile(models.Model):
     #################################
 
     def num_hidden_quests(self):
-        hidden_quest_list = self.get_hidden_quests_as_list()
-        return len(hidden_quest_list)
+        return len(self.get_hidden_quest_ids())
 
     def is_quest_hidden(self, quest):
-        hidden_quest_list = self.get_hidden_quests_as_list()
-        if str(quest.id) in hidden_quest_list:
-            return True
-        else:
-            return False
-
-    def get_hidden_quests_as_list(self):
-        if self.hidden_quests is None:
-            return []
-        else:
-            return smart_list(self.hidden_quests)
-
-    def save_hidden_quests_from_list(self, hidden_quest_list):
-        hidden_quest_csv = ",".join(hidden_quest_list)
-        self.hidden_quests = hidden_quest_csv
-        self.save()
+        return quest.id in self.get_hidden_quest_ids()
+
+    def get_hidden_quest_ids(self):
+        """
+        :return: the set of the ids of the quests the user has hidden, loaded once per profile instance so checking it
+            for every quest on a page is one query
+        """
+        if getattr(self, '_hidden_quest_ids', None) is None:
+            self._hidden_quest_ids = set(
+                HiddenQuest.objects.filter(user_id=self.user_id).values_list('quest_id', flat=True)
+            )
+        return self._hidden_quest_ids
 
     def hide_quest(self, quest_id):
-        hidden_quest_list = self.get_hidden_quests_as_list()
-        if str(quest_id) not in hidden_quest_list:
-            hidden_quest_list.append(str(quest_id))
-            self.save_hidden_quests_from_list(hidden_quest_list)
+        # a single insert that does nothing if it's already hidden, e.g. by a double click
+        HiddenQuest.objects.bulk_create([HiddenQuest(user_id=self.user_id, quest_id=quest_id)], ignore_conflicts=True)
+        self._hidden_quest_ids = None
+        invalidate_available_quests(self.user_id)
 
     def unhide_quest(self, quest_id):
-        hidden_quest_list = self.get_hidden_quests_as_list()
-        if str(quest_id) in hidden_quest_list:
-            hidden_quest_list.remove(str(quest_id))
-            self.save_hidden_quests_from_list(hidden_quest_list)
+        HiddenQuest.objects.filter(user_id=self.user_id, quest_id=quest_id).delete()
+        self._hidden_quest_ids = None
+        invalidate_available_quests(self.user_id)
 
     #################################
     #
@@ -279,9 +278,19 @@ class Profile(models.Model):
     #################################
 
     def xp_invalidate_cache(self):
+        """
+        Recalculate the user's XP from scratch and reconcile the XP ledger with it. XP is normally kept up to date
+        by the ledger as it changes (see XPEntryManager.record()), so this is only needed to correct drift.
+        """
         xp = QuestSubmission.objects.calculate_xp(self.user)
         xp += BadgeAssertion.objects.calculate_xp(self.user)
         xp += CourseStudent.objects.calculate_xp(self.user)
+
+        semester_id = SiteConfig.get().active_semester_id
+        ledger_xp = XPDailyTotal.objects.get_xp(self.user, semester_id)
+        if xp != ledger_xp:
+            XPEntry.objects.record([XPEntry(user=self.user, semester_id=semester_id, delta=xp - ledger_xp,
+                                            timestamp=timezone.now())])
         self.xp_cached = xp
         self.save()
         return xp
@@ -293,12 +302,9 @@ class Profile(models.Model):
         return self.xp_cached / course_count
 
     def xp_to_date(self, date):
-        # TODO: Combine this with other methods?
-        xp = QuestSubmission.objects.calculate_xp_to_date(self.user, date)
-        xp += BadgeAssertion.objects.calculate_xp_to_date(self.user, date)
-        # TODO: Add manual adjustments to calculation
-        xp += CourseStudent.objects.calculate_xp(self.user)
-        return xp
+        if not isinstance(date, datetime):
+            date = timezone.make_aware(datetime.combine(date, time.min))
+        return XPDailyTotal.objects.get_xp_to_date(self.user, SiteConfig.get().active_semester_id, date)
 
     def mark(self):
         # course = CourseStudent.objects.current_course(self.user)
@@ -366,6 +372,221 @@ class Profile(models.Model):
         return User.objects.filter(id__in=user_id_list)
 
 
+class HiddenQuest(models.Model):
+    """ A quest the user has hidden from their Available quests tab """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='hidden_quests', on_delete=models.CASCADE)
+    quest = models.ForeignKey(Quest, related_name='+', on_delete=models.CASCADE)
+
+    class Meta:
+        # also the index QuestQuerySet.exclude_hidden() looks them up by
+        unique_together = ('user', 'quest')
+
+    def __str__(self):
+        return "{} hid {}".format(self.user, self.quest_id)
+
+
+def xp_contribution(instance):
+    """
+    What a QuestSubmission, BadgeAssertion or CourseStudent adds to its user's XP, counted the same way as the
+    aggregates in Profile.xp_invalidate_cache()
+    :return: a (semester_id, xp, timestamp) tuple, or None if it doesn't count towards XP
+    """
+    if isinstance(instance, QuestSubmission):
+        if instance.is_approved and not instance.game_lab_transfer and instance.quest_id and instance.semester_id:
+            return instance.semester_id, instance.quest.xp, instance.time_approved or timezone.now()
+    elif isinstance(instance, BadgeAssertion):
+        if not instance.game_lab_transfer:
+            return instance.semester_id, instance.badge.xp, instance.timestamp or timezone.now()
+    elif isinstance(instance, CourseStudent):
+        # manual adjustments apply to the whole semester
+        if instance.semester_id:
+            first_day = instance.semester.first_day
+            timestamp = timezone.make_aware(datetime.combine(first_day, time.min)) if first_day else timezone.now()
+            return instance.semester_id, instance.xp_adjustment, timestamp
+    return None
+
+
+def xp_change_entries(instance, before, after):
+    """
+    :param before: the instance's xp_contribution() before it changed, or None
+    :param after: the instance's xp_contribution() after it changed, or None
+    :return: unsaved XPEntry objects that take the old contribution out of the ledger and put the new one in
+    """
+    entries = []
+    if before == after:
+        return entries
+    if before is not None:
+        semester_id, xp, timestamp = before
+        entries.append(XPEntry(user=instance.user, semester_id=semester_id, delta=-xp, timestamp=timestamp,
+                               source_object=instance))
+    if after is not None:
+        semester_id, xp, timestamp = after
+        entries.append(XPEntry(user=instance.user, semester_id=semester_id, delta=xp, timestamp=timestamp,
+                               source_object=instance))
+    return entries
+
+
+XP_PROGRESS_CHART_CACHE_KEY = 'xp_progress_chart_{user_id}_{semester_id}_{date}'
+
+
+def xp_progress_chart_cache_key(user_id, semester_id, date=None):
+    """ Key for the user's XP at the end of each class day in the semester, as it stood on the date (today) """
+    return XP_PROGRESS_CHART_CACHE_KEY.format(user_id=user_id, semester_id=semester_id,
+                                              date=date or timezone.localdate())
+
+
+class XPEntryManager(models.Manager):
+
+    def record(self, entries):
+        """
+        Append the (unsaved) entries to the ledger and add their deltas to the daily totals, and to Profile.xp_cached
+        for the active semester.  Profiles already loaded on the entries' users are refreshed.
+        :return: the saved entries
+        """
+        entries = [entry for entry in entries if entry.delta]
+        if not entries:
+            return entries
+
+        active_semester_id = SiteConfig.get().active_semester_id
+        xp_changes = {}
+        for entry in entries:
+            if entry.semester_id == active_semester_id:
+                xp_changes[entry.user_id] = xp_changes.get(entry.user_id, 0) + entry.delta
+
+        with transaction.atomic():
+            # lock the users' profiles so concurrent changes can't interleave their running totals
+            user_ids = sorted({entry.user_id for entry in entries})
+            list(Profile.objects.select_for_update().filter(user_id__in=user_ids).values_list('id', flat=True))
+
+            self.bulk_create(entries)
+            XPDailyTotal.objects.add(entries)
+            for user_id, delta in xp_changes.items():
+                Profile.objects.filter(user_id=user_id).update(xp_cached=F('xp_cached') + delta)
+
+        cache.delete_many({xp_progress_chart_cache_key(entry.user_id, entry.semester_id) for entry in entries})
+
+        # keyed by identity: the same user may be loaded more than once
+        loaded_users = {id(entry.user): entry.user for entry in entries if XPEntry.user.is_cached(entry)}
+        for user in loaded_users.values():
+            if User.profile.is_cached(user):
+                user.profile.refresh_from_db(fields=['xp_cached'])
+        return entries
+
+    def record_xp_value_change(self, instance, delta):
+        """ Record a change in a Quest's or Badge's XP for everyone that has already earned it """
+        if isinstance(instance, Quest):
+            model = QuestSubmission
+            sources = QuestSubmission._base_manager.filter(
+                quest=instance, is_approved=True, game_lab_transfer=False, semester__isnull=False
+            ).values_list('id', 'user_id', 'semester_id', 'time_approved')
+        else:
+            model = BadgeAssertion
+            sources = BadgeAssertion._base_manager.filter(
+                badge=instance, game_lab_transfer=False
+            ).values_list('id', 'user_id', 'semester_id', 'timestamp')
+
+        content_type = ContentType.objects.get_for_model(model)
+        return self.record([
+            XPEntry(user_id=user_id, semester_id=semester_id, delta=delta, timestamp=timestamp or timezone.now(),
+                    source_content_type=content_type, source_object_id=source_id)
+            for source_id, user_id, semester_id, timestamp in sources
+        ])
+
+    def record_changes(self, changes):
+        """
+        Record what changing XP sources did to their users' XP
+        :param changes: (instance, contribution_before, contribution_after) tuples, see xp_change_entries()
+        """
+        return self.record([entry for change in changes for entry in xp_change_entries(*change)])
+
+
+class XPEntry(models.Model):
+    """ An append-only ledger of every change to a user's XP, in a semester """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='xp_entries', on_delete=models.CASCADE)
+    semester = models.ForeignKey('courses.Semester', on_delete=models.CASCADE)
+    delta = models.IntegerField()
+    timestamp = models.DateTimeField(help_text="When the XP counts from, e.g. the time the quest was approved")
+    created = models.DateTimeField(auto_now_add=True)
+
+    # the submission, badge assertion or course that changed, or None for a reconciliation
+    source_content_type = models.ForeignKey(ContentType, null=True, blank=True, on_delete=models.SET_NULL)
+    source_object_id = models.PositiveIntegerField(null=True, blank=True)
+    source_object = GenericForeignKey("source_content_type", "source_object_id")
+
+    objects = XPEntryManager()
+
+    class Meta:
+        verbose_name_plural = "XP entries"
+        indexes = [
+            models.Index(fields=['user', 'semester', 'timestamp'], name='xpentry_user_sem_time_idx'),
+        ]
+
+    def __str__(self):
+        return "{:+d} XP for {} at {}".format(self.delta, self.user, self.timestamp)
+
+
+class XPDailyTotalManager(models.Manager):
+
+    def add(self, entries):
+        """ Roll the entries' deltas into the running totals of the day they count from, and every day after it """
+        deltas = {}
+        for entry in entries:
+            key = (entry.user_id, entry.semester_id, timezone.localtime(entry.timestamp).date())
+            deltas[key] = deltas.get(key, 0) + entry.delta
+
+        for (user_id, semester_id, day), delta in deltas.items():
+            qs = self.filter(user_id=user_id, semester_id=semester_id)
+            qs.filter(date__gt=day).update(xp=F('xp') + delta)
+            if not qs.filter(date=day).update(xp=F('xp') + delta):
+                self.create(user_id=user_id, semester_id=semester_id, date=day,
+                            xp=self.get_xp(user_id, semester_id, day) + delta)
+
+    def get_xp(self, user, semester, date=None):
+        """ :return: the user's total XP in the semester at the end of the date, or today if no date is given """
+        qs = self.filter(user=user, semester=semester)
+        if date is not None:
+            qs = qs.filter(date__lte=date)
+        return qs.order_by('-date').values_list('xp', flat=True).first() or 0
+
+    def get_xp_series(self, user, semester, dates):
+        """ :return: a list of the user's total XP in the semester at the end of each of the dates, in one query """
+        if not dates:
+            return []
+        totals = list(self.filter(user=user, semester=semester, date__lte=max(dates)).order_by('date')
+                      .values_list('date', 'xp'))
+        total_dates = numpy.array([total_date for total_date, xp in totals], dtype='datetime64[D]')
+        total_xp = numpy.array([0] + [xp for total_date, xp in totals])
+        # the latest total on or before each date, or the leading 0 when there isn't one yet
+        indices = numpy.searchsorted(total_dates, numpy.array(dates, dtype='datetime64[D]'), side='right')
+        return total_xp[indices].tolist()
+
+    def get_xp_to_date(self, user, semester, date):
+        """ :return: the user's total XP in the semester at the datetime: the day before's total and the day so far """
+        day = timezone.localtime(date).date()
+        xp = self.get_xp(user, semester, day - timedelta(days=1))
+        day_start = timezone.make_aware(datetime.combine(day, time.min))
+        day_xp = XPEntry.objects.filter(
+            user=user, semester=semester, timestamp__gte=day_start, timestamp__lte=date
+        ).aggregate(Sum('delta'))['delta__sum']
+        return xp + (day_xp or 0)
+
+
+class XPDailyTotal(models.Model):
+    """ A user's running XP total in a semester at the end of each day their XP changed, rolled up from XPEntry """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='xp_daily_totals', on_delete=models.CASCADE)
+    semester = models.ForeignKey('courses.Semester', on_delete=models.CASCADE)
+    date = models.DateField()
+    xp = models.IntegerField(default=0)
+
+    objects = XPDailyTotalManager()
+
+    class Meta:
+        unique_together = ('user', 'semester', 'date')
+
+    def __str__(self):
+        return "{} XP for {} on {}".format(self.xp, self.user, self.date)
+
+
 def create_profile(sender, **kwargs):
     from django.db import connection
 
@@ -0,0 +1,80 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from badges.models import Badge, BadgeAssertion
+from courses.models import CourseStudent, Semester
+from profile_manager.models import XPEntry, xp_change_entries, xp_contribution
+from quest_manager.models import Quest, QuestSubmission
+
+RELATED_XP_SOURCE = {
+    QuestSubmission: 'quest',
+    BadgeAssertion: 'badge',
+    CourseStudent: 'semester',
+}
+
+
+@receiver(pre_save, sender=QuestSubmission)
+@receiver(pre_save, sender=BadgeAssertion)
+@receiver(pre_save, sender=CourseStudent)
+def xp_source_pre_save(sender, instance, raw=False, **kwargs):
+    """ Remember what the saved version counted towards the user's XP, to compare with after saving """
+    if raw:
+        return
+    old = None
+    if instance.pk:
+        old = sender._base_manager.select_related(RELATED_XP_SOURCE[sender]).filter(pk=instance.pk).first()
+    instance._xp_contribution_before = xp_contribution(old) if old else None
+
+
+@receiver(post_save, sender=QuestSubmission)
+@receiver(post_save, sender=BadgeAssertion)
+@receiver(post_save, sender=CourseStudent)
+def xp_source_post_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    before = getattr(instance, '_xp_contribution_before', None)
+    XPEntry.objects.record_changes([(instance, before, xp_contribution(instance))])
+
+
+@receiver(post_delete, sender=QuestSubmission)
+@receiver(post_delete, sender=BadgeAssertion)
+@receiver(post_delete, sender=CourseStudent)
+def xp_source_post_delete(sender, instance, **kwargs):
+    contribution = xp_contribution(instance)
+    if contribution is None:
+        return
+    entries = xp_change_entries(instance, contribution, None)
+
+    def record():
+        # the instance may have been deleted along with its user or semester, then there's nothing left to correct
+        if User.objects.filter(pk=instance.user_id).exists() and Semester.objects.filter(pk=contribution[0]).exists():
+            XPEntry.objects.record(entries)
+
+    # wait until the whole delete has finished so the ledger isn't written for a user that is being deleted
+    transaction.on_commit(record)
+
+
+@receiver(pre_save, sender=Quest)
+@receiver(pre_save, sender=Badge)
+def xp_value_pre_save(sender, instance, raw=False, **kwargs):
+    if raw or not instance.pk:
+        instance._xp_before = None
+    else:
+        instance._xp_before = sender._base_manager.filter(pk=instance.pk).values_list('xp', flat=True).first()
+
+
+@receiver(post_save, sender=Quest)
+@receiver(post_save, sender=Badge)
+def xp_value_post_save(sender, instance, **kwargs):
+    """ Changing a quest's or badge's XP changes the XP of everyone that already has it """
+    xp_before = getattr(instance, '_xp_before', None)
+    if xp_before is not None and xp_before != instance.xp:
+        XPEntry.objects.record_xp_value_change(instance, instance.xp - xp_before)
+
+
+@receiver(pre_delete, sender=Quest)
+def quest_pre_delete(sender, instance, **kwargs):
+    # submissions are kept without their quest, so they no longer count for any XP
+    XPEntry.objects.record_xp_value_change(instance, -instance.xp)
@@ -1,5 +1,9 @@
+from datetime import timedelta
+
 from django.contrib.auth import get_user_model
 from django.test import SimpleTestCase
+from django.utils import timezone
+from freezegun import freeze_time
 from model_mommy import mommy
 from model_mommy.recipe import Recipe
 from tenant_schemas.test.cases import TenantTestCase
@@ -7,7 +11,7 @@ from tenant_schemas.test.cases import TenantTestCase
 from siteconfig.models import SiteConfig
 
 from courses.models import Semester
-from profile_manager.models import Profile, smart_list
+from profile_manager.models import Profile, XPDailyTotal, XPEntry, smart_list
 
 
 class ProfileTestModel(TenantTestCase):
@@ -42,15 +46,16 @@ class ProfileTestModel(TenantTestCase):
     def test_profile_num_hidden_quests(self):
         self.assertEqual(self.profile.num_hidden_quests(), 0)
 
-    def test_profile_get_hidden_quests_as_list(self):
-        self.assertEqual(self.profile.get_hidden_quests_as_list(), [])
+    def test_profile_get_hidden_quest_ids(self):
+        self.assertEqual(self.profile.get_hidden_quest_ids(), set())
 
     def test_profile_hidden_quests(self):
         num_to_hide = 3
         quests_to_hide = mommy.make('quest_manager.quest', _quantity=num_to_hide)
-        hidden_quest_list = [str(q.pk) for q in quests_to_hide]
-
-        self.profile.save_hidden_quests_from_list(hidden_quest_list)
+        for quest in quests_to_hide:
+            self.profile.hide_quest(quest.id)
+        # hiding it again does nothing
+        self.profile.hide_quest(quests_to_hide[0].id)
 
         self.assertEqual(self.profile.num_hidden_quests(), num_to_hide)
 
@@ -59,14 +64,24 @@ class ProfileTestModel(TenantTestCase):
 
         quest_not_hidden = mommy.make('quest_manager.quest')
         self.assertFalse(self.profile.is_quest_hidden(quest_not_hidden))
-        self.assertEqual(self.profile.get_hidden_quests_as_list(), hidden_quest_list)
+        self.assertEqual(self.profile.get_hidden_quest_ids(), {q.id for q in quests_to_hide})
 
         self.profile.hide_quest(quest_not_hidden.id)
         self.assertTrue(self.profile.is_quest_hidden(quest_not_hidden))
+        self.assertEqual(self.profile.get_hidden_quest_ids(), {q.id for q in quests_to_hide + [quest_not_hidden]})
+
+        # loaded once for all the quests
+        profile = Profile.objects.get(id=self.profile.id)
+        with self.assertNumQueries(1):
+            self.assertTrue(all(profile.is_quest_hidden(quest) for quest in quests_to_hide))
 
         self.profile.unhide_quest(quest_hidden.id)
         self.assertFalse(self.profile.is_quest_hidden(quest_hidden))
 
+        # deleting the quest unhides it
+        quest_not_hidden.delete()
+        self.assertEqual(Profile.objects.get(id=self.profile.id).num_hidden_quests(), num_to_hide - 1)
+
     def test_profile_current_courses(self):
         # no current courses to start
         self.assertFalse(self.profile.current_courses().exists())
@@ -125,6 +140,74 @@ class ProfileTestModel(TenantTestCase):
         # print(self.profile.current_teachers()) # why is this empty?!?!
 
 
+class XPLedgerTestModel(TenantTestCase):
+
+    def setUp(self):
+        User = get_user_model()
+        self.teacher = Recipe(User, is_staff=True).make()  # need a teacher or student creation will fail.
+        self.user = mommy.make(User)
+        self.active_sem = SiteConfig.get().active_semester
+        self.quest = mommy.make('quest_manager.Quest', xp=5)
+        self.sub = mommy.make('quest_manager.QuestSubmission', user=self.user, quest=self.quest,
+                              semester=self.active_sem)
+
+    @freeze_time('2018-10-12 00:54:00', tz_offset=0)
+    def test_xp_ledger_follows_approvals_and_returns(self):
+        self.sub.mark_approved()
+        self.assertEqual(XPEntry.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(self.user.profile.xp_cached, 5)
+        self.assertEqual(XPDailyTotal.objects.get_xp(self.user, self.active_sem), 5)
+
+        self.sub.mark_returned()
+        self.assertEqual(XPEntry.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(self.user.profile.xp_cached, 0)
+        self.assertEqual(XPDailyTotal.objects.get_xp(self.user, self.active_sem), 0)
+
+    def test_xp_ledger_follows_quest_xp_changes(self):
+        self.sub.mark_approved()
+        self.quest.xp = 8
+        self.quest.save()
+        self.assertEqual(Profile.objects.get(user=self.user).xp_cached, 8)
+
+        self.quest.delete()
+        self.assertEqual(Profile.objects.get(user=self.user).xp_cached, 0)
+
+    def test_xp_ledger_xp_to_date(self):
+        with freeze_time(timezone.now() - timedelta(days=3)):
+            self.sub.mark_approved()
+        mommy.make('courses.CourseStudent', user=self.user, semester=self.active_sem, xp_adjustment=2)
+
+        profile = self.user.profile
+        self.assertEqual(profile.xp_cached, 7)
+        self.assertEqual(profile.xp_to_date(timezone.now()), 7)
+        # the adjustment counts from the first day of the semester, which is today
+        self.assertEqual(profile.xp_to_date(timezone.now() - timedelta(days=1)), 5)
+        self.assertEqual(profile.xp_to_date(timezone.now() - timedelta(days=4)), 0)
+
+    def test_xp_ledger_get_xp_series(self):
+        today = timezone.localdate()
+        with freeze_time(timezone.now() - timedelta(days=3)):
+            self.sub.mark_approved()
+        dates = [today - timedelta(days=days_ago) for days_ago in [5, 3, 1, 0]]
+
+        with self.assertNumQueries(1):
+            xp_series = XPDailyTotal.objects.get_xp_series(self.user, self.active_sem, dates)
+        self.assertEqual(xp_series, [0, 5, 5, 5])
+
+    def test_xp_ledger_reconciles_with_aggregates(self):
+        self.sub.mark_approved()
+        profile = Profile.objects.get(user=self.user)
+        self.assertEqual(profile.xp_invalidate_cache(), 5)
+        self.assertEqual(XPEntry.objects.filter(user=self.user).count(), 1)
+
+        # ledger missed a change, e.g. an update() that bypassed signals
+        XPEntry.objects.filter(user=self.user).delete()
+        XPDailyTotal.objects.filter(user=self.user).delete()
+        self.assertEqual(profile.xp_invalidate_cache(), 5)
+        self.assertEqual(XPEntry.objects.get(user=self.user).source_object, None)
+        self.assertEqual(XPDailyTotal.objects.get_xp(self.user, self.active_sem), 5)
+
+
 class SmartListTests(SimpleTestCase):
 
     def test_smart_list_empty(self):
@@ -1,18 +1,28 @@
+import uuid
+
+from django.conf import settings
 from django.contrib import admin
 from django.contrib import messages
-from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.utils import timezone
 
 from import_export import resources
 from import_export.fields import Field
+from import_export.instance_loaders import ModelInstanceLoader
+from import_export.results import RowResult
 from django_summernote.admin import SummernoteModelAdmin
 from import_export.admin import ImportExportActionModelAdmin, ExportActionMixin
 
+from prerequisites.graph import invalidate_prereq_graph
 from prerequisites.models import Prereq
 from prerequisites.admin import PrereqInline
+from prerequisites.tasks import update_quest_conditions_all
+from profile_manager.models import XPEntry
 from tenant.admin import NonPublicSchemaOnlyAdminAccessMixin
 from .signals import tidy_html
-from .models import Quest, Category, QuestSubmission, CommonData
+from .models import Quest, Category, QuestSubmission, CommonData, invalidate_quest_availability
+from .tasks import schedule_quest_availability_update
 
 
 def publish_selected_quests(modeladmin, request, queryset):
@@ -75,18 +85,65 @@ class QuestSubmissionAdmin(NonPublicSchemaOnlyAdminAccessMixin, admin.ModelAdmin
         return qs
 
 
+def clean_import_id(value):
+    """ :return: the import_id as a normalized string, so ids read from a file match the ids of saved quests """
+    return str(uuid.UUID(str(value))) if value else None
+
+
+class ImportIdInstanceLoader(ModelInstanceLoader):
+    """ Looks up all the quests being imported with a single query, instead of one per row """
+
+    def __init__(self, *args, **kwargs):
+        super(ImportIdInstanceLoader, self).__init__(*args, **kwargs)
+        import_ids = {clean_import_id(row['import_id']) for row in self.dataset.dict} - {None}
+        self.quests = {
+            clean_import_id(quest.import_id): quest
+            for quest in self.get_queryset().filter(import_id__in=import_ids)
+        }
+
+    def get_instance(self, row):
+        return self.quests.get(clean_import_id(row['import_id']))
+
+
 class QuestResource(resources.ModelResource):
+    """
+    Imports quests in batches: each batch is inserted or updated with one query, without the signals of saving each
+    quest, then prereqs and campaigns are linked in bulk and prerequisite conditions are refreshed once at the end.
+    """
     prereq_quest_import_id = Field(column_name='prereq_quest_import_id')
     campaign_title = Field()
     campaign_icon = Field()
 
+    # number of quests saved together
+    batch_size = 100
+
     class Meta:
         model = Quest
         import_id_fields = ('import_id',)
         exclude = ('id', 'editor', 'specific_teacher_to_notify', 'campaign', 'common_data')
+        instance_loader_class = ImportIdInstanceLoader
+
+    def get_queryset(self):
+        return super(QuestResource, self).get_queryset().select_related('campaign')
+
+    def before_export(self, queryset, *args, **kwargs):
+        # Look up the prereq quests of all the exported quests at once, rather than for each quest
+        quest_ct = ContentType.objects.get_for_model(Quest)
+        quest_ids = (queryset if queryset is not None else self.get_queryset()).values_list('id', flat=True)
+        prereqs = Prereq.objects.filter(
+            parent_content_type=quest_ct, parent_object_id__in=quest_ids, prereq_content_type=quest_ct
+        ).order_by('-id').with_objects()
+        # the first simple prereq quest of each quest wins
+        self.prereq_quests = {p.parent_object_id: p.get_prereq() for p in prereqs}
+
+    def after_export(self, queryset, data, *args, **kwargs):
+        del self.prereq_quests
 
     def dehydrate_prereq_quest_import_id(self, quest):
         # save basic single/simple prerequisite quest, if there is one.
+        if hasattr(self, 'prereq_quests'):
+            prereq_quest = self.prereq_quests.get(quest.id)
+            return prereq_quest.import_id if prereq_quest else None
         prereqs = Prereq.objects.all_parent(quest)
         for p in prereqs:
             if p.prereq_content_type == ContentType.objects.get_for_model(Quest):
@@ -104,50 +161,124 @@ class QuestResource(resources.ModelResource):
         else:
             return None
 
-    def generate_simple_prereqs(self, parent_quest, data_dict):
-        # check that the prereq quest exists as an import-linked quest via import_id
-
-        prereq_quest_import_id = data_dict["prereq_quest_import_id"]
-
-        if prereq_quest_import_id:
-            try:
-                prereq_quest = Quest.objects.get(import_id=prereq_quest_import_id)
-            except ObjectDoesNotExist:
-                return False
-
-            existing_prereqs_groups = Prereq.objects.all_parent(parent_quest)
-
-            # generate list of objects for already existing primary prereq
-            existing_primary_prereqs = [p.get_prereq() for p in existing_prereqs_groups]
-
-            # check if the imported prereq already exists
-            if prereq_quest in existing_primary_prereqs:
-                return False
-            else:
-                # Create a new prereq to this quest
-                Prereq.add_simple_prereq(parent_quest, prereq_quest)
-        return True
-
-    def generate_campaign(self, quest, data_dict):
-        campaign_title = data_dict["campaign_title"]
-        campaign_icon = data_dict["campaign_icon"]
-
-        campaign, created = Category.objects.get_or_create(
-            title=campaign_title,
-            defaults={'icon': campaign_icon},
-        )
-
-        quest.campaign = campaign
-        quest.save()
+    def before_import(self, dataset, using_transactions, dry_run, **kwargs):
+        self.pending_quests = []
+        self.pending_row_results = []
+        self.xp_before = {}
+        # the import preview shows each quest's prereq, so look them all up at once as for an export
+        import_ids = {clean_import_id(row['import_id']) for row in dataset.dict} - {None}
+        self.before_export(Quest.objects.filter(import_id__in=import_ids))
+
+    def after_import_instance(self, instance, new, **kwargs):
+        if not new:
+            self.xp_before[instance.pk] = instance.xp
+
+    def save_instance(self, instance, using_transactions=True, dry_run=False):
+        """ Quests are saved in batches by save_pending_quests() instead of one at a time """
+        self.before_save_instance(instance, using_transactions, dry_run)
+        if using_transactions or not dry_run:
+            self.pending_quests.append(instance)
+            if len(self.pending_quests) >= self.batch_size:
+                self.save_pending_quests()
+        self.after_save_instance(instance, using_transactions, dry_run)
+
+    def after_import_row(self, row, row_result, **kwargs):
+        # a new quest still waiting to be saved has no id yet for the admin log entry, fill it in once it's saved
+        if row_result.import_type == RowResult.IMPORT_TYPE_NEW and row_result.object_id is None and self.pending_quests:
+            self.pending_row_results.append((row_result, self.pending_quests[-1]))
+
+    def save_pending_quests(self):
+        """ Do what saving each quest and its pre_save signal would, then insert and update the whole batch at once """
+        quests, self.pending_quests = self.pending_quests, []
+        if not quests:
+            return
+
+        now = timezone.now()
+        for quest in quests:
+            quest.instructions = tidy_html(quest.instructions)
+            quest.datetime_next_availability_change = quest.next_availability_change()
+            quest.datetime_last_edit = now
+
+        new_quests = [quest for quest in quests if quest.pk is None]
+        updated_quests = [quest for quest in quests if quest.pk is not None]
+        Quest.objects.bulk_create(new_quests)
+        Quest.objects.bulk_update(updated_quests, [f.name for f in Quest._meta.concrete_fields if not f.primary_key])
+
+        for row_result, quest in self.pending_row_results:
+            row_result.object_id = quest.pk
+        self.pending_row_results = []
+
+        for quest in updated_quests:
+            xp_change = quest.xp - self.xp_before.pop(quest.pk, quest.xp)
+            if xp_change:
+                XPEntry.objects.record_xp_value_change(quest, xp_change)
+
+    def generate_simple_prereqs(self, quests, rows):
+        """
+        Make each row's prereq_quest_import_id quest a prereq of the row's quest, if it isn't already
+        :param quests: the imported quests and their prereq quests, by import_id
+        """
+        quest_ct = ContentType.objects.get_for_model(Quest)
+        links = set()
+        for row in rows:
+            parent_quest = quests.get(clean_import_id(row["import_id"]))
+            prereq_quest = quests.get(clean_import_id(row["prereq_quest_import_id"]))
+            if parent_quest and prereq_quest:
+                links.add((parent_quest.id, prereq_quest.id))
+
+        existing_links = set(Prereq.objects.filter(
+            parent_content_type=quest_ct, parent_object_id__in=[parent_id for parent_id, prereq_id in links],
+            prereq_content_type=quest_ct,
+        ).values_list('parent_object_id', 'prereq_object_id'))
+
+        Prereq.objects.bulk_create([
+            Prereq(parent_content_type=quest_ct, parent_object_id=parent_id,
+                   prereq_content_type=quest_ct, prereq_object_id=prereq_id)
+            for parent_id, prereq_id in links - existing_links
+        ])
+
+    def generate_campaigns(self, quests, rows):
+        """ Put each row's quest in the campaign with the row's campaign_title, creating the campaigns that are new """
+        campaign_icons = {row["campaign_title"]: row["campaign_icon"] for row in rows if row["campaign_title"]}
+        campaigns = {campaign.title: campaign for campaign in Category.objects.filter(title__in=campaign_icons)}
+        new_campaigns = [
+            Category(title=title, icon=icon) for title, icon in campaign_icons.items() if title not in campaigns
+        ]
+        # ids are returned by postgres
+        campaigns.update({campaign.title: campaign for campaign in Category.objects.bulk_create(new_campaigns)})
+
+        changed_quests = []
+        for row in rows:
+            quest = quests.get(clean_import_id(row["import_id"]))
+            campaign = campaigns.get(row["campaign_title"])
+            if quest and quest.campaign_id != (campaign.id if campaign else None):
+                quest.campaign = campaign
+                changed_quests.append(quest)
+        Quest.objects.bulk_update(changed_quests, ['campaign'])
 
     def after_import(self, dataset, result, using_transactions, dry_run, **kwargs):
-        for data_dict in dataset.dict:
-            import_id = data_dict["import_id"]
-            parent_quest = Quest.objects.get(import_id=import_id)
-
-            self.generate_simple_prereqs(parent_quest, data_dict)
-
-            self.generate_campaign(parent_quest, data_dict)
+        self.save_pending_quests()
+        del self.prereq_quests
+        if not using_transactions and dry_run:
+            return
+
+        rows = dataset.dict
+        import_ids = {clean_import_id(row["import_id"]) for row in rows}
+        import_ids |= {clean_import_id(row["prereq_quest_import_id"]) for row in rows}
+        quests = {
+            clean_import_id(quest.import_id): quest
+            for quest in Quest.objects.filter(import_id__in=import_ids - {None})
+        }
+
+        self.generate_simple_prereqs(quests, rows)
+        self.generate_campaigns(quests, rows)
+
+        # everything the quests' and prereqs' post_save signals would have started, once for the whole import
+        invalidate_prereq_graph()
+        transaction.on_commit(invalidate_prereq_graph)
+        invalidate_quest_availability()
+        transaction.on_commit(schedule_quest_availability_update)
+        update_quest_conditions_all.apply_async(args=[1], queue='default', countdown=settings.CONDITIONS_UPDATE_COUNTDOWN)
 
 
 class QuestAdmin(NonPublicSchemaOnlyAdminAccessMixin, SummernoteModelAdmin, ImportExportActionModelAdmin):  # use SummenoteModelAdmin
@@ -0,0 +1,51 @@
+import time
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from quest_manager.models import Quest
+from quest_manager.signals import prettify_html, tidy_html, tidy_html_cache_key
+
+
+class Command(BaseCommand):
+    help = ('Time tidying the instructions of the existing quests, as saving them does: parsed every time, and with '
+            'the tidy_html cache, both when it is empty and when it already has the same instructions.  '
+            'Run it for a tenant, e.g. tenant_command benchmark_tidy_html --schema=...')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=None, help='Only use this many quests')
+
+    def handle(self, *args, **options):
+        bodies = list(
+            Quest.objects.get_queryset(include_archived=True).exclude(instructions='')
+            .order_by('id').values_list('instructions', flat=True)[:options['limit']]
+        )
+        if not bodies:
+            self.stdout.write('No quests with instructions to tidy.')
+            return
+        self.stdout.write('Tidying the instructions of {} quests ({} characters)'.format(
+            len(bodies), sum(len(body) for body in bodies)))
+
+        parsed, parse_time = self.time(prettify_html, bodies)
+
+        cache.delete_many([tidy_html_cache_key(markup) for markup in bodies])
+        cached, miss_time = self.time(tidy_html, bodies)
+        # e.g. the same instructions saved from the form again, or a copy of the quest
+        repeated, hit_time = self.time(tidy_html, bodies)
+
+        self.stdout.write('  parsed every save:          {:8.1f} ms'.format(parse_time * 1000))
+        self.stdout.write('  cached, first save:         {:8.1f} ms'.format(miss_time * 1000))
+        self.stdout.write('  cached, same instructions:  {:8.1f} ms ({:.0f}x faster)'.format(
+            hit_time * 1000, parse_time / hit_time if hit_time else float('inf')))
+        self.stdout.write('  quests already tidy:        {:8d}'.format(
+            sum(body == tidy for body, tidy in zip(bodies, parsed))))
+
+        if cached != parsed or repeated != cached:
+            self.stdout.write(self.style.ERROR('Cached results differ from parsing the instructions!'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Cached results match parsing the instructions.'))
+
+    def time(self, tidy, bodies):
+        start = time.perf_counter()
+        results = [tidy(body) for body in bodies]
+        return results, time.perf_counter() - start
@@ -0,0 +1,145 @@
+import random
+import re
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from badges.models import Badge, BadgeAssertion, BadgeType
+from courses.models import Semester
+from notifications.models import Notification
+from quest_manager.models import Quest, QuestSubmission
+from siteconfig.models import SiteConfig
+
+User = get_user_model()
+
+INDEXED_MODELS = (QuestSubmission, BadgeAssertion, Notification)
+# created in SQL by quest_manager's 0018_questsubmission_keyset_indexes migration, so not in any Meta.indexes
+SQL_INDEXES = ('questsubmission_approved_idx', 'questsubmission_returned_idx')
+
+
+class Command(BaseCommand):
+    help = ('Show the query plans of the hot path QuestSubmission, BadgeAssertion and Notification queries, with and '
+            'without their indexes.  Everything (seeded data and dropped indexes) is rolled back afterwards.  '
+            'Run it for a tenant, e.g. tenant_command explain_hot_queries --schema=... --students 2000')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--students', type=int, default=0,
+                            help='Seed this many students, with submissions, badges and notifications, first')
+        parser.add_argument('--analyze', action='store_true', help='EXPLAIN ANALYZE, i.e. run the queries too')
+        parser.add_argument('--verbose-plans', action='store_true', help='Show the full plans, not just the costs')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if options['students']:
+                self.stdout.write('Seeding {} students...'.format(options['students']))
+                self.seed(options['students'])
+            with connection.cursor() as cursor:
+                for model in INDEXED_MODELS:
+                    cursor.execute('ANALYZE {}'.format(connection.ops.quote_name(model._meta.db_table)))
+
+            queries = self.get_queries()
+            after = self.explain_all(queries, options['analyze'])
+            with connection.schema_editor() as schema_editor:
+                for model in INDEXED_MODELS:
+                    for index in model._meta.indexes:
+                        schema_editor.remove_index(model, index)
+                for name in SQL_INDEXES:
+                    schema_editor.execute('DROP INDEX {}'.format(schema_editor.quote_name(name)))
+            before = self.explain_all(queries, options['analyze'])
+
+            for name in queries:
+                self.stdout.write(self.style.MIGRATE_HEADING(name))
+                self.stdout.write('  without indexes: {}'.format(self.summarize(before[name])))
+                self.stdout.write('  with indexes:    {}'.format(self.summarize(after[name])))
+                if options['verbose_plans']:
+                    self.stdout.write(self.indent(before[name]))
+                    self.stdout.write(self.indent(after[name]))
+
+            transaction.set_rollback(True)
+
+    def get_queries(self):
+        """ :return: {name: queryset} of the manager queries the indexes were added for """
+        user = QuestSubmission.objects.order_by('-id').values_list('user', flat=True).first()
+        user = User.objects.filter(id=user).first() or User.objects.first()
+        quest = Quest.objects.order_by('-id').first()
+        badge = Badge.objects.order_by('-id').first()
+        return {
+            'Submissions in progress': QuestSubmission.objects.all_not_completed(user),
+            'Submissions completed': QuestSubmission.objects.all_completed(user),
+            'Submissions of a quest': QuestSubmission.objects.all_for_user_quest(user, quest, False),
+            'Submissions awaiting approval': QuestSubmission.objects.all_awaiting_approval(),
+            # a page of the approved and returned tabs, in the order of views.paginate_keyset()
+            'Submissions approved, all semesters': QuestSubmission.objects.all_approved(
+                active_semester_only=False).order_by(F('time_approved').desc(nulls_last=True), '-id')[:31],
+            'Submissions returned': QuestSubmission.objects.all_returned().order_by(
+                F('time_returned').desc(nulls_last=True), '-id')[:31],
+            'Badge assertions of a badge': BadgeAssertion.objects.all_for_user_badge(user, badge, False),
+            'Badge assertions this semester': BadgeAssertion.objects.get_queryset(True).get_user(user).no_game_lab(),
+            'Notifications unread': Notification.objects.get_queryset().get_user(user).get_unread(),
+            'Notifications': Notification.objects.get_queryset().get_user(user),
+        }
+
+    def explain_all(self, queries, analyze):
+        return {name: qs.explain(analyze=analyze) for name, qs in queries.items()}
+
+    def summarize(self, plan):
+        cost = re.search(r'cost=[\d.]+\.\.([\d.]+)', plan)
+        summary = 'cost {}'.format(cost.group(1) if cost else '?')
+        execution_time = re.search(r'Execution Time: ([\d.]+ ms)', plan)
+        if execution_time:
+            summary += ', {}'.format(execution_time.group(1))
+        first_line = plan.splitlines()[0].split('  (')[0]
+        return '{} ({})'.format(summary, first_line.strip())
+
+    def indent(self, plan):
+        return '\n'.join('      ' + line for line in plan.splitlines())
+
+    def seed(self, num_students, num_quests=300, num_badges=50, num_semesters=4, subs_per_semester=40):
+        rand = random.Random(0)
+        now = timezone.now()
+        tag = now.strftime('%Y%m%d%H%M%S')
+
+        semesters = [Semester.objects.create(first_day=(now - timedelta(days=180 * i)).date())
+                     for i in range(num_semesters)]
+        active_semester_id = SiteConfig.get().active_semester_id
+        semester_ids = [active_semester_id] + [semester.id for semester in semesters]
+
+        quests = Quest.objects.bulk_create(
+            [Quest(name='Benchmark {} {}'.format(tag, i), max_repeats=-1) for i in range(num_quests)])
+        badge_type = BadgeType.objects.create(name='Benchmark {}'.format(tag))
+        badges = Badge.objects.bulk_create(
+            [Badge(name='Benchmark {} {}'.format(tag, i), badge_type=badge_type) for i in range(num_badges)])
+        students = User.objects.bulk_create(
+            [User(username='benchmark_{}_{}'.format(tag, i)) for i in range(num_students)])
+        user_ct = ContentType.objects.get_for_model(User)
+
+        for student in students:
+            submissions, assertions, notifications = [], [], []
+            for semester_id in semester_ids:
+                for quest in rand.sample(quests, subs_per_semester):
+                    completed = now - timedelta(days=rand.randint(0, 180 * num_semesters))
+                    state = rand.random()
+                    submissions.append(QuestSubmission(
+                        quest=quest, user=student, semester_id=semester_id,
+                        is_completed=state > 0.1, is_approved=state > 0.2,
+                        first_time_completed=completed if state > 0.05 else None,
+                        time_completed=completed if state > 0.05 else None,
+                        time_approved=completed + timedelta(days=1) if state > 0.2 else None,
+                        time_returned=completed + timedelta(days=1) if 0.05 < state <= 0.1 else None,
+                    ))
+                for badge in rand.sample(badges, 5):
+                    assertions.append(BadgeAssertion(badge=badge, user=student, semester_id=semester_id,
+                                                     game_lab_transfer=rand.random() < 0.1))
+            for i in range(50):
+                notifications.append(Notification(
+                    sender_content_type=user_ct, sender_object_id=student.id, recipient=student,
+                    verb='benchmark', unread=rand.random() < 0.2,
+                ))
+            QuestSubmission.objects.bulk_create(submissions)
+            BadgeAssertion.objects.bulk_create(assertions)
+            Notification.objects.bulk_create(notifications)
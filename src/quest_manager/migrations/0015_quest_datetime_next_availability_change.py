@@ -0,0 +1,54 @@
+from datetime import datetime, time, timedelta
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def next_availability_change(quest, now_local, tz):
+    """ A frozen copy of XPItem.next_availability_change(), migrations can't use the live model """
+    def local_datetime(date, local_time):
+        return timezone.make_aware(datetime.combine(date, local_time), tz)
+
+    available = local_datetime(quest.date_available, quest.time_available)
+    if available > now_local:
+        return available
+
+    if quest.date_expired:
+        if quest.time_expired:
+            expires = local_datetime(quest.date_expired, quest.time_expired)
+        else:
+            expires = local_datetime(quest.date_expired + timedelta(days=1), time.min)
+        return expires if expires >= now_local else None
+
+    if quest.time_expired:
+        if now_local.time() <= quest.time_expired:
+            return local_datetime(now_local.date(), quest.time_expired)
+        return local_datetime(now_local.date() + timedelta(days=1), time.min)
+
+    return None
+
+
+def forwards(apps, schema_editor):
+    Quest = apps.get_model('quest_manager', 'Quest')
+    tz = timezone.get_default_timezone()
+    now_local = timezone.now().astimezone(tz)
+    quests = list(Quest.objects.all())
+    for quest in quests:
+        quest.datetime_next_availability_change = next_availability_change(quest, now_local, tz)
+    Quest.objects.bulk_update(quests, ['datetime_next_availability_change'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quest_manager', '0014_auto_20200407_0814'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='quest',
+            name='datetime_next_availability_change',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
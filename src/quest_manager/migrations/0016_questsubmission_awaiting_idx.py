@@ -0,0 +1,16 @@
+from django.db import migrations, models
+import django.db.models.query_utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quest_manager', '0015_quest_datetime_next_availability_change'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='questsubmission',
+            index=models.Index(condition=django.db.models.query_utils.Q(('is_approved', False), ('is_completed', True)), fields=['semester', 'time_completed'], name='questsubmission_awaiting_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+from django.db import migrations, models
+import django.db.models.query_utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quest_manager', '0016_questsubmission_awaiting_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='questsubmission',
+            index=models.Index(fields=['user', 'quest', 'ordinal'], name='questsubmission_user_quest_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='questsubmission',
+            index=models.Index(fields=['user', 'semester', 'is_completed', 'is_approved'], name='questsubmission_user_sem_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='questsubmission',
+            index=models.Index(condition=django.db.models.query_utils.Q(('is_approved', True)), fields=['semester', 'time_approved'], name='questsubmission_approved_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='questsubmission',
+            index=models.Index(condition=django.db.models.query_utils.Q(('is_completed', False), ('time_completed__isnull', False)), fields=['semester', 'time_returned'], name='questsubmission_returned_idx'),
+        ),
+    ]
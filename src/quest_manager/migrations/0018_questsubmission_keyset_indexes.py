@@ -0,0 +1,48 @@
+from django.db import migrations
+
+
+# The approved and returned tabs page through submissions with views.paginate_keyset(), ordered by
+# (time_approved / time_returned DESC NULLS LAST, id DESC).  Index can't express that order before Django 3.2,
+# so the indexes are recreated in SQL and removed from the model state.
+CREATE_KEYSET_INDEXES = [
+    'DROP INDEX IF EXISTS questsubmission_approved_idx;',
+    'CREATE INDEX questsubmission_approved_idx ON quest_manager_questsubmission '
+    '(time_approved DESC NULLS LAST, id DESC) WHERE is_approved;',
+    'DROP INDEX IF EXISTS questsubmission_returned_idx;',
+    'CREATE INDEX questsubmission_returned_idx ON quest_manager_questsubmission '
+    '(semester_id, time_returned DESC NULLS LAST, id DESC) WHERE NOT is_completed AND time_completed IS NOT NULL;',
+]
+
+RESTORE_INDEXES = [
+    'DROP INDEX IF EXISTS questsubmission_approved_idx;',
+    'CREATE INDEX questsubmission_approved_idx ON quest_manager_questsubmission '
+    '(semester_id, time_approved) WHERE is_approved;',
+    'DROP INDEX IF EXISTS questsubmission_returned_idx;',
+    'CREATE INDEX questsubmission_returned_idx ON quest_manager_questsubmission '
+    '(semester_id, time_returned) WHERE NOT is_completed AND time_completed IS NOT NULL;',
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quest_manager', '0017_questsubmission_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(CREATE_KEYSET_INDEXES, reverse_sql=RESTORE_INDEXES),
+            ],
+            state_operations=[
+                migrations.RemoveIndex(
+                    model_name='questsubmission',
+                    name='questsubmission_approved_idx',
+                ),
+                migrations.RemoveIndex(
+                    model_name='questsubmission',
+                    name='questsubmission_returned_idx',
+                ),
+            ],
+        ),
+    ]
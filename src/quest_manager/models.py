@@ -1,21 +1,22 @@
 import uuid
-import json
+from datetime import datetime, time, timedelta
 
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericRelation
-from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
-from django.db import models
-from django.db.models import Q, Max, Sum
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models import Count, Exists, F, OuterRef, Q, Max, Min, Sum
 # from django.shortcuts import get_object_or_404
 # from django.templatetags.static import static
 from django.urls import reverse
 from django.utils import timezone, datetime_safe
+from django_redis import get_redis_connection
 
 from siteconfig.models import SiteConfig
 
 from badges.models import BadgeAssertion
 from comments.models import Comment
-from prerequisites.models import Prereq, IsAPrereqMixin, HasPrereqsMixin, PrereqAllConditionsMet
+from prerequisites.models import Prereq, IsAPrereqMixin, HasPrereqsMixin, PrereqAllConditionsMet, users_with_at_least
 # from utilities.models import ImageResource
 
 # from django.contrib.contenttypes.models import ContentType
@@ -130,6 +131,37 @@ class XPItem(models.Model):
 
         return self.visible_to_students and not self.expired()
 
+    def next_availability_change(self, now=None):
+        """
+        :return: the next moment (timezone aware, from now on) at which the date and time window checked by `active`
+            opens or closes.  Expiry happens just after that moment.  None if the window won't change again.
+        """
+        tz = timezone.get_default_timezone()
+        now_local = (now or timezone.now()).astimezone(tz)
+
+        def local_datetime(date, local_time):
+            return timezone.make_aware(datetime.combine(date, local_time), tz)
+
+        # not available yet
+        available = local_datetime(self.date_available, self.time_available)
+        if available > now_local:
+            return available
+
+        if self.date_expired:
+            if self.time_expired:
+                expires = local_datetime(self.date_expired, self.time_expired)
+            else:  # after the date (midnight)
+                expires = local_datetime(self.date_expired + timedelta(days=1), time.min)
+            return expires if expires >= now_local else None
+
+        # daily expiration at set time, and back at midnight
+        if self.time_expired:
+            if now_local.time() <= self.time_expired:
+                return local_datetime(now_local.date(), self.time_expired)
+            return local_datetime(now_local.date() + timedelta(days=1), time.min)
+
+        return None
+
     def is_available(self, user):
         """This quest should be in the user's available tab.  Doesn't check exactly, but same criteria.
         Should probably put criteria in one spot and share.  See QuestManager.get_available()"""
@@ -146,8 +178,12 @@ class QuestQuerySet(models.query.QuerySet):
         self.debug_object_list = list(self)
 
     def exclude_hidden(self, user):
-        """ Users can "hide" quests.  This is stored in their profile as a list of quest ids """
-        return self.exclude(pk__in=user.profile.get_hidden_quests_as_list())
+        """ Users can "hide" quests, see profile_manager.models.HiddenQuest.  An anti-join on their hidden quests """
+        # import here to prevent circular imports
+        from profile_manager.models import HiddenQuest
+
+        hidden = HiddenQuest.objects.filter(user_id=user.id, quest_id=OuterRef('pk'))
+        return self.annotate(hidden_by_user=Exists(hidden)).filter(hidden_by_user=False)
 
     def block_if_needed(self, user=None):
         """ If there are blocking quests or blocking subs in progress, only return blocking quests.
@@ -214,13 +250,12 @@ class QuestQuerySet(models.query.QuerySet):
         :param user:
         :return: A queryset of the prerequisite's that have been met so far
         """
-        pk_met_list = self.get_pk_met_list(user) or [0]
-        return self.filter(pk__in=pk_met_list)
+        return self.filter(pk__in=self.get_met_lists(user).met_ids())
 
     def get_list_not_submitted_or_inprogress(self, user):
         quest_list = list(self)
-        # http://stackoverflow.com/questions/1207406/remove-items-from-a-list-while-iterating-in-python
-        return [q for q in quest_list if QuestSubmission.objects.not_submitted_or_inprogress(user, q)]
+        summaries = QuestSubmission.objects.get_summaries(user, quest_list)
+        return [q for q in quest_list if q.not_submitted_or_inprogress(summaries.get(q.id))]
 
     def not_submitted_or_inprogress(self, user):
         quest_list = self.get_list_not_submitted_or_inprogress(user)
@@ -249,14 +284,75 @@ class QuestQuerySet(models.query.QuerySet):
         else:
             return self.filter(editor=user.id)
 
-    def get_pk_met_list(self, user):
-        model_name = '{}.{}'.format(Quest._meta.app_label, Quest._meta.model_name)
-        pk_met_list = PrereqAllConditionsMet.objects.filter(user=user, model_name=model_name).first()
-        if not pk_met_list:
+    def get_met_lists(self, user):
+        """
+        :return: a queryset of the user's PrereqAllConditionsMet for quests, creating it first if it doesn't exist yet
+        """
+        met_lists = PrereqAllConditionsMet.objects.filter(user=user, model_name=Quest.get_model_name())
+        if not met_lists.exists():
             from prerequisites.tasks import update_quest_conditions_for_user
-            pk_met_list = update_quest_conditions_for_user(user.id)
-            pk_met_list = PrereqAllConditionsMet.objects.get(id=pk_met_list)
-        return json.loads(pk_met_list.ids)
+            update_quest_conditions_for_user(user.id)
+        return met_lists
+
+    def get_pk_met_list(self, user):
+        return self.get_met_lists(user).first().get_ids()
+
+
+QUEST_AVAILABILITY_VERSION_CACHE_KEY = 'quest_availability_version'
+QUEST_ACTIVE_IDS_CACHE_KEY = 'quest_active_ids'
+
+
+def get_quest_availability_version():
+    """
+    :return: a key that changes whenever the availability of quests may have changed: when a quest is saved or deleted,
+        or when one becomes available or expires (see quest_manager.tasks.update_quest_availability).
+        Caches of quest availability can include it in their keys and live for as long as it doesn't change.
+    """
+    version = cache.get(QUEST_AVAILABILITY_VERSION_CACHE_KEY)
+    if version is None:
+        version = invalidate_quest_availability()
+    return version
+
+
+def invalidate_quest_availability():
+    version = uuid.uuid4().hex
+    cache.set(QUEST_AVAILABILITY_VERSION_CACHE_KEY, version, None)
+    return version
+
+
+QUEST_CARD_VERSION_CACHE_KEY = 'quest_card_version'
+
+
+def get_quest_card_version():
+    """
+    :return: a key that changes whenever something shown on every quest's card, other than the quest itself, changes:
+        a campaign or the site's default icon.  Part of the key of the cached quest cards in the Available quests tab,
+        along with the quest's datetime_last_edit.
+    """
+    version = cache.get(QUEST_CARD_VERSION_CACHE_KEY)
+    if version is None:
+        version = invalidate_quest_cards()
+    return version
+
+
+def invalidate_quest_cards():
+    version = uuid.uuid4().hex
+    cache.set(QUEST_CARD_VERSION_CACHE_KEY, version, None)
+    return version
+
+
+AVAILABLE_QUESTS_USER_VERSION_CACHE_KEY = 'available_quests_user_version_{}'
+AVAILABLE_QUESTS_CACHE_KEY = 'available_quests_{}_{}_{}'
+
+
+def invalidate_available_quests(user_id):
+    """
+    Call when something that affects which quests are available to the user changes: their submissions, badges,
+    courses, hidden quests or met prerequisites.  See QuestManager.get_available_ids()
+    """
+    version = uuid.uuid4().hex
+    cache.set(AVAILABLE_QUESTS_USER_VERSION_CACHE_KEY.format(user_id), version, None)
+    return version
 
 
 class QuestManager(models.Manager):
@@ -269,7 +365,111 @@ class QuestManager(models.Manager):
     def get_active(self):
         return self.get_queryset().datetime_available().not_expired().visible()
 
+    def get_active_ids(self):
+        """
+        :return: the set of ids of get_active(), cached until the availability of quests changes
+        """
+        return self._get_active_ids_until()[0]
+
+    def _get_active_ids_until(self):
+        """
+        :return: (the set of ids of get_active(), the moment it stops being valid or None)
+        """
+        # a single entry tagged with the version (like get_available_ids()), so old versions don't pile up in the cache
+        version = get_quest_availability_version()
+        entry = cache.get(QUEST_ACTIVE_IDS_CACHE_KEY)
+        # Also checked here, in case the scheduled update_quest_availability is late
+        if entry is None or entry['version'] != version or \
+                (entry['valid_until'] is not None and entry['valid_until'] <= timezone.now()):
+            entry = {
+                'version': version,
+                'ids': set(self.get_active().values_list('id', flat=True)),
+                'valid_until': self.get_next_availability_change(),
+            }
+            cache.set(QUEST_ACTIVE_IDS_CACHE_KEY, entry, None)
+        return entry['ids'], entry['valid_until']
+
+    def get_next_availability_change(self, now=None):
+        """
+        :return: the next moment a visible quest becomes available or expires, None if none ever will.  Quests whose
+            stored datetime_next_availability_change has passed are worked out again, but not saved: that's left to
+            update_next_availability_changes(), from the scheduled quest_manager.tasks.update_quest_availability
+        """
+        now = now or timezone.now()
+        upcoming = self.get_queryset().visible().filter(datetime_next_availability_change__gt=now)
+        changes = [
+            upcoming.aggregate(Min('datetime_next_availability_change'))['datetime_next_availability_change__min']
+        ]
+        passed = self.get_queryset().visible().filter(datetime_next_availability_change__lte=now)
+        changes += [quest.next_availability_change(now) for quest in passed]
+        changes = [change for change in changes if change is not None]
+        return min(changes) if changes else None
+
+    def update_next_availability_changes(self):
+        """
+        Recompute the datetime_next_availability_change of the quests whose stored one has passed.
+        :return: the next moment a visible quest becomes available or expires, None if none ever will
+        """
+        now = timezone.now()
+        passed = list(self.get_queryset().filter(datetime_next_availability_change__lte=now))
+        for quest in passed:
+            quest.datetime_next_availability_change = quest.next_availability_change(now)
+        self.bulk_update(passed, ['datetime_next_availability_change'])
+
+        return self.get_next_availability_change(now)
+
     def get_available(self, user, remove_hidden=True, blocking=True):
+        """ Quests that should appear in the user's Available quests tab, see get_available_ids() """
+        return self.get_queryset().filter(pk__in=self.get_available_ids(user, remove_hidden, blocking))\
+            .select_related('campaign')
+
+    def get_available_ids(self, user, remove_hidden=True, blocking=True):
+        """
+        :return: the ids of _get_available(), cached per user.  The cached ids are tagged with the quest availability
+            version and the user's version (see invalidate_available_quests()), so a warm call is one cache read.
+            They also expire when a completed repeatable quest's time between repeats runs out.
+        """
+        version_keys = [QUEST_AVAILABILITY_VERSION_CACHE_KEY, AVAILABLE_QUESTS_USER_VERSION_CACHE_KEY.format(user.id)]
+        key = AVAILABLE_QUESTS_CACHE_KEY.format(user.id, int(remove_hidden), int(blocking))
+        cached = cache.get_many(version_keys + [key])
+        versions = (
+            cached.get(version_keys[0]) or get_quest_availability_version(),
+            cached.get(version_keys[1]) or invalidate_available_quests(user.id),
+        )
+
+        entry = cached.get(key)
+        if entry is None or entry['versions'] != versions or \
+                (entry['valid_until'] is not None and entry['valid_until'] <= timezone.now()):
+            active_ids, valid_until = self._get_active_ids_until()
+            next_repeat = self._next_repeat_available(user, active_ids)
+            if next_repeat is not None and (valid_until is None or next_repeat < valid_until):
+                valid_until = next_repeat
+            entry = {
+                'versions': versions,
+                'ids': list(self._get_available(user, remove_hidden, blocking).values_list('id', flat=True)),
+                'valid_until': valid_until,
+            }
+            cache.set(key, entry, None)
+        return entry['ids']
+
+    def _next_repeat_available(self, user, quest_ids):
+        """
+        :return: the next moment the time between repeats of one of the quests, completed by the user, runs out
+        """
+        now = timezone.now()
+        quests = list(self.get_queryset().filter(pk__in=quest_ids, hours_between_repeats__gt=0))
+        summaries = QuestSubmission.objects.get_summaries(user, quests)
+
+        next_repeat = None
+        for quest in quests:
+            time_of_last = summaries.get(quest.id, {}).get('latest_first_time_completed')
+            if time_of_last:
+                repeat_time = time_of_last + timedelta(hours=quest.hours_between_repeats)
+                if now < repeat_time and (next_repeat is None or repeat_time < next_repeat):
+                    next_repeat = repeat_time
+        return next_repeat
+
+    def _get_available(self, user, remove_hidden=True, blocking=True):
         """ Quests that should appear in the user's Available quests tab.   Should exclude:
         1. Quests whose available date & time has not past, or quest that have expired
         2. Quests that are not visible to students or archived
@@ -279,7 +479,7 @@ class QuestManager(models.Manager):
         6. Quests who's repeat time has not passed since last completion
         7. Check for blocking quests (available and in-progress), if present, remove all others
         """
-        qs = self.get_active().select_related('campaign')  # exclusions 1 & 2
+        qs = self.get_queryset().filter(pk__in=self.get_active_ids()).select_related('campaign')  # exclusions 1 & 2
         qs = qs.get_conditions_met(user)  # 3
         available_quests = qs.not_submitted_or_inprogress(user)  # 4,5 & 6
 
@@ -289,7 +489,8 @@ class QuestManager(models.Manager):
         return available_quests
 
     def get_available_without_course(self, user):
-        qs = self.get_active().get_conditions_met(user).available_without_course()
+        qs = self.get_queryset().filter(pk__in=self.get_active_ids())
+        qs = qs.get_conditions_met(user).available_without_course()
         return qs.get_list_not_submitted_or_inprogress(user)
 
     def all_drafts(self, user):
@@ -339,6 +540,10 @@ class Quest(XPItem, IsAPrereqMixin, HasPrereqsMixin):
                                    help_text="When this quest becomes available, it will block all other "
                                              "non-blocking quests until this it is completed")
 
+    # Precomputed next_availability_change(), kept up to date on save and by
+    # quest_manager.tasks.update_quest_availability
+    datetime_next_availability_change = models.DateTimeField(blank=True, null=True, editable=False, db_index=True)
+
     # What does this do to help us?
     prereq_parent = GenericRelation(Prereq,
                                     content_type_field='parent_content_type',
@@ -368,27 +573,38 @@ class Quest(XPItem, IsAPrereqMixin, HasPrereqsMixin):
 
     def is_repeat_available(self, user):
         "Assumes one submission has already been completed"
-        latest_sub = QuestSubmission.objects.all_for_user_quest(user, self, False).latest('first_time_completed')
-        time_of_last = latest_sub.first_time_completed
+        summary = QuestSubmission.objects.get_summaries(user, [self]).get(self.id)
+        return self.repeat_available(summary)
 
-        # happens if submission hasn't been completed yet. i.e. still in progress.
-        if not time_of_last:
+    def not_submitted_or_inprogress(self, summary):
+        """
+        :param summary: the user's submission summary for this quest, from QuestSubmissionManager.get_summaries()
+        :return: True if the quest has not been started, or if it has been completed already
+        or if it is a repeatable quest past the repeat time
+        """
+        if summary is None:
+            return True
+        # check if the quest is already in progress
+        if summary['num_in_progress']:
             return False
 
-        # # to handle cases before first_time_completed existed as a property
-        # if not latest_dt:
-        #     # then latest_sub could be wrong.  Need to get latest completed date
-        #     latest_sub = self.all_for_user_quest(user, quest, False).latest('time_completed')
-        #     latest_dt = latest_sub.time_completed
+        # Handle repeatable quests with past submissions
+        return self.repeat_available(summary)
+
+    def repeat_available(self, summary):
+        """ is_repeat_available() from the user's submission summary, see QuestSubmissionManager.get_summaries() """
+        # happens if a submission hasn't been completed yet. i.e. still in progress.
+        if summary is None or summary['num_never_completed']:
+            return False
+        time_of_last = summary['latest_first_time_completed']
 
         # if haven't maxed out repeats
 
         if self.repeat_per_semester:
-            # get all completed this semester
-            qs = QuestSubmission.objects.all_completed(user=user).filter(quest=self)
-            if qs.count() > self.max_repeats:
+            # all completed this semester
+            if summary['num_completed_this_semester'] > self.max_repeats:
                 return False
-        elif latest_sub.ordinal > self.max_repeats and self.max_repeats != -1:
+        elif summary['max_ordinal'] > self.max_repeats and self.max_repeats != -1:
             return False
 
         # Haven't maxed out yet, so check times
@@ -411,6 +627,10 @@ class Quest(XPItem, IsAPrereqMixin, HasPrereqsMixin):
         # print("num_approved: " + str(num_approved) + "/" + str(num_required))
         return num_approved >= num_required
 
+    def users_meeting_condition_as_prerequisite(self, user_ids, num_required=1):
+        approved_submissions = QuestSubmission.objects.get_queryset(False).get_quest(self).approved()
+        return users_with_at_least(approved_submissions, num_required, user_ids)
+
     def is_editable(self, user):
         if user.is_staff:
             return True
@@ -476,19 +696,15 @@ class QuestSubmissionQuerySet(models.query.QuerySet):
         if teacher is None:
             return self
         else:
-            # Why doesn't this work?!? it only works for some teachers? with or without pk
-            # return self.filter(user__coursestudent__block__current_teacher=teacher).distinct()
-            pk_sub_list = [
-                sub.pk for sub in self
-                if teacher.pk in sub.user.profile.teachers() or sub.quest.specific_teacher_to_notify == teacher
-            ]
+            from courses.models import CourseStudent  # import here to prevent circular imports
 
-            # pk_sub_list += [
-            #     sub.pk for sub in self
-            #     if
-            # ]
-
-            return self.filter(pk__in=pk_sub_list)
+            # Students in the teacher's blocks this semester, i.e. the users whose profile.teachers() includes them.
+            # A subquery rather than a join, so submissions of students in several of the teacher's blocks aren't
+            # duplicated.  Covered by CourseStudent's (semester, block, user) unique index.
+            students = CourseStudent.objects.filter(
+                semester=SiteConfig.get().active_semester_id, block__current_teacher=teacher
+            ).values('user_id')
+            return self.filter(Q(user_id__in=students) | Q(quest__specific_teacher_to_notify=teacher))
 
     def exclude_archived_quests(self):
         return self.exclude(quest__archived=True)
@@ -497,6 +713,12 @@ class QuestSubmissionQuerySet(models.query.QuerySet):
         return self.exclude(quest__visible_to_students=False)
 
 
+# Autosaved drafts are kept in the cache until flushed to QuestSubmission.draft_text, see QuestSubmission.save_draft()
+SUBMISSION_DRAFT_CACHE_KEY = 'submission_draft_{}'
+# a redis set of the ids of the submissions with drafts that haven't been flushed yet
+SUBMISSION_DRAFTS_PENDING_CACHE_KEY = 'submission_drafts_pending'
+
+
 class QuestSubmissionManager(models.Manager):
     def get_queryset(self,
                      active_semester_only=False,
@@ -603,11 +825,8 @@ class QuestSubmissionManager(models.Manager):
         # is false, it must have been returned.
         if user is None:
             returned_qs = self.get_queryset(True).not_completed().has_completion_date()
-            # postgres places null values at the beginning.  This will move them to the extend
-            # see: http://stackoverflow.com/questions/15121093/django-adding-nulls-last-to-query
-            q = returned_qs.extra(select={'date_null': 'time_returned is null'})
-            return q.extra(order_by=['date_null', '-time_returned'])
-            # return returned_qs
+            # postgres places null values at the beginning.  This will move them to the end
+            return returned_qs.order_by(F('time_returned').desc(nulls_last=True))
         return self.get_queryset(True).get_user(user).not_completed().has_completion_date().order_by('-time_returned')
 
     def all_for_user_quest(self, user, quest, active_semester_only):
@@ -621,6 +840,26 @@ class QuestSubmissionManager(models.Manager):
         else:
             return 0
 
+    def get_summaries(self, user, quests):
+        """
+        Summarize the user's submissions (from all semesters) of each of the quests in a single grouped query.
+        :return: a dict of summaries keyed by quest id, for the quests the user has submissions for:
+            max_ordinal: the number of submissions
+            num_in_progress: submissions started but not completed in the active semester
+            num_never_completed: submissions with no first_time_completed
+            latest_first_time_completed: the first_time_completed of the latest submission
+            num_completed_this_semester: submissions completed in the active semester
+        """
+        active_semester_id = SiteConfig.get().active_semester_id
+        qs = self.get_queryset().get_user(user).filter(quest__in=quests).order_by().values('quest_id').annotate(
+            max_ordinal=Max('ordinal'),
+            num_in_progress=Count('id', filter=Q(semester_id=active_semester_id, is_completed=False)),
+            num_never_completed=Count('id', filter=Q(first_time_completed=None)),
+            latest_first_time_completed=Max('first_time_completed'),
+            num_completed_this_semester=Count('id', filter=Q(semester_id=active_semester_id, is_completed=True)),
+        )
+        return {summary['quest_id']: summary for summary in qs}
+
     def quest_is_available(self, user, quest):
         """
         :return: True if the quest should appear on the user's available quests tab
@@ -633,22 +872,7 @@ class QuestSubmissionManager(models.Manager):
         :return: True if the quest has not been started, or if it has been completed already
         or if it is a repeatable quest past the repeat time
         """
-        num_subs = self.num_submissions(user, quest)
-        if num_subs == 0:
-            return True
-        # check if the quest is already in progress
-        try:
-            self.all_not_completed(user=user).get(quest=quest)
-            # if no exception is thrown it means that an inprogress submission was found
-            return False
-        except MultipleObjectsReturned:
-            return False  # multiple found
-        except ObjectDoesNotExist:
-            pass  # nothing found, continue
-
-        # Handle repeatable quests with past submissions
-
-        return quest.is_repeat_available(user)
+        return quest.not_submitted_or_inprogress(self.get_summaries(user, [quest]).get(quest.id))
 
     def create_submission(self, user, quest):
         # this logic should probably be removed from this location?
@@ -666,6 +890,85 @@ class QuestSubmissionManager(models.Manager):
         else:
             return None
 
+    def approve_submissions(self, submissions, transfer=False):
+        """
+        QuestSubmission.mark_approved() for many submissions in one transaction: a single update and XP ledger write,
+        then badges, available quests and prerequisite conditions are recalculated once per student.
+        :return: the submissions, updated
+        """
+        now = timezone.now()
+        fields = {'is_completed': True, 'is_approved': True, 'time_approved': now, 'game_lab_transfer': transfer}
+        return self._bulk_update_submissions(submissions, fields, check_badges=True, transfer=transfer)
+
+    def return_submissions(self, submissions):
+        """ QuestSubmission.mark_returned() for many submissions, see approve_submissions() """
+        now = timezone.now()
+        fields = {'is_completed': False, 'is_approved': False, 'game_lab_transfer': False, 'time_returned': now}
+        return self._bulk_update_submissions(submissions, fields)
+
+    def _bulk_update_submissions(self, submissions, fields, check_badges=False, transfer=False):
+        # import here to prevent circular imports
+        from prerequisites.graph import get_changed_targets
+        from prerequisites.tasks import schedule_quest_conditions_for_user
+        from profile_manager.models import XPEntry, xp_contribution
+
+        submissions = list(submissions)
+        with transaction.atomic():
+            # bypasses save() and its signals, so everything they would do is done below, per student
+            self.model.objects.filter(pk__in=[sub.pk for sub in submissions]).update(updated=timezone.now(), **fields)
+
+            submissions_by_user = {}
+            xp_changes = []
+            for sub in submissions:
+                xp_before = xp_contribution(sub)
+                for field, value in fields.items():
+                    setattr(sub, field, value)
+                xp_changes.append((sub, xp_before, xp_contribution(sub)))
+                submissions_by_user.setdefault(sub.user, []).append(sub)
+            XPEntry.objects.record_changes(xp_changes)
+
+            for user, user_submissions in submissions_by_user.items():
+                if check_badges:
+                    BadgeAssertion.objects.check_for_new_assertions(user, transfer=transfer)
+                invalidate_available_quests(user.id)
+                targets = {target for sub in user_submissions for target in get_changed_targets(sub)}
+                schedule_quest_conditions_for_user(user.id, list(targets))
+        return submissions
+
+    def flush_drafts(self, submission_ids=None):
+        """
+        Write the drafts waiting in the draft store to draft_text: all of them, or only those of the submissions given.
+        A single bulk update, so without post_save: prerequisite conditions aren't updated and `updated` isn't bumped.
+        :return: the number of drafts written
+        """
+        redis = get_redis_connection()
+        pending_key = cache.make_key(SUBMISSION_DRAFTS_PENDING_CACHE_KEY)
+        # taken off the pending set before reading them, so a draft saved meanwhile is pending again for the next flush
+        if submission_ids is None:
+            ids = redis.spop(pending_key, redis.scard(pending_key)) or []
+        else:
+            submission_ids = list(submission_ids)
+            with redis.pipeline() as pipe:
+                for submission_id in submission_ids:
+                    pipe.srem(pending_key, submission_id)
+                removed = pipe.execute()
+            ids = [submission_id for submission_id, was_pending in zip(submission_ids, removed) if was_pending]
+
+        keys = {int(submission_id): SUBMISSION_DRAFT_CACHE_KEY.format(int(submission_id)) for submission_id in ids}
+        drafts = cache.get_many(keys.values())
+        # drafts evicted from the cache before they could be flushed are lost, the previous one stays in draft_text
+        submissions = [
+            self.model(pk=submission_id, draft_text=drafts[key])
+            for submission_id, key in keys.items() if key in drafts
+        ]
+        self.bulk_update(submissions, ['draft_text'])
+        return len(submissions)
+
+    def flush_drafts_for_user(self, user):
+        submission_ids = self.get_queryset(exclude_archived_quests=False, exclude_quests_not_visible_to_students=False)\
+            .get_user(user).filter(is_completed=False).values_list('id', flat=True)
+        return self.flush_drafts(submission_ids)
+
     def calculate_xp(self, user):
         total_xp = self.all_approved(user).no_game_lab().aggregate(Sum('quest__xp'))
         xp = total_xp['quest__xp__sum']
@@ -715,11 +1018,17 @@ class QuestSubmissionManager(models.Manager):
             sub.semester_id = SiteConfig.get().active_semester.id
             sub.save()
 
-    def remove_in_progress(self):
-        # In Progress Quests
-        qs = self.all_not_completed(active_semester_only=False)
-        num_del = qs.delete()
-        return num_del
+    def remove_in_progress(self, batch_size=None):
+        """
+        Delete the quests that were started but not completed, in bulk and without their delete signals.
+        :param batch_size: only delete up to this many of them
+        :return: the number deleted
+        """
+        ids = self.all_not_completed(active_semester_only=False).order_by('id').values_list('id', flat=True)
+        ids = list(ids[:batch_size] if batch_size else ids)
+        # nothing has a foreign key to a submission, so there's nothing to cascade and they don't need to be collected
+        self.model._base_manager.filter(id__in=ids)._raw_delete(self.db)
+        return len(ids)
 
 
 class QuestSubmission(models.Model):
@@ -747,6 +1056,20 @@ class QuestSubmission(models.Model):
 
     class Meta:
         ordering = ["time_approved", "time_completed"]
+        indexes = [
+            # a user's submissions of a quest, e.g. all_for_user_quest(), get_summaries() and num_submissions()
+            models.Index(fields=['user', 'quest', 'ordinal'], name='questsubmission_user_quest_idx'),
+            # a user's in progress, completed and approved tabs and XP, in the active semester
+            models.Index(fields=['user', 'semester', 'is_completed', 'is_approved'],
+                         name='questsubmission_user_sem_idx'),
+            # the approvals queue, see QuestSubmissionManager.all_awaiting_approval()
+            models.Index(fields=['semester', 'time_completed'], name='questsubmission_awaiting_idx',
+                         condition=Q(is_completed=True, is_approved=False)),
+            # The approved and returned tabs, see all_approved(), all_returned() and views.paginate_keyset(), have
+            # questsubmission_approved_idx and questsubmission_returned_idx too.  They are in the keyset order
+            # (... DESC NULLS LAST, id DESC), which Index can't express before Django 3.2, so they are created by
+            # migration 0018_questsubmission_keyset_indexes instead.
+        ]
 
     objects = QuestSubmissionManager()
 
@@ -780,8 +1103,48 @@ class QuestSubmission(models.Model):
         if self.first_time_completed is None:
             self.first_time_completed = self.time_completed
         self.draft_text = None  # clear draft stuff
+        self.discard_draft()
         self.save()
 
+    def save_draft(self, draft_text):
+        """
+        Autosave the draft into the draft store, from where it is flushed to draft_text (by
+        quest_manager.tasks.flush_submission_drafts soon after, or when the student logs out), instead of saving the
+        submission and sending its signals every few seconds while the student types.
+        """
+        # import here to prevent circular imports
+        from .tasks import schedule_submission_drafts_flush
+
+        if len(draft_text or '') > settings.SUBMISSION_DRAFT_MAX_LENGTH:
+            # too big to keep in the cache, write it straight to the database instead
+            self.discard_draft()
+            QuestSubmission.objects.filter(pk=self.pk).update(draft_text=draft_text)
+            self.draft_text = draft_text
+            return
+
+        cache.set(SUBMISSION_DRAFT_CACHE_KEY.format(self.pk), draft_text, settings.SUBMISSION_DRAFT_TIMEOUT)
+        redis = get_redis_connection()
+        pending_key = cache.make_key(SUBMISSION_DRAFTS_PENDING_CACHE_KEY)
+        with redis.pipeline() as pipe:
+            pipe.sadd(pending_key, self.pk)
+            pipe.scard(pending_key)
+            added, num_pending = pipe.execute()
+
+        if num_pending > settings.SUBMISSION_DRAFT_MAX_PENDING:
+            QuestSubmission.objects.flush_drafts()
+        else:
+            schedule_submission_drafts_flush()
+
+    def get_draft_text(self):
+        """ :return: the latest draft, from the draft store if it's there, otherwise as last flushed to draft_text """
+        draft_text = cache.get(SUBMISSION_DRAFT_CACHE_KEY.format(self.pk))
+        return self.draft_text if draft_text is None else draft_text
+
+    def discard_draft(self):
+        """ Remove the draft from the draft store without flushing it, e.g. once it has been submitted """
+        cache.delete(SUBMISSION_DRAFT_CACHE_KEY.format(self.pk))
+        get_redis_connection().srem(cache.make_key(SUBMISSION_DRAFTS_PENDING_CACHE_KEY), self.pk)
+
     def mark_approved(self, transfer=False):
         self.is_completed = True  # might have been false if returned
         self.is_approved = True
@@ -790,7 +1153,6 @@ class QuestSubmission(models.Model):
         self.save()
         # update badges
         BadgeAssertion.objects.check_for_new_assertions(self.user, transfer=transfer)
-        self.user.profile.xp_invalidate_cache()  # recalculate XP
 
     def mark_returned(self):
         self.is_completed = False
@@ -798,7 +1160,6 @@ class QuestSubmission(models.Model):
         self.game_lab_transfer = False
         self.time_returned = timezone.now()
         self.save()
-        self.user.profile.xp_invalidate_cache()  # recalculate XP
 
     def is_awaiting_approval(self):
         return self.is_completed and not self.is_approved
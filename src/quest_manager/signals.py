@@ -1,10 +1,22 @@
+import hashlib
 import re
 
 from bs4 import BeautifulSoup
-from django.db.models.signals import pre_save
+from django.contrib.auth.signals import user_logged_out
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
+from tenant_schemas.utils import get_public_schema_name
 
-from quest_manager.models import Quest
+from badges.models import BadgeAssertion
+from courses.models import CourseStudent
+from prerequisites.models import PrereqAllConditionsMet
+from quest_manager.models import (
+    Category, Quest, QuestSubmission, invalidate_available_quests, invalidate_quest_availability, invalidate_quest_cards
+)
+from quest_manager.tasks import schedule_quest_availability_update
+from siteconfig.models import SiteConfig
 
 
 class UglySoup(BeautifulSoup):
@@ -34,10 +46,72 @@ class UglySoup(BeautifulSoup):
 
 @receiver(pre_save, sender=Quest)
 def quest_pre_save_callback(sender, instance, **kwargs):
-    instance.instructions = tidy_html(instance.instructions)
+    # Stored instructions were tidied when they were saved.  Tidying isn't idempotent (it re-indents the text of
+    # <pre> blocks), so instructions that haven't changed since the previous save are left as they are.
+    if instance.pk is None or instance.instructions != saved_instructions(instance.pk):
+        instance.instructions = tidy_html(instance.instructions)
+    instance.datetime_next_availability_change = instance.next_availability_change()
+
+
+@receiver([post_save, post_delete], sender=Quest)
+def quest_availability_changed(sender, instance, **kwargs):
+    invalidate_quest_availability()
+    transaction.on_commit(schedule_quest_availability_update)
+
+
+@receiver([post_save, post_delete], sender=SiteConfig)
+def site_config_changed(sender, instance, **kwargs):
+    # e.g. the active semester changed
+    invalidate_quest_availability()
+    # e.g. the default icon changed
+    invalidate_quest_cards()
+
+
+@receiver([post_save, post_delete], sender=Category)
+def campaign_changed(sender, instance, **kwargs):
+    invalidate_quest_cards()
+
+
+@receiver([post_save, post_delete], sender=QuestSubmission)
+@receiver([post_save, post_delete], sender=BadgeAssertion)
+@receiver([post_save, post_delete], sender=CourseStudent)
+@receiver([post_save, post_delete], sender=PrereqAllConditionsMet)
+def available_quests_changed_for_user(sender, instance, **kwargs):
+    invalidate_available_quests(instance.user_id)
+
+
+@receiver(user_logged_out)
+def flush_drafts_on_logout(sender, request, user, **kwargs):
+    """ Write the student's autosaved drafts to the database when their session ends """
+    if user is not None and connection.schema_name != get_public_schema_name():
+        QuestSubmission.objects.flush_drafts_for_user(user)
+
+
+def saved_instructions(quest_id):
+    return Quest.objects.get_queryset(include_archived=True).filter(id=quest_id) \
+        .values_list('instructions', flat=True).first()
+
+
+TIDY_HTML_CACHE_KEY = 'tidy_html_{fix_runaway_newlines:d}_{digest}'
+TIDY_HTML_CACHE_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def tidy_html_cache_key(markup, fix_runaway_newlines=False):
+    digest = hashlib.sha1(markup.encode('utf-8')).hexdigest()
+    return TIDY_HTML_CACHE_KEY.format(fix_runaway_newlines=fix_runaway_newlines, digest=digest)
 
 
 def tidy_html(markup, fix_runaway_newlines=False):
+    """ prettify_html(), cached by a hash of the markup """
+    key = tidy_html_cache_key(markup, fix_runaway_newlines)
+    prettified = cache.get(key)
+    if prettified is None:
+        prettified = prettify_html(markup, fix_runaway_newlines)
+        cache.set(key, prettified, TIDY_HTML_CACHE_TIMEOUT)
+    return prettified
+
+
+def prettify_html(markup, fix_runaway_newlines=False):
 
     # https://stackoverflow.com/questions/17583415/customize-beautifulsoups-prettify-by-tag
 
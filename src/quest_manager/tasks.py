@@ -0,0 +1,91 @@
+import json
+from datetime import timedelta
+
+from celery import shared_task
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django_celery_beat.models import ClockedSchedule, PeriodicTask
+from tenant_schemas.utils import schema_context
+
+from .models import Quest, QuestSubmission, invalidate_quest_availability
+
+# django_celery_beat's tables are shared by all the tenants, so each tenant has its own task
+AVAILABILITY_TASK_NAME = 'Quest availability update {}'
+
+SUBMISSION_DRAFTS_FLUSH_SCHEDULED_CACHE_KEY = 'submission_drafts_flush_scheduled'
+
+
+def schedule_quest_availability_update():
+    """
+    Schedule update_quest_availability for the next moment a quest of the current tenant becomes available or expires,
+    replacing the one already scheduled for the tenant, if any.
+    """
+    schema_name = connection.schema_name
+    task_name = AVAILABILITY_TASK_NAME.format(schema_name)
+    next_change = Quest.objects.update_next_availability_changes()
+
+    task = PeriodicTask.objects.filter(name=task_name).select_related('clocked').first()
+
+    if next_change is None:  # There shouldn't be a task so delete if it exists
+        if task is not None:
+            task.delete()
+            delete_unused_clocked_schedule(task.clocked)
+        return
+
+    # quests expire just after their expiry time
+    clocked_time = next_change + timedelta(seconds=1)
+
+    # PeriodicTask doesn't have an update_or_create method for some reason, so do it long way
+    # https://github.com/celery/django-celery-beat/issues/106
+    defaults = {
+        'task': 'quest_manager.tasks.update_quest_availability',
+        'queue': 'default',
+        # beat doesn't know which tenant it's for
+        'kwargs': json.dumps({'schema_name': schema_name}),
+        'one_off': True,
+        'enabled': True,
+    }
+    if task is None:
+        task = PeriodicTask(name=task_name)
+    # The task keeps its own ClockedSchedule and moves it, a new one for every change would pile up in the shared
+    # table.  Tasks scheduled before that could share theirs, see delete_unused_clocked_schedule()
+    previous_schedule = task.clocked
+    if previous_schedule is None or PeriodicTask.objects.filter(clocked=previous_schedule).exclude(pk=task.pk).exists():
+        task.clocked = ClockedSchedule.objects.create(clocked_time=clocked_time)
+    elif previous_schedule.clocked_time != clocked_time:
+        previous_schedule.clocked_time = clocked_time
+        previous_schedule.save()
+    for key, value in defaults.items():
+        setattr(task, key, value)
+    task.save()
+
+
+def delete_unused_clocked_schedule(schedule):
+    """ Delete the ClockedSchedule if no PeriodicTask uses it anymore (deleting it would delete them too) """
+    if schedule is not None and not PeriodicTask.objects.filter(clocked=schedule).exists():
+        schedule.delete()
+
+
+@shared_task(name='quest_manager.tasks.update_quest_availability')
+def update_quest_availability(schema_name):
+    """ Run when quests become available or expire: invalidate the cached quest availability and schedule the next run """
+    with schema_context(schema_name):
+        invalidate_quest_availability()
+        schedule_quest_availability_update()
+
+
+def schedule_submission_drafts_flush():
+    """ Flush the draft store in SUBMISSION_DRAFT_FLUSH_COUNTDOWN seconds, unless a flush is already scheduled """
+    countdown = settings.SUBMISSION_DRAFT_FLUSH_COUNTDOWN
+    # Expires on its own in case the task is lost
+    if cache.add(SUBMISSION_DRAFTS_FLUSH_SCHEDULED_CACHE_KEY, True, countdown * 10):
+        flush_submission_drafts.apply_async(queue='default', countdown=countdown)
+
+
+@shared_task(name='quest_manager.tasks.flush_submission_drafts')
+def flush_submission_drafts():
+    """ Write the autosaved drafts in the draft store to their submissions """
+    # drafts saved from now on schedule the next flush
+    cache.delete(SUBMISSION_DRAFTS_FLUSH_SCHEDULED_CACHE_KEY)
+    QuestSubmission.objects.flush_drafts()
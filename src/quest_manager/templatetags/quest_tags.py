@@ -13,4 +13,4 @@ def is_hidden(quest, user):
     """
     if not user or not quest:
         return None
-    return user.profile.is_quest_hidden(quest)
+    return quest.id in user.profile.get_hidden_quest_ids()
@@ -0,0 +1,60 @@
+import uuid
+
+import tablib
+from django.contrib.contenttypes.models import ContentType
+from mock import patch
+from model_mommy import mommy
+from tenant_schemas.test.cases import TenantTestCase
+
+from prerequisites.models import Prereq
+from quest_manager.admin import QuestResource
+from quest_manager.models import Quest
+
+
+class QuestResourceTest(TenantTestCase):
+
+    def setUp(self):
+        self.prereq_quest = mommy.make(Quest, name="Prereq Quest")
+        self.quest = mommy.make(Quest, name="Quest", xp=5)
+
+    def has_simple_prereq(self, parent_quest, prereq_quest):
+        quest_ct = ContentType.objects.get_for_model(Quest)
+        return Prereq.objects.filter(
+            parent_content_type=quest_ct, parent_object_id=parent_quest.id,
+            prereq_content_type=quest_ct, prereq_object_id=prereq_quest.id,
+        ).exists()
+
+    @patch('quest_manager.admin.update_quest_conditions_all.apply_async')
+    def test_quest_resource_import(self, update_conditions):
+        rows = QuestResource().export(Quest.objects.filter(id__in=[self.prereq_quest.id, self.quest.id])).dict
+        for row in rows:
+            if row['name'] == "Quest":
+                row['xp'] = 8
+                row['prereq_quest_import_id'] = str(self.prereq_quest.import_id)
+                row['campaign_title'] = "Campaign"
+        rows.append(dict(rows[0], name="New Quest", import_id=str(uuid.uuid4()),
+                         prereq_quest_import_id=str(self.quest.import_id), campaign_title="Campaign"))
+
+        dataset = tablib.Dataset(headers=list(rows[0].keys()))
+        for row in rows:
+            dataset.append([row[header] for header in dataset.headers])
+
+        result = QuestResource().import_data(dataset, dry_run=False)
+
+        self.assertFalse(result.has_errors())
+        self.assertEqual(Quest.objects.count(), 3)
+        # conditions are refreshed once for the whole import, not for every quest and prereq
+        update_conditions.assert_called_once()
+
+        quest = Quest.objects.get(id=self.quest.id)
+        new_quest = Quest.objects.get(name="New Quest")
+        self.assertEqual(quest.xp, 8)
+        self.assertEqual(quest.campaign.title, "Campaign")
+        self.assertEqual(new_quest.campaign, quest.campaign)
+        self.assertTrue(self.has_simple_prereq(quest, self.prereq_quest))
+        self.assertTrue(self.has_simple_prereq(new_quest, quest))
+        self.assertEqual([row.object_id for row in result.rows], [self.prereq_quest.id, quest.id, new_quest.id])
+
+        # importing again doesn't duplicate the prereqs
+        QuestResource().import_data(dataset, dry_run=False)
+        self.assertEqual(Prereq.objects.count(), 2)
@@ -7,7 +7,7 @@ from freezegun import freeze_time
 from tenant_schemas.test.cases import TenantTestCase
 
 from quest_manager.models import Quest, QuestSubmission
-from courses.models import Semester
+from courses.models import Block, CourseStudent, Semester
 
 from siteconfig.models import SiteConfig
 
@@ -223,6 +223,36 @@ class QuestManagerTest(TenantTestCase):
         qs = Quest.objects.get_available(self.student)
         self.assertListEqual(list(qs.values_list('name', flat=True)), ['Quest-not-started'])
 
+    def test_quest_manager_get_available_cached(self):
+        """ QuestManager.get_available should be cached per user until something affecting it changes """
+        quest = mommy.make(Quest, name='Quest-repeatable', max_repeats=-1, hours_between_repeats=1)
+        Quest.objects.get_available(self.student)
+
+        # one cache read and the quests
+        with self.assertNumQueries(1):
+            self.assertListEqual(list(Quest.objects.get_available(self.student)), [quest])
+
+        # hiding the quest
+        self.student.profile.hide_quest(quest.id)
+        self.assertListEqual(list(Quest.objects.get_available(self.student)), [])
+        self.assertListEqual(list(Quest.objects.get_available(self.student, remove_hidden=False)), [quest])
+        self.student.profile.unhide_quest(quest.id)
+
+        # starting the quest
+        sub = mommy.make(QuestSubmission, quest=quest, user=self.student, semester=SiteConfig.get().active_semester)
+        self.assertListEqual(list(Quest.objects.get_available(self.student)), [])
+
+        # still not available after completing it, until the time between repeats runs out
+        sub.mark_completed()
+        self.assertListEqual(list(Quest.objects.get_available(self.student)), [])
+        with freeze_time(localtime() + timedelta(hours=1, minutes=1)):
+            self.assertListEqual(list(Quest.objects.get_available(self.student)), [quest])
+
+        # editing the quest
+        quest.visible_to_students = False
+        quest.save()
+        self.assertListEqual(list(Quest.objects.get_available(self.student)), [])
+
     def make_test_quests_and_submissions_stack(self):
         """  Creates 6 quests with related submissions
         Quest                   sub     .completed   .semester
@@ -297,6 +327,27 @@ class QuestSubmissionQuerysetTest(TenantTestCase):
         qs = QuestSubmission.objects.order_by('id').get_quest(quest).values_list('id', flat=True)
         self.assertListEqual(list(qs), [first.id, second.id])
 
+    def test_quest_submission_qs_for_teacher_only(self):
+        """QuestSubmissionQuerySet.for_teacher_only should return the submissions of students in the teacher's blocks
+        this semester, and of quests that notify the teacher specifically """
+        active_semester = SiteConfig.get().active_semester
+        block = mommy.make(Block, current_teacher=self.teacher)
+        other_block = mommy.make(Block)
+        other_student = mommy.make(User)
+        past_student = mommy.make(User)
+        mommy.make(CourseStudent, user=self.student, block=block, semester=active_semester)
+        mommy.make(CourseStudent, user=other_student, block=other_block, semester=active_semester)
+        mommy.make(CourseStudent, user=past_student, block=block, semester=mommy.make(Semester))
+
+        mine = mommy.make(QuestSubmission, user=self.student)
+        notifies_me = mommy.make(QuestSubmission, user=other_student, quest__specific_teacher_to_notify=self.teacher)
+        mommy.make(QuestSubmission, user=other_student)
+        mommy.make(QuestSubmission, user=past_student)
+
+        qs = QuestSubmission.objects.order_by('id').for_teacher_only(self.teacher).values_list('id', flat=True)
+        self.assertListEqual(list(qs), [mine.id, notifies_me.id])
+        self.assertEqual(QuestSubmission.objects.all().for_teacher_only(None).count(), 4)
+
     def test_quest_submission_qs_get_semester(self):
         """QuestSubmissionQuerySet.get_semester should return all quest submissions for given semester"""
         semester = mommy.make(Semester, active=True)
@@ -366,6 +417,37 @@ class QuestSubmissionManagerTest(TenantTestCase):
         qs = QuestSubmission.objects.all_for_user_quest(self.student, quest, True).values_list('id', flat=True)
         self.assertListEqual(list(qs), [first.id])
 
+    def test_quest_submission_manager_get_summaries(self):
+        """
+        QuestSubmissionManager.get_summaries should summarize the user's submissions of each quest, from all semesters
+        """
+        active_semester = mommy.make(Semester)
+        past_semester = mommy.make(Semester)
+        SiteConfig.get().set_active_semester(active_semester.id)
+        quest = mommy.make(Quest, max_repeats=-1)
+        not_started = mommy.make(Quest)
+
+        past = mommy.make(QuestSubmission, user=self.student, quest=quest, semester=past_semester)
+        past.mark_completed()
+        completed = mommy.make(QuestSubmission, user=self.student, quest=quest, semester=active_semester, ordinal=2)
+        completed.mark_completed()
+        mommy.make(QuestSubmission, user=self.student, quest=quest, semester=active_semester, ordinal=3)
+        mommy.make(QuestSubmission, user=self.teacher, quest=quest, semester=active_semester, ordinal=4)
+
+        with self.assertNumQueries(2):  # SiteConfig and the grouped submissions
+            summaries = QuestSubmission.objects.get_summaries(self.student, [quest, not_started])
+
+        self.assertNotIn(not_started.id, summaries)
+        summary = summaries[quest.id]
+        self.assertEqual(summary['max_ordinal'], 3)
+        self.assertEqual(summary['num_in_progress'], 1)
+        self.assertEqual(summary['num_never_completed'], 1)
+        self.assertEqual(summary['latest_first_time_completed'], completed.first_time_completed)
+        self.assertEqual(summary['num_completed_this_semester'], 1)
+
+        self.assertTrue(not_started.not_submitted_or_inprogress(summaries.get(not_started.id)))
+        self.assertFalse(quest.not_submitted_or_inprogress(summary))
+
     def make_test_submissions_stack(self):
         active = mommy.make(Semester, active=True)
         inactive = mommy.make(Semester, active=False)
@@ -1,9 +1,11 @@
 import re
 
-from datetime import timedelta
-from django.utils.timezone import localtime
+from datetime import datetime, time, timedelta
+from django.utils.timezone import localtime, make_aware
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 
+from mock import patch
 from model_mommy import mommy
 from model_mommy.recipe import Recipe
 from freezegun import freeze_time
@@ -12,7 +14,9 @@ from tenant_schemas.test.client import TenantClient
 
 from siteconfig.models import SiteConfig
 
-from quest_manager.models import Category, CommonData, Quest, QuestSubmission
+from quest_manager.models import (
+    QUEST_ACTIVE_IDS_CACHE_KEY, Category, CommonData, Quest, QuestSubmission, get_quest_availability_version
+)
 from courses.models import Semester
 
 
@@ -89,6 +93,29 @@ class QuestTestModel(TenantTestCase):
             formatted_markup = self.quest.instructions
             self.assertEqual(formatted_markup, pair[1])
 
+    def test_quest_html_formatting_cached(self):
+        self.quest.instructions = "<p>some <b>bold</b> text</p>"
+        self.quest.save()
+        self.assertEqual(self.quest.instructions, "<p>\n    some <b>bold</b> text\n</p>")
+
+        # unchanged instructions, e.g. toggling another field, aren't parsed again
+        with patch('quest_manager.signals.prettify_html') as prettify_html:
+            self.quest.sort_order = 5
+            self.quest.save()
+            Quest.objects.get(id=self.quest.id).save()
+            prettify_html.assert_not_called()
+        self.assertEqual(self.quest.instructions, "<p>\n    some <b>bold</b> text\n</p>")
+
+    def test_quest_html_formatting_pre_unchanged_on_resave(self):
+        self.quest.instructions = "<div><pre>line one\n  indented line</pre></div>"
+        self.quest.save()
+        tidied = self.quest.instructions
+
+        # tidying again would re-indent the <pre> text
+        self.quest.save()
+        Quest.objects.get(id=self.quest.id).save()
+        self.assertEqual(Quest.objects.get(id=self.quest.id).instructions, tidied)
+
     @freeze_time('2018-10-12 00:54:00', tz_offset=0)
     def test_is_repeat_available(self):
         """
@@ -197,6 +224,95 @@ class QuestTestModel(TenantTestCase):
         self.assertFalse(quest_semester.is_repeat_available(student))
 
 
+@freeze_time('2018-10-12 00:54:00', tz_offset=0)
+class QuestAvailabilityTestModel(TenantTestCase):
+
+    def setUp(self):
+        self.now_local = localtime()
+        self.today = self.now_local.date()
+
+    def local_datetime(self, date, hour, minute=0):
+        return make_aware(datetime.combine(date, time(hour, minute)))
+
+    def test_next_availability_change_not_available_yet(self):
+        quest = mommy.make(Quest, date_available=self.today + timedelta(days=2), time_available=time(9))
+        self.assertEqual(quest.next_availability_change(), self.local_datetime(self.today + timedelta(days=2), 9))
+
+    def test_next_availability_change_expiry_date(self):
+        quest = mommy.make(Quest, date_expired=self.today + timedelta(days=1))
+        # expires after the date, at midnight
+        self.assertEqual(quest.next_availability_change(), self.local_datetime(self.today + timedelta(days=2), 0))
+
+        quest = mommy.make(Quest, date_expired=self.today + timedelta(days=1), time_expired=time(14))
+        self.assertEqual(quest.next_availability_change(), self.local_datetime(self.today + timedelta(days=1), 14))
+
+        # already expired, it won't change again
+        quest = mommy.make(Quest, date_expired=self.today - timedelta(days=1))
+        self.assertIsNone(quest.next_availability_change())
+
+    def test_next_availability_change_daily_expiry(self):
+        later_today = (self.now_local + timedelta(hours=1)).time().replace(second=0, microsecond=0)
+        quest = mommy.make(Quest, time_expired=later_today)
+        self.assertEqual(quest.next_availability_change(), make_aware(datetime.combine(self.today, later_today)))
+
+        # expired for today, back at midnight
+        earlier_today = (self.now_local - timedelta(hours=1)).time().replace(second=0, microsecond=0)
+        quest = mommy.make(Quest, time_expired=earlier_today)
+        self.assertEqual(quest.next_availability_change(), self.local_datetime(self.today + timedelta(days=1), 0))
+
+    def test_next_availability_change_never(self):
+        quest = mommy.make(Quest)
+        self.assertIsNone(quest.next_availability_change())
+        self.assertIsNone(quest.datetime_next_availability_change)
+
+    def test_next_availability_change_stored_on_save(self):
+        quest = mommy.make(Quest, date_expired=self.today + timedelta(days=1), time_expired=time(14))
+        quest.refresh_from_db()
+        self.assertEqual(quest.datetime_next_availability_change, self.local_datetime(self.today + timedelta(days=1), 14))
+
+    def test_get_active_ids_across_transitions(self):
+        later_today = (self.now_local + timedelta(hours=1)).time().replace(second=0, microsecond=0)
+        daily = mommy.make(Quest, time_expired=later_today)
+        tomorrow = mommy.make(Quest, date_available=self.today + timedelta(days=1))
+        always = mommy.make(Quest)
+
+        self.assertSetEqual(Quest.objects.get_active_ids(), {daily.id, always.id})
+
+        with freeze_time(self.now_local + timedelta(hours=2)):
+            # daily quest expired, even though nothing was saved and the scheduled update didn't run
+            self.assertSetEqual(Quest.objects.get_active_ids(), {always.id})
+            # and the stored next change is left for the scheduled update to save
+            stored_change = daily.datetime_next_availability_change
+            daily.refresh_from_db()
+            self.assertEqual(daily.datetime_next_availability_change, stored_change)
+
+        with freeze_time(self.local_datetime(self.today + timedelta(days=1), 0, 1)):
+            # back again after midnight, along with the quest that became available
+            self.assertSetEqual(Quest.objects.get_active_ids(), {daily.id, tomorrow.id, always.id})
+
+    def test_get_active_ids_invalidated_on_save(self):
+        quest = mommy.make(Quest)
+        self.assertIn(quest.id, Quest.objects.get_active_ids())
+
+        quest.visible_to_students = False
+        quest.save()
+        self.assertNotIn(quest.id, Quest.objects.get_active_ids())
+        # replacing the entry of the previous version
+        self.assertEqual(cache.get(QUEST_ACTIVE_IDS_CACHE_KEY)['version'], get_quest_availability_version())
+
+    def test_update_next_availability_changes(self):
+        later_today = (self.now_local + timedelta(hours=1)).time().replace(second=0, microsecond=0)
+        quest = mommy.make(Quest, time_expired=later_today)
+        expiry = make_aware(datetime.combine(self.today, later_today))
+        self.assertEqual(Quest.objects.update_next_availability_changes(), expiry)
+
+        with freeze_time(self.now_local + timedelta(hours=2)):
+            self.assertEqual(Quest.objects.update_next_availability_changes(),
+                             self.local_datetime(self.today + timedelta(days=1), 0))
+        quest.refresh_from_db()
+        self.assertEqual(quest.datetime_next_availability_change, self.local_datetime(self.today + timedelta(days=1), 0))
+
+
 class SubmissionTestModel(TenantTestCase):
 
     def setUp(self):
@@ -233,6 +349,31 @@ class SubmissionTestModel(TenantTestCase):
         self.assertIsNotNone(sub.first_time_completed)
         self.assertIsNone(sub.draft_text)
 
+    @patch('quest_manager.tasks.schedule_submission_drafts_flush')
+    def test_submission_save_draft(self, schedule_flush):
+        sub = mommy.make(QuestSubmission)
+        sub.save_draft("Draft words")
+        schedule_flush.assert_called_once()
+        self.assertEqual(QuestSubmission.objects.get(id=sub.id).get_draft_text(), "Draft words")
+
+        # submitting discards the draft instead of flushing it over the cleared draft_text
+        sub.mark_completed()
+        self.assertIsNone(sub.get_draft_text())
+        self.assertEqual(QuestSubmission.objects.flush_drafts(), 0)
+
+        # too long for the draft store, so written straight through
+        with self.settings(SUBMISSION_DRAFT_MAX_LENGTH=5):
+            sub.save_draft("More draft words")
+        self.assertEqual(QuestSubmission.objects.get(id=sub.id).draft_text, "More draft words")
+
+        # too many drafts waiting, so they're all flushed right away
+        with self.settings(SUBMISSION_DRAFT_MAX_PENDING=1):
+            other_sub = mommy.make(QuestSubmission)
+            other_sub.save_draft("Other words")
+            sub.save_draft("Short")
+        self.assertEqual(QuestSubmission.objects.get(id=sub.id).draft_text, "Short")
+        self.assertEqual(QuestSubmission.objects.get(id=other_sub.id).draft_text, "Other words")
+
     def test_submission_get_previous(self):
         """ If this is a repeatable quest and has been completed already, return that previous submission """
         repeat_quest = mommy.make(Quest, name="repeatable-quest", max_repeats=-1)
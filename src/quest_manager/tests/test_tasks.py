@@ -0,0 +1,57 @@
+import json
+from datetime import timedelta
+
+from django.db import connection
+from django.utils import timezone
+from django_celery_beat.models import ClockedSchedule, PeriodicTask
+from mock import patch
+from model_mommy import mommy
+from tenant_schemas.test.cases import TenantTestCase
+
+from quest_manager.models import Quest
+from quest_manager.tasks import AVAILABILITY_TASK_NAME, schedule_quest_availability_update, update_quest_availability
+
+
+class QuestAvailabilityTaskTest(TenantTestCase):
+
+    def setUp(self):
+        self.quest = mommy.make(Quest, date_available=timezone.localtime().date() + timedelta(days=1))
+
+    def test_schedule_quest_availability_update_per_tenant(self):
+        schedule_quest_availability_update()
+        # the same from another tenant, whose schema name is all that matters here
+        with patch('quest_manager.tasks.connection') as other_connection:
+            other_connection.schema_name = 'other_tenant'
+            schedule_quest_availability_update()
+
+        for schema_name in [connection.schema_name, 'other_tenant']:
+            task = PeriodicTask.objects.get(name=AVAILABILITY_TASK_NAME.format(schema_name))
+            self.assertEqual(json.loads(task.kwargs), {'schema_name': schema_name})
+
+        # no more changes for this tenant, the other tenant's task is left alone
+        Quest.objects.all().delete()
+        schedule_quest_availability_update()
+        self.assertFalse(PeriodicTask.objects.filter(name=AVAILABILITY_TASK_NAME.format(connection.schema_name)).exists())
+        self.assertTrue(PeriodicTask.objects.filter(name=AVAILABILITY_TASK_NAME.format('other_tenant')).exists())
+
+    def test_reschedule_quest_availability_update_reuses_schedule(self):
+        schedule_quest_availability_update()
+        self.quest.date_available += timedelta(days=1)
+        self.quest.save()
+        schedule_quest_availability_update()
+
+        # moved, rather than a new ClockedSchedule left behind for every change
+        self.assertEqual(ClockedSchedule.objects.count(), 1)
+        task = PeriodicTask.objects.get(name=AVAILABILITY_TASK_NAME.format(connection.schema_name))
+        self.assertEqual(task.clocked.clocked_time, self.quest.next_availability_change() + timedelta(seconds=1))
+
+        # and deleted along with the task
+        Quest.objects.all().delete()
+        schedule_quest_availability_update()
+        self.assertFalse(ClockedSchedule.objects.exists())
+
+    @patch('quest_manager.tasks.invalidate_quest_availability')
+    def test_update_quest_availability_in_tenant(self, invalidate):
+        update_quest_availability(connection.schema_name)
+        invalidate.assert_called_once()
+        self.assertTrue(PeriodicTask.objects.filter(name=AVAILABILITY_TASK_NAME.format(connection.schema_name)).exists())
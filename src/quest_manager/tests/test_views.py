@@ -1,13 +1,23 @@
+from datetime import timedelta
+
 from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 
+from mock import patch
 from model_mommy import mommy
 from tenant_schemas.test.cases import TenantTestCase
 from tenant_schemas.test.client import TenantClient
 
 from siteconfig.models import SiteConfig
 
-from quest_manager.models import QuestSubmission, Quest
+from comments.models import Comment
+from courses.models import Block, CourseStudent
+from notifications.models import Notification
+from quest_manager.models import Category, QuestSubmission, Quest
+from quest_manager.views import paginate_keyset
 
 
 class QuestViewTests(TenantTestCase):
@@ -138,6 +148,39 @@ class SubmissionViewTests(TenantTestCase):
         self.sub2 = mommy.make(QuestSubmission, quest=self.quest1)
         self.sub3 = mommy.make(QuestSubmission, quest=self.quest2)
 
+    @patch('quest_manager.models.Quest.get_icon_url', return_value='/icon.png')
+    def test_available_quest_cards_cached(self, get_icon_url):
+        self.client.force_login(self.test_teacher)
+        num_quests = Quest.objects.all().visible().count()
+        response = self.client.get(reverse('quests:available'))
+        self.assertContains(response, self.quest1.name)
+        self.assertEqual(get_icon_url.call_count, num_quests)
+
+        # rendered from the cache
+        self.client.get(reverse('quests:available'))
+        self.assertEqual(get_icon_url.call_count, num_quests)
+
+        # editing a quest only renders its own card again
+        self.quest1.save()
+        self.client.get(reverse('quests:available'))
+        self.assertEqual(get_icon_url.call_count, num_quests + 1)
+
+        # a campaign is shown on every card
+        mommy.make(Category)
+        self.client.get(reverse('quests:available'))
+        self.assertEqual(get_icon_url.call_count, num_quests * 2 + 1)
+
+    def test_available_quest_cards_show_current_editor(self):
+        self.client.force_login(self.test_teacher)
+        self.quest1.editor = self.test_teacher
+        self.quest1.save()
+        self.assertContains(self.client.get(reverse('quests:available')), 'Editor: test_teacher')
+
+        # the editor line isn't cached with the rest of the card
+        self.test_teacher.username = 'renamed_teacher'
+        self.test_teacher.save()
+        self.assertContains(self.client.get(reverse('quests:available')), 'Editor: renamed_teacher')
+
     def test_all_submission_page_status_codes_for_students(self):
         # log in a student
         success = self.client.login(username=self.test_student1.username, password=self.test_password)
@@ -221,6 +264,58 @@ class SubmissionViewTests(TenantTestCase):
         self.assertEqual(self.client.get(reverse('quests:skip', args=[s1_pk])).status_code, 302)
         self.assertEqual(self.client.get(reverse('quests:approve', args=[s1_pk])).status_code, 404)
 
+    def test_approve_selected(self):
+        self.client.force_login(self.test_teacher)
+        semester = SiteConfig.get().active_semester
+        subs = mommy.make(QuestSubmission, quest=self.quest1, user=self.test_student1, semester=semester,
+                          is_completed=True, time_completed=timezone.now(), _quantity=3)
+        not_selected = mommy.make(QuestSubmission, quest=self.quest2, user=self.test_student1, semester=semester,
+                                  is_completed=True, time_completed=timezone.now())
+
+        response = self.client.post(reverse('quests:approve_selected'), data={
+            'submission_ids': [subs[0].id, subs[1].id],
+            'approve_button': '',
+        })
+        self.assertRedirects(response, reverse('quests:approvals'))
+        self.assertListEqual(
+            [sub.is_approved for sub in QuestSubmission.objects.filter(pk__in=[s.id for s in subs]).order_by('id')],
+            [True, True, False]
+        )
+        not_selected.refresh_from_db()
+        self.assertFalse(not_selected.is_approved)
+        self.assertEqual(Comment.objects.all_with_target_object(subs[0]).count(), 1)
+        self.assertEqual(Notification.objects.all_unread(self.test_student1).filter(verb='approved').count(), 2)
+
+        response = self.client.post(reverse('quests:approve_selected'), data={
+            'submission_ids': [subs[2].id],
+            'return_button': '',
+        })
+        subs[2].refresh_from_db()
+        self.assertTrue(subs[2].is_returned())
+
+        # GET not allowed
+        self.assertEqual(self.client.get(reverse('quests:approve_selected')).status_code, 404)
+
+    def test_approvals_submitted_query_count(self):
+        """ The number of queries for a teacher's approvals shouldn't depend on the size of other teachers' queues """
+        self.client.force_login(self.test_teacher)
+        semester = SiteConfig.get().active_semester
+        block = mommy.make(Block, current_teacher=self.test_teacher)
+        mommy.make(CourseStudent, user=self.test_student1, block=block, semester=semester)
+        mommy.make(QuestSubmission, user=self.test_student1, quest=self.quest2, semester=semester,
+                   is_completed=True, time_completed=timezone.now())
+
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse('quests:submitted'))
+            self.assertEqual(len(response.context['tab_list'][0]['submissions']), 1)
+            return len(queries)
+
+        num_queries = count_queries()
+        mommy.make(QuestSubmission, quest=self.quest1, semester=semester,
+                   is_completed=True, time_completed=timezone.now(), _quantity=10)
+        self.assertEqual(count_queries(), num_queries)
+
     def test_student_quest_completion(self):
         # self.sub1 = mommy.make(QuestSubmission, user=self.test_student1, quest=self.quest1)
 
@@ -266,5 +361,49 @@ class SubmissionViewTests(TenantTestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json()['result'], "Draft saved")
 
+        # kept in the draft store until it's flushed to the submission
+        sub.refresh_from_db()
+        self.assertIsNone(sub.draft_text)
+        self.assertEqual(draft_comment, sub.get_draft_text())
+
+        self.assertEqual(QuestSubmission.objects.flush_drafts(), 1)
         sub.refresh_from_db()
-        self.assertEqual(draft_comment, sub.draft_text)  # fAILS CUS MODEL DIDN'T SAVE! aRGH..
+        self.assertEqual(draft_comment, sub.draft_text)
+        self.assertEqual(QuestSubmission.objects.flush_drafts(), 0)
+
+
+class PaginateKeysetTests(TenantTestCase):
+
+    def setUp(self):
+        now = timezone.now()
+        # two share a time, so the id breaks the tie; two were never returned, so they come last
+        times = [now, now - timedelta(hours=1), now - timedelta(hours=1), now - timedelta(days=400), None, None]
+        self.subs = [mommy.make(QuestSubmission, time_returned=time) for time in times]
+        # newest first, ties and nulls by id descending
+        self.expected = [self.subs[0], self.subs[2], self.subs[1], self.subs[3], self.subs[5], self.subs[4]]
+
+    def test_paginate_keyset_forwards_and_backwards(self):
+        qs = QuestSubmission.objects.all()
+        pages = [paginate_keyset(qs, 'time_returned', per_page=2)]
+        while pages[-1].has_next():
+            pages.append(paginate_keyset(qs, 'time_returned', after=pages[-1].next_cursor, per_page=2))
+
+        self.assertListEqual([list(page) for page in pages],
+                             [self.expected[0:2], self.expected[2:4], self.expected[4:6]])
+        self.assertFalse(pages[0].has_previous())
+
+        previous = paginate_keyset(qs, 'time_returned', before=pages[2].previous_cursor, per_page=2)
+        self.assertListEqual(list(previous), self.expected[2:4])
+        self.assertTrue(previous.has_previous())
+        previous = paginate_keyset(qs, 'time_returned', before=previous.previous_cursor, per_page=2)
+        self.assertListEqual(list(previous), self.expected[0:2])
+        self.assertFalse(previous.has_previous())
+
+    def test_paginate_keyset_bad_cursor(self):
+        page = paginate_keyset(QuestSubmission.objects.all(), 'time_returned', after='garbage', per_page=2)
+        self.assertListEqual(list(page), self.expected[0:2])
+
+    def test_paginate_keyset_approximate_count(self):
+        page = paginate_keyset(QuestSubmission.objects.all(), 'time_returned', per_page=2, count=True)
+        self.assertIsInstance(page.approximate_count, int)
+        self.assertIsNone(paginate_keyset(QuestSubmission.objects.all(), 'time_returned').approximate_count)
@@ -1,27 +1,33 @@
 import json
 import uuid
+from datetime import datetime, timedelta
 
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.auth.mixins import UserPassesTestMixin
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.db import transaction
+from django.db.models import F, Q
 from django.http import HttpResponse, JsonResponse
 from django.shortcuts import render, get_object_or_404, redirect, Http404
 from django.template.loader import render_to_string
 from django.urls import reverse_lazy, reverse
+from django.utils import timezone
 from django.views.generic.edit import DeleteView, UpdateView, CreateView
 
 from siteconfig.models import SiteConfig
 
 from badges.models import BadgeAssertion
 from comments.models import Comment, Document
+from notifications.models import Notification
 from notifications.signals import notify
 from prerequisites.models import Prereq
 from prerequisites.tasks import update_quest_conditions_for_user
 from tenant.views import allow_non_public_view, AllowNonPublicViewMixin
 from .forms import QuestForm, SubmissionForm, SubmissionFormStaff, SubmissionQuickReplyForm
-from .models import Quest, QuestSubmission
+from .models import Quest, QuestSubmission, get_quest_card_version
 
 
 def is_staff_or_TA(user):
@@ -225,6 +231,8 @@ def quest_list(request, quest_id=None, submission_id=None, template="quest_manag
         # "num_completed": num_completed,
         "active_q_id": active_quest_id,
         "active_id": active_submission_id,
+        "quest_card_version": get_quest_card_version(),
+        "quest_card_cache_timeout": settings.QUEST_CARD_CACHE_TIMEOUT,
         "available_tab_active": available_tab_active,
         "inprogress_tab_active": in_progress_tab_active,
         "completed_tab_active": completed_tab_active,
@@ -399,6 +407,17 @@ def detail(request, quest_id):
 #
 # #################################
 
+APPROVED_ICON = "<span class='fa-stack'>" + \
+                "<i class='fa fa-check fa-stack-2x text-success'></i>" + \
+                "<i class='fa fa-shield fa-stack-1x'></i>" + \
+                "</span>"
+
+RETURNED_ICON = "<span class='fa-stack'>" + \
+                "<i class='fa fa-shield fa-stack-1x'></i>" + \
+                "<i class='fa fa-ban fa-stack-2x text-danger'></i>" + \
+                "</span>"
+
+
 @allow_non_public_view
 @staff_member_required
 def approve(request, submission_id):
@@ -441,10 +460,7 @@ def approve(request, submission_id):
             blank_comment_text = ""
             if 'approve_button' in request.POST:
                 note_verb = "approved"
-                icon = "<span class='fa-stack'>" + \
-                       "<i class='fa fa-check fa-stack-2x text-success'></i>" + \
-                       "<i class='fa fa-shield fa-stack-1x'></i>" + \
-                       "</span>"
+                icon = APPROVED_ICON
                 blank_comment_text = SiteConfig.get().blank_approval_text
                 submission.mark_approved()
             elif 'comment_button' in request.POST:
@@ -456,10 +472,7 @@ def approve(request, submission_id):
                 blank_comment_text = "(no comment added)"
             elif 'return_button' in request.POST:
                 note_verb = "returned"
-                icon = "<span class='fa-stack'>" + \
-                       "<i class='fa fa-shield fa-stack-1x'></i>" + \
-                       "<i class='fa fa-ban fa-stack-2x text-danger'></i>" + \
-                       "</span>"
+                icon = RETURNED_ICON
                 blank_comment_text = SiteConfig.get().blank_return_text
                 submission.mark_returned()
             else:
@@ -525,6 +538,46 @@ def approve(request, submission_id):
         raise Http404
 
 
+@allow_non_public_view
+@staff_member_required
+def approve_selected(request):
+    """ Approve or return all the submissions selected in the Submitted tab at once, see approve() """
+    if request.method != "POST":
+        raise Http404
+
+    submission_ids = request.POST.getlist('submission_ids')
+    submissions = QuestSubmission.objects.all_awaiting_approval().filter(pk__in=submission_ids)\
+        .select_related('user__profile', 'quest')
+
+    if 'approve_button' in request.POST:
+        note_verb = "approved"
+        icon = APPROVED_ICON
+        comment_text = SiteConfig.get().blank_approval_text
+        update_submissions = QuestSubmission.objects.approve_submissions
+    elif 'return_button' in request.POST:
+        note_verb = "returned"
+        icon = RETURNED_ICON
+        comment_text = SiteConfig.get().blank_return_text
+        update_submissions = QuestSubmission.objects.return_submissions
+    else:
+        raise Http404("unrecognized submit button")
+
+    with transaction.atomic():
+        submissions = update_submissions(submissions)
+        Comment.objects.create_comments(
+            user=request.user,
+            text=comment_text,
+            targets_paths=[(submission, submission.get_absolute_url()) for submission in submissions],
+        )
+        # no "with" in the notifications, since no comment was entered
+        Notification.objects.bulk_notify(
+            request.user, note_verb, icon, [(submission.user, submission, None) for submission in submissions]
+        )
+
+    messages.success(request, "{} submissions {}".format(len(submissions), note_verb))
+    return redirect("quests:approvals")
+
+
 def paginate(object_list, page, per_page=30):
     paginator = Paginator(object_list, per_page)
     try:
@@ -538,6 +591,110 @@ def paginate(object_list, page, per_page=30):
     return object_list
 
 
+class KeysetPage:
+    """ A page of paginate_keyset().  Unlike a Paginator page, it only knows its neighbours through their cursors. """
+    is_keyset = True
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None, approximate_count=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.approximate_count = approximate_count
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def encode_cursor(obj, field):
+    """ :return: the position of obj in a paginate_keyset() list ordered by field, e.g. '1539305640000000_12' """
+    value = getattr(obj, field)
+    timestamp = 'n' if value is None else str((value - EPOCH) // timedelta(microseconds=1))
+    return '{}_{}'.format(timestamp, obj.id)
+
+
+def decode_cursor(cursor):
+    """ :return: (datetime or None, id) from encode_cursor(), or None if the cursor isn't valid """
+    try:
+        timestamp, pk = cursor.split('_')
+        if timestamp == 'n':
+            return None, int(pk)
+        return EPOCH + timedelta(microseconds=int(timestamp)), int(pk)
+    except (AttributeError, ValueError, OverflowError, OSError):
+        return None
+
+
+def approximate_count(queryset):
+    """ :return: the planner's estimate of the number of rows in the queryset, without counting them """
+    plan = json.loads(queryset.explain(format='json'))
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def paginate_keyset(queryset, field, after=None, before=None, per_page=30, count=False):
+    """
+    Paginate queryset from newest to oldest by the datetime `field` (nulls last), then id.  Instead of a page
+    number, pages after or before the cursor of an object are requested, so every page costs the same as the first
+    one: no OFFSET, and no COUNT unless `count`, which is approximate.
+    :param after: the next_cursor of the previous page
+    :param before: the previous_cursor of the next page
+    """
+    newest_first = [F(field).desc(nulls_last=True), '-id']
+    oldest_first = [F(field).asc(nulls_first=True), 'id']
+    approx = approximate_count(queryset) if count else None
+
+    position = decode_cursor(before) if before else None
+    if position:
+        value, pk = position
+        if value is None:
+            older = Q(**{field + '__isnull': False}) | Q(**{field + '__isnull': True, 'id__gt': pk})
+        else:
+            older = Q(**{field + '__gt': value}) | Q(**{field: value, 'id__gt': pk})
+        object_list = list(queryset.filter(older).order_by(*oldest_first)[:per_page + 1])
+        has_previous = len(object_list) > per_page
+        object_list = object_list[:per_page][::-1]
+        if object_list:
+            return KeysetPage(
+                object_list,
+                next_cursor=encode_cursor(object_list[-1], field),
+                previous_cursor=encode_cursor(object_list[0], field) if has_previous else None,
+                approximate_count=approx,
+            )
+        after = None  # nothing newer, so deliver the first page
+
+    position = decode_cursor(after) if after else None
+    if position:
+        value, pk = position
+        if value is None:
+            newer = Q(**{field + '__isnull': True, 'id__lt': pk})
+        else:
+            newer = Q(**{field + '__lt': value}) | Q(**{field: value, 'id__lt': pk}) | Q(**{field + '__isnull': True})
+        queryset = queryset.filter(newer)
+
+    object_list = list(queryset.order_by(*newest_first)[:per_page + 1])
+    has_next = len(object_list) > per_page
+    object_list = object_list[:per_page]
+    return KeysetPage(
+        object_list,
+        next_cursor=encode_cursor(object_list[-1], field) if has_next else None,
+        previous_cursor=encode_cursor(object_list[0], field) if position and object_list else None,
+        approximate_count=approx,
+    )
+
+
 @allow_non_public_view
 @staff_member_required
 def approvals(request, quest_id=None):
@@ -585,16 +742,19 @@ def approvals(request, quest_id=None):
     skipped_tab_active = False
 
     page = request.GET.get('page')
+    # cursors for the tabs paginated with paginate_keyset(), their history grows every semester
+    after = request.GET.get('after')
+    before = request.GET.get('before')
     # if '/submitted/' in request.path_info:
     #     approval_submissions = QuestSubmission.objects.all_awaiting_approval()
     if '/returned/' in request.path_info:
         returned_submissions = QuestSubmission.objects.all_returned()
         returned_tab_active = True
-        returned_submissions = paginate(returned_submissions, page)
+        returned_submissions = paginate_keyset(returned_submissions, 'time_returned', after, before, count=True)
     elif '/approved/' in request.path_info:
         approved_submissions = QuestSubmission.objects.all_approved(quest=quest, active_semester_only=active_sem_only)
         approved_tab_active = True
-        approved_submissions = paginate(approved_submissions, page)
+        approved_submissions = paginate_keyset(approved_submissions, 'time_approved', after, before, count=True)
     elif '/skipped/' in request.path_info:
         skipped_submissions = QuestSubmission.objects.all_skipped()
         skipped_tab_active = True
@@ -914,8 +1074,7 @@ def ajax_save_draft(request):
         submission_id = request.POST.get('submission_id')
 
         sub = get_object_or_404(QuestSubmission, pk=submission_id)
-        sub.draft_text = submission_comment
-        sub.save()
+        sub.save_draft(submission_comment)
 
         response_data = {}
         response_data['result'] = 'Draft saved'
@@ -955,7 +1114,7 @@ def submission(request, submission_id=None, quest_id=None):
         # Staff form has additional fields such as award granting.
         main_comment_form = SubmissionFormStaff(request.POST or None)
     else:
-        initial = {'comment_text': sub.draft_text}
+        initial = {'comment_text': sub.get_draft_text()}
         main_comment_form = SubmissionForm(request.POST or None, initial=initial)
 
     # main_comment_form = CommentForm(request.POST or None, wysiwyg=True, label="")
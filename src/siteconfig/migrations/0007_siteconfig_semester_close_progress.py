@@ -0,0 +1,17 @@
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('siteconfig', '0006_auto_20200403_1528'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='siteconfig',
+            name='semester_close_progress',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, editable=False, help_text='How far closing a semester has got, see courses.models.SemesterManager.close_semester()', null=True),
+        ),
+    ]
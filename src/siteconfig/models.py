@@ -1,4 +1,5 @@
 from django.contrib.auth import get_user_model
+from django.contrib.postgres.fields import JSONField
 from django.core.exceptions import MultipleObjectsReturned
 from django.db import models
 from django.shortcuts import get_object_or_404
@@ -141,6 +142,11 @@ class SiteConfig(models.Model):
     # hs_message_teachers_only = forms.BooleanField(label="Limit students so they can only message teachers",
     #                                               default=True, required=False)
 
+    semester_close_progress = JSONField(
+        null=True, blank=True, editable=False,
+        help_text="How far closing a semester has got, see courses.models.SemesterManager.close_semester()"
+    )
+
     def get_absolute_url(self):
         from django.urls import reverse
         return reverse('site_config_update', args=[str(self.id)])
@@ -1,6 +1,8 @@
 from django.contrib.admin.views.decorators import staff_member_required
 from django.utils.decorators import method_decorator
 from django.views.generic.edit import UpdateView
+
+from prerequisites.tasks import get_quest_conditions_queue_depth
 from .models import SiteConfig
 
 
@@ -8,3 +10,8 @@ from .models import SiteConfig
 class SiteConfigUpdate(UpdateView):
     model = SiteConfig
     fields = '__all__'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['quest_conditions_queue_depth'] = get_quest_conditions_queue_depth()
+        return context